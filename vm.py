@@ -40,7 +40,7 @@ token_types = 	{
 				}
 
 proc = vm_blocks.Proc(0, 5, consts, codes)
-domain = vm_domain.Domain(token_types)
+domain = vm_domain.Domain(token_types, vm_trace.TRACE_INSTRUCTION)
 domain.spawn_thread(proc)
 domain.run()
 
@@ -0,0 +1,72 @@
+# vm_async.py - Virtual Machine Event Loop Integration
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Runs a Domain as a coroutine on a trollius (asyncio for Python 2) event loop, see Domain.run_async.
+# trollius is optional, only run_async needs it.
+
+import time
+
+import vm_thread
+import vm_exception
+
+try:
+	import trollius as asyncio
+	from trollius import From
+except ImportError:
+	asyncio = None
+
+def all_halted(domain):
+	for thread in domain.threads:
+		if thread.state != vm_thread.THREAD_HALTED:
+			return False
+	return True
+
+def run_domain(domain, yield_instructions, loop):
+	# Returns the coroutine of Domain.run_async
+	if asyncio is None:
+		raise ImportError("Domain.run_async needs the trollius package")
+	return asyncio.coroutine(domain_coroutine)(domain, yield_instructions, loop)
+
+def domain_coroutine(domain, yield_instructions, loop):
+	# Domain.run, yielding to the loop every yield_instructions instructions. Paused threads are slept on
+	# with the loop's timers and threads waiting for the host on domain.wake_event, set by Thread.wake.
+	domain.trace_info("Domain", "Running Domain Async...")
+	run_queue = domain.run_queue
+	pool = domain.pool
+	quantum = min(domain.quantum, yield_instructions)
+	domain.error = None
+	domain.wake_event = asyncio.Event(loop=loop)
+	executed = 0
+	try:
+		while True:
+			if domain.sleepers:
+				domain.wake_sleepers(time.time())
+			if not run_queue:
+				if not domain.sleepers and all_halted(domain):
+					break
+				timeout = None
+				if domain.sleepers:
+					timeout = max(0.0, domain.sleepers[0][0] - time.time())
+				domain.wake_event.clear()
+				try:
+					yield From(asyncio.wait_for(domain.wake_event.wait(), timeout, loop=loop))
+				except asyncio.TimeoutError:
+					pass
+				executed = 0
+				continue
+			if pool.collect_pending:
+				domain.collect_garbage()
+			thread = run_queue.popleft()
+			executed += domain.run_thread(thread, quantum)
+			if thread.state == vm_thread.THREAD_RUNNING:
+				run_queue.append(thread)
+			if executed >= yield_instructions:
+				executed = 0
+				yield From(asyncio.sleep(0, loop=loop))
+	except vm_exception.VMException as e:
+		#Handle VM Exception
+		domain.error = e
+		domain.trace_sink.write_error(e.error_class, e.error_type, e.error_subtype, e.error_info)
+	finally:
+		domain.wake_event = None
+		domain.trace_info("Domain", "Finished Running Domain Async...")
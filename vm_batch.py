@@ -0,0 +1,75 @@
+# vm_batch.py - Virtual Machine Batch Runner
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import multiprocessing
+
+import vm_values
+import vm_domain
+import vm_thread
+
+# Result Format: {
+#	'status':string - 'halted', 'blocked' (a thread is still waiting), 'error' (a VMException) or 'failed' (any other exception),
+#	'error':dict - {error_type, error_subtype, error_info, error_class} of the VMException, or {'message'} if failed, None otherwise,
+#	'cycle_count':int - the number of instructions run by the domain,
+#	'eval_stack':list - the eval stack of the first thread's current frame when the domain stopped
+# }
+
+def export_value(value):
+	# Converts a VM value into something that can be sent back from a worker process
+	if vm_values.isNullValue(value):
+		return None
+	elif vm_values.isBoolValue(value) or vm_values.isIntValue(value) or vm_values.isFloatValue(value):
+		return value
+	elif vm_values.isCharValue(value):
+		return unicode(value)
+	else:
+		return repr(value)
+
+def run_job(job):
+	# Runs a (token_types, proc) or (token_types, proc, quotas) job in a new Domain and returns its result dict,
+	# quotas being the job's vm_domain.Quotas
+	token_types, proc = job[:2]
+	quotas = None
+	if len(job) > 2:
+		quotas = job[2]
+	result = { 'status':'halted', 'error':None, 'cycle_count':0, 'eval_stack':[] }
+	try:
+		domain = vm_domain.Domain(token_types, quotas=quotas)
+		thread = domain.spawn_thread(proc)
+		domain.run()
+		result['cycle_count'] = domain.cycle_count
+		if thread.frame_stack:
+			result['eval_stack'] = [export_value(value) for value in thread.frame_stack[-1].eval_stack]
+		if domain.error is not None:
+			e = domain.error
+			result['status'] = 'error'
+			result['error'] = { 'error_type':e.error_type, 'error_subtype':e.error_subtype, 'error_info':export_value(e.error_info), 'error_class':e.error_class }
+		elif any(thread.state == vm_thread.THREAD_BLOCKED for thread in domain.threads):
+			result['status'] = 'blocked'
+	except Exception as e:
+		result['status'] = 'failed'
+		result['error'] = { 'message':"{0}: {1}".format(type(e).__name__, e) }
+	return result
+
+class BatchRunner(object):
+	# Runs jobs on a pool of worker processes that stay warm between batches
+	# Fields:
+	#	pool: multiprocessing.Pool - the worker processes
+	def __init__(self, processes=None):
+		self.pool = multiprocessing.Pool(processes)
+	
+	def run(self, jobs, chunksize=1):
+		# Runs a list of jobs (see run_job), returning their result dicts in the same order
+		return self.pool.map(run_job, jobs, chunksize)
+	
+	def close(self):
+		self.pool.close()
+		self.pool.join()
+
+def run_batch(jobs, processes=None, chunksize=1):
+	# Runs a list of jobs (see run_job) on a new BatchRunner
+	runner = BatchRunner(processes)
+	try:
+		return runner.run(jobs, chunksize)
+	finally:
+		runner.close()
@@ -0,0 +1,4 @@
+# vm_bench - Virtual Machine Benchmarks
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Run from the repository root, e.g. python -m vm_bench.memory or python -m vm_bench.throughput
@@ -0,0 +1,55 @@
+# vm_bench/memory.py - Virtual Machine Memory Benchmark
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Usage: python -m vm_bench.memory [objects] [fields]
+# Measures the bytes per Obj block of a domain holding many objects, both as the growth of the
+# process' resident set and as the sum of sys.getsizeof over what each object allocates.
+
+import sys
+import resource
+
+import vm_values
+import vm_blocks
+import vm_domain
+
+def peak_rss_bytes():
+	# ru_maxrss is in kilobytes on Linux and in bytes on Mac OS X
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		return peak
+	return peak * 1024
+
+def object_sizeof(ref_value):
+	# The bytes allocated for one object: its ref, its block and the block's field list.
+	# Fields holding Null or small ints point at shared objects, so they only cost their list slot.
+	block = ref_value.block()
+	return sys.getsizeof(ref_value) + sys.getsizeof(block) + sys.getsizeof(block.instc_fields)
+
+def measure(objects, fields):
+	token = vm_values.TokenValue("bench", "obj")
+	domain = vm_domain.Domain({ token : vm_blocks.Type(fields, 0) })
+	pool = domain.pool
+	held = []
+	before = peak_rss_bytes()
+	for index in xrange(objects):
+		held.append(pool.add_block(vm_blocks.Obj(fields)))
+	after = peak_rss_bytes()
+	return {
+		'objects':objects,
+		'fields':fields,
+		'rss_bytes_per_object':float(after - before) / objects,
+		'sizeof_bytes_per_object':object_sizeof(held[0]),
+		'live_blocks':len(pool.blocks)
+	}
+
+if __name__ == "__main__":
+	objects = 1000000
+	fields = 5
+	if len(sys.argv) > 1:
+		objects = int(sys.argv[1])
+	if len(sys.argv) > 2:
+		fields = int(sys.argv[2])
+	results = measure(objects, fields)
+	print "Objects: {0} ({1} fields each)".format(results['objects'], results['fields'])
+	print "RSS bytes per object: {0:.1f}".format(results['rss_bytes_per_object'])
+	print "Allocated bytes per object: {0}".format(results['sizeof_bytes_per_object'])
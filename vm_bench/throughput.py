@@ -0,0 +1,169 @@
+# vm_bench/throughput.py - Virtual Machine Throughput Benchmark
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Usage: python -m vm_bench.throughput [--iterations N] [--repeats N] [--optimize] [--verify] [--jit]
+#			[--only name,...] [--json results.json] [--compare baseline.json] [--threshold 0.05]
+# Runs each workload in vm_bench.workloads with tracing off, in its own process so its peak memory
+# is its own, and reports the best of the repeats. --compare exits with status 1 if any workload
+# is slower, or uses more memory, than the baseline by more than the threshold.
+
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+
+import vm_trace
+import vm_jit
+import vm_domain
+import vm_verify
+import vm_optimize
+import vm_bench.memory
+import vm_bench.workloads
+
+FormatVersion = 1
+
+# Format: { result_key:String : higher_is_better:bool }
+# The results compared against a baseline
+ComparedResults = {
+	'iterations_per_second' : True,
+	'peak_rss_bytes' : False
+}
+
+def total_allocations(pool):
+	# Every block ever added is either still live or was freed by a collection
+	return len(pool.blocks) + pool.freed_blocks
+
+def run_once(name, iterations, optimize, verify, jit):
+	make_proc, threads, params = vm_bench.workloads.Workloads[name]
+	proc = make_proc(iterations)
+	if optimize:
+		vm_optimize.optimize_proc(proc)
+	if verify:
+		vm_verify.verify_proc(proc)
+	domain = vm_domain.Domain(vm_bench.workloads.token_types(), vm_trace.TRACE_OFF)
+	if jit:
+		domain.attach_compiler(vm_jit.Compiler())
+	if callable(params):
+		params = params(domain)
+	for index in range(threads):
+		domain.spawn_thread(proc, list(params))
+	allocations = total_allocations(domain.pool)
+	start = time.time()
+	domain.run()
+	seconds = time.time() - start
+	if domain.error is not None:
+		raise RuntimeError("workload {0} failed: {1} {2}".format(name, domain.error.error_type, domain.error.error_subtype))
+	return {
+		'seconds':seconds,
+		'instructions':domain.cycle_count,
+		'iterations':iterations * threads,
+		'allocations':total_allocations(domain.pool) - allocations
+	}
+
+def run_workload(args):
+	# Runs one workload repeats times, returning its result dict from the fastest run
+	name, iterations, repeats, optimize, verify, jit = args
+	best = None
+	for repeat in range(repeats):
+		run = run_once(name, iterations, optimize, verify, jit)
+		if best is None or run['seconds'] < best['seconds']:
+			best = run
+	seconds = max(best['seconds'], 1e-9)
+	return (name, {
+		'seconds':best['seconds'],
+		'instructions':best['instructions'],
+		'instructions_per_second':best['instructions'] / seconds,
+		'iterations_per_second':best['iterations'] / seconds,
+		'allocations_per_second':best['allocations'] / seconds,
+		'peak_rss_bytes':vm_bench.memory.peak_rss_bytes()
+	})
+
+def run_benchmarks(names, iterations, repeats, optimize=False, verify=False, jit=False):
+	# Returns the results document for the named workloads
+	pool = multiprocessing.Pool(1, maxtasksperchild=1)
+	try:
+		results = dict(pool.map(run_workload, [(name, iterations, repeats, optimize, verify, jit) for name in names], 1))
+	finally:
+		pool.close()
+		pool.join()
+	return {
+		'version':FormatVersion,
+		'python':platform.python_version(),
+		'platform':platform.platform(),
+		'options':{ 'iterations':iterations, 'repeats':repeats, 'optimize':optimize, 'verify':verify, 'jit':jit },
+		'results':results
+	}
+
+def compare_results(baseline, current, threshold):
+	# Returns a list of (name, result_key, baseline value, current value, change, is_regression),
+	# change being the fraction by which current is better (positive) or worse (negative)
+	comparisons = []
+	for name in sorted(current['results']):
+		if name not in baseline['results']:
+			continue
+		for key, higher_is_better in sorted(ComparedResults.items()):
+			old = baseline['results'][name][key]
+			new = current['results'][name][key]
+			if old == 0:
+				continue
+			change = (float(new) - old) / old
+			if not higher_is_better:
+				change = -change
+			comparisons.append((name, key, old, new, change, change < -threshold))
+	return comparisons
+
+def format_results(document):
+	output = "{0:<14} {1:>12} {2:>14} {3:>14} {4:>14} {5:>12}".format("workload", "seconds", "instr/s", "iter/s", "alloc/s", "peak rss")
+	for name in sorted(document['results']):
+		result = document['results'][name]
+		output += "\n{0:<14} {1:>12.4f} {2:>14.0f} {3:>14.0f} {4:>14.0f} {5:>12}".format(name, result['seconds'], result['instructions_per_second'], result['iterations_per_second'], result['allocations_per_second'], result['peak_rss_bytes'])
+	return output
+
+def format_comparisons(comparisons):
+	output = "{0:<14} {1:<22} {2:>14} {3:>14} {4:>9}".format("workload", "result", "baseline", "current", "change")
+	for name, key, old, new, change, is_regression in comparisons:
+		output += "\n{0:<14} {1:<22} {2:>14.0f} {3:>14.0f} {4:>+8.1f}%".format(name, key, old, new, change * 100)
+		if is_regression:
+			output += " REGRESSION"
+	return output
+
+def main(argv):
+	parser = argparse.ArgumentParser(prog="python -m vm_bench.throughput")
+	parser.add_argument("--iterations", type=int, default=20000, help="loop iterations per thread")
+	parser.add_argument("--repeats", type=int, default=3, help="runs per workload, the fastest is kept")
+	parser.add_argument("--optimize", action="store_true", help="run vm_optimize over each proc first")
+	parser.add_argument("--verify", action="store_true", help="run vm_verify over each proc first")
+	parser.add_argument("--jit", action="store_true", help="compile hot procs with vm_jit")
+	parser.add_argument("--only", help="comma separated workload names")
+	parser.add_argument("--json", help="write the results to this file")
+	parser.add_argument("--compare", help="compare the results with this earlier --json file")
+	parser.add_argument("--threshold", type=float, default=0.05, help="the fraction worse than the baseline that is a regression")
+	options = parser.parse_args(argv)
+	names = sorted(vm_bench.workloads.Workloads)
+	if options.only:
+		names = options.only.split(",")
+	document = run_benchmarks(names, options.iterations, options.repeats, options.optimize, options.verify, options.jit)
+	print format_results(document)
+	if options.json:
+		f = open(options.json, "w")
+		try:
+			json.dump(document, f, indent=1, sort_keys=True)
+		finally:
+			f.close()
+	if options.compare:
+		f = open(options.compare)
+		try:
+			baseline = json.load(f)
+		finally:
+			f.close()
+		comparisons = compare_results(baseline, document, options.threshold)
+		print
+		print format_comparisons(comparisons)
+		if [comparison for comparison in comparisons if comparison[5]]:
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main(sys.argv[1:]))
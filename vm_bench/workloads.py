@@ -0,0 +1,165 @@
+# vm_bench/workloads.py - Virtual Machine Benchmark Workloads
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Generated Procs covering each opcode family. Every workload runs a stack neutral body in a loop
+# counted down in local 0, so each family's cost can be compared per iteration.
+
+import vm_values
+import vm_blocks
+
+BenchToken = vm_values.TokenValue("bench", "obj")
+
+def counted_loop(iterations, body, consts=[], prologue=[], locals_count=4, params_count=0):
+	# Returns a Proc running prologue once, then body iterations times. consts(0) is the iteration count,
+	# body and prologue consts start at consts(1).
+	top = len(prologue) + 4
+	opcodes = list(prologue) + [
+		20, 0,		# LD_CONST 0
+		23, 0		# ST_LOCAL 0
+	] + list(body) + [
+		22, 0,		# LD_LOCAL 0
+		36,			# IDEC
+		23, 0,		# ST_LOCAL 0
+		24,			# LD_0
+		22, 0,		# LD_LOCAL 0
+		48,			# ICMP_GT
+		14, top,	# BR_TRUE top
+		10			# HALT
+	]
+	return vm_blocks.Proc(params_count, locals_count, [iterations] + list(consts), opcodes)
+
+def load_store(iterations):
+	body = [
+		20, 1,		# LD_CONST 1
+		23, 1,		# ST_LOCAL 1
+		22, 1,		# LD_LOCAL 1
+		23, 2,		# ST_LOCAL 2
+		21, 0,		# LD_PARAM 0
+		23, 3,		# ST_LOCAL 3
+		25,			# LD_1
+		23, 1		# ST_LOCAL 1
+	]
+	return counted_loop(iterations, body, [7], params_count=1)
+
+def int_arith(iterations):
+	body = [
+		20, 1,		# LD_CONST 1 (7)
+		20, 2,		# LD_CONST 2 (3)
+		30,			# IADD
+		20, 2,		# LD_CONST 2
+		32,			# IMUL
+		20, 3,		# LD_CONST 3 (2)
+		31,			# ISUB
+		34,			# INEG
+		35,			# IING
+		36,			# IDEC
+		20, 1,		# LD_CONST 1
+		33,			# IDIV
+		23, 1		# ST_LOCAL 1
+	]
+	return counted_loop(iterations, body, [7, 3, 2])
+
+def int_compare(iterations):
+	body = []
+	for opcode in range(44, 50):
+		body += [
+			22, 0,		# LD_LOCAL 0
+			20, 1,		# LD_CONST 1
+			opcode,		# ICMP_*
+			1, 1		# POP 1
+		]
+	return counted_loop(iterations, body, [1000])
+
+def conversions(iterations):
+	body = [
+		22, 0,		# LD_LOCAL 0
+		83,			# I2B
+		84,			# B2I
+		83,			# I2B
+		84,			# B2I
+		23, 1		# ST_LOCAL 1
+	]
+	return counted_loop(iterations, body)
+
+def stack_ops(iterations):
+	body = [
+		25,			# LD_1
+		2,			# DUP
+		2,			# DUP
+		1, 2,		# POP 2
+		2,			# DUP
+		1, 2		# POP 2
+	]
+	return counted_loop(iterations, body)
+
+def alloc_churn(iterations):
+	body = [
+		20, 1,		# LD_CONST 1 (bench.obj)
+		58,			# LD_TYPE
+		61,			# NEWOBJ
+		2,			# DUP
+		20, 2,		# LD_CONST 2
+		56, 0,		# ST_FIELD 0
+		20, 2,		# LD_CONST 2
+		56, 1		# ST_FIELD 1
+	]
+	return counted_loop(iterations, body, [BenchToken, 5])
+
+def arrays(iterations):
+	prologue = [
+		20, 1,		# LD_CONST 1 (16)
+		60, 1,		# NEWARRAY Int
+		23, 1		# ST_LOCAL 1
+	]
+	body = [
+		22, 1,		# LD_LOCAL 1
+		25,			# LD_1
+		22, 0,		# LD_LOCAL 0
+		54,			# ST_ITEM
+		22, 1,		# LD_LOCAL 1
+		25,			# LD_1
+		53,			# LD_ITEM
+		22, 1,		# LD_LOCAL 1
+		57,			# LD_COUNT
+		1, 2		# POP 2
+	]
+	return counted_loop(iterations, body, [16], prologue)
+
+def channel_send(iterations):
+	# Sends a new object over the shared channel in param 0 and receives it back, while local 1 holds a
+	# large array, so the cost of Pool.detach walking the pool shows
+	prologue = [
+		20, 2,		# LD_CONST 2 (4096)
+		60, 0,		# NEWARRAY Value
+		23, 1		# ST_LOCAL 1
+	]
+	body = [
+		21, 0,		# LD_PARAM 0
+		20, 1,		# LD_CONST 1 (bench.obj)
+		58,			# LD_TYPE
+		61,			# NEWOBJ
+		131,		# SEND
+		21, 0,		# LD_PARAM 0
+		133,		# TRY_RECV
+		1, 2		# POP 2
+	]
+	return counted_loop(iterations, body, [BenchToken, 4096], prologue, params_count=1)
+
+def shared_channel(domain):
+	return [domain.pool.add_block(vm_blocks.Channel(1))]
+
+# Format: { name:String : (make_proc:func(iterations) -> Proc, threads:int, params:list<values> or func(Domain) -> list<values>) }
+Workloads = {
+	'load_store' : (load_store, 1, [11]),
+	'int_arith' : (int_arith, 1, []),
+	'int_compare' : (int_compare, 1, []),
+	'conversions' : (conversions, 1, []),
+	'stack_ops' : (stack_ops, 1, []),
+	'alloc_churn' : (alloc_churn, 1, []),
+	'arrays' : (arrays, 1, []),
+	'channel_send' : (channel_send, 1, shared_channel),
+	'threads' : (int_arith, 8, [])
+}
+
+def token_types():
+	return { BenchToken : vm_blocks.Type(2, 0) }
@@ -1,52 +1,178 @@
 # vm_blocks.py - Virtual Machine Blocks Implementation
 # (c) 2013, Bryan Stockus. All Rights Reserved.
 
+import array
+import collections
+
 import vm_values
+import vm_opcode
 
-class Block:
+class Block(object):
 	# Fields:
-	#	block_kind:enum<int> - the kind of the block {0=Empty, 1=Type, 2=Obj, 3=Array, 4=Proc, 5=Module}
-	def __init__(self, block_type):
-		self.block_type = block_type
+	#	block_type:enum<int> - the kind of the block {0=Empty, 1=Type, 2=Obj, 3=Array, 4=Proc, 5=Module, 6=Channel}, set per class
+	__slots__ = ()
+	block_type = 0
+	def child_values(self):
+		# Returns the values held by this block, which the pool's collector traces through
+		return ()
 
 
 class Type(Block):
 	# Fields:
-	#	type_id:String - the type's id string
+	#	type_id:String - the type's id string, None if the type is not part of a Module
 	#	instc_fields_count:uint
 	#	class_fields_count:uint
-	def __init__(self, instc_fields_count, class_fields_count):
-		Block.__init__(self, 1)
+	__slots__ = ('instc_fields_count', 'class_fields_count', 'type_id')
+	block_type = 1
+	def __init__(self, instc_fields_count, class_fields_count, type_id=None):
 		self.instc_fields_count = instc_fields_count
 		self.class_fields_count = class_fields_count
+		self.type_id = type_id
 	def __repr__(self):
 		return "[Type: instc_fields_count={0} class_fields_count={1}]".format(self.instc_fields_count, self.class_fields_count)
 
 class Obj(Block):
 	# Fields:
 	#	instc_fields:List<Value> - the object's instance fields
+	__slots__ = ('instc_fields',)
+	block_type = 2
 	def __init__(self, instc_fields_count):
-		Block.__init__(self, 2)
-		self.instc_fields = [vm_values.NullValue()] * instc_fields_count
+		self.instc_fields = [vm_values.Null] * instc_fields_count
+	def child_values(self):
+		return self.instc_fields
 	def __repr__(self):
 		return "[Obj: instc_fields={0}]".format(self.instc_fields)
 
+# Array Kinds
+ARRAY_VALUE = 0
+ARRAY_INT = 1
+ARRAY_FLOAT = 2
+ARRAY_BOOL = 3
+
+# Format: { kind:int : (typecode:String, accepts:func(value) -> bool, load:func(item) -> value) }
+# The packed storage of each array kind, ARRAY_VALUE arrays are lists of Values
+ArrayKinds = {
+	ARRAY_VALUE : (None, lambda value : True, lambda item : item),
+	ARRAY_INT : ('l', lambda value : vm_values.isIntValue(value) and not vm_values.isBoolValue(value), lambda item : item),
+	ARRAY_FLOAT : ('d', lambda value : vm_values.isFloatValue(value), lambda item : item),
+	ARRAY_BOOL : ('b', lambda value : vm_values.isBoolValue(value), bool)
+}
+
 class Array(Block):
 	# Fields:
-	#	
-	def __init__(self):
-		Block.__init__(self, 3)
+	#	kind:enum<int> - the ARRAY_* kind of the elements
+	#	items:list<Value>/array - the elements, packed in an array.array unless kind is ARRAY_VALUE
+	__slots__ = ('kind', 'items')
+	block_type = 3
+	def __init__(self, kind, count):
+		self.kind = kind
+		typecode = ArrayKinds[kind][0]
+		if typecode is None:
+			self.items = [vm_values.Null] * count
+		else:
+			self.items = array.array(typecode, [0]) * count
+	def accepts(self, value):
+		# True if value can be stored in this array's elements
+		return ArrayKinds[self.kind][1](value)
+	def get_item(self, index):
+		return ArrayKinds[self.kind][2](self.items[index])
+	def get_items(self):
+		# Returns all the elements as Values
+		if self.kind == ARRAY_BOOL:
+			return [bool(item) for item in self.items]
+		return list(self.items)
+	def set_items(self, values):
+		# Replaces all the elements, values must all be accepted by this array
+		typecode = ArrayKinds[self.kind][0]
+		if typecode is None:
+			self.items = list(values)
+		else:
+			self.items = array.array(typecode, values)
+	def fill(self, value):
+		self.set_items([value] * len(self.items))
+	def child_values(self):
+		if self.kind == ARRAY_VALUE:
+			return self.items
+		return ()
+	def __repr__(self):
+		return "[Array: kind={0} items={1}]".format(self.kind, self.get_items())
+
+class Channel(Block):
+	# A bounded queue of values between threads, see the Channel Opcodes
+	# Fields:
+	#	capacity:uint - the most values items holds, senders block once it is full
+	#	items:deque<Value> - the values sent and not received yet
+	#	senders:deque<(Thread,Value)> - the threads blocked sending to the full channel, with the values they sent
+	#	receivers:deque<Thread> - the threads blocked receiving from the empty channel, each once, they run RECV again once woken
+	#	domain:Domain - the domain whose threads use this channel, None if it is shared between domains.
+	#		The values of a shared channel are held in no pool, see Pool.detach.
+	__slots__ = ('capacity', 'items', 'senders', 'receivers', 'domain')
+	block_type = 6
+	def __init__(self, capacity, domain=None):
+		self.capacity = capacity
+		self.items = collections.deque()
+		self.senders = collections.deque()
+		self.receivers = collections.deque()
+		self.domain = domain
+	def send(self, thread, value):
+		# Queues value, blocking thread while the channel is full, and wakes a blocked receiver
+		if len(self.items) < self.capacity:
+			self.items.append(value)
+		else:
+			self.senders.append((thread, value))
+			thread.wait()
+		# A receiver woken by the host may have left, it is skipped
+		while self.receivers:
+			receiver = self.receivers.popleft()
+			if receiver.is_blocked:
+				receiver.wake()
+				break
+	def park_receiver(self, thread):
+		# Blocks thread until a value is sent
+		if thread not in self.receivers:
+			self.receivers.append(thread)
+		thread.wait()
+	def wake_sender(self, sender):
+		# Wakes a sender once none of its values wait to be queued, a sender woken by the host may have sent more
+		for waiting, value in self.senders:
+			if waiting is sender:
+				return
+		sender.wake()
+	def receive(self):
+		# Returns (True, value) of the oldest value sent, waking a blocked sender, or (False, Null) if there is none
+		if self.items:
+			value = self.items.popleft()
+			if self.senders:
+				sender, sent = self.senders.popleft()
+				self.items.append(sent)
+				self.wake_sender(sender)
+		elif self.senders:
+			sender, value = self.senders.popleft()
+			self.wake_sender(sender)
+		else:
+			return (False, vm_values.Null)
+		return (True, value)
+	def child_values(self):
+		if self.domain is None:
+			return ()
+		return list(self.items) + [value for sender, value in self.senders]
+	def __repr__(self):
+		return "[Channel: capacity={0} items={1}]".format(self.capacity, list(self.items))
 
 class Module(Block):
 	# Fields:
 	#	module_id:String - the module's id string
 	#	types:List<Type> - the module's types
 	#	procs:List<Proc> - the module's procs
+	__slots__ = ('module_id', 'types', 'procs')
+	block_type = 5
 	def __init__(self, module_id, types, procs):
-		Block.__init__(self, 5)
 		self.module_id = module_id
 		self.types = types
 		self.procs = procs
+	def token_types(self):
+		# Returns the dict<TokenValue,Type> of this module's types, as taken by Domain
+		return dict((vm_values.TokenValue(self.module_id, type_block.type_id), type_block) for type_block in self.types)
 
 class Proc(Block):
 	# A procedure object
@@ -55,9 +181,52 @@ class Proc(Block):
 	#	locals_count: int - the number of Locals needed by this Proc
 	#	consts: list<values> - the constants needed by this Proc
 	#	opcodes: list<int> - the opcodes for this Proc
-	def __init__(self, params_count, locals_count, consts, opcodes):
-		Block.__init__(self, 4)
+	#	code: list<tuple> - the decoded opcodes, built on first use (see vm_opcode.decode_opcodes)
+	#	verified: bool - True if code was built by vm_verify.verify_proc and skips the proven checks
+	#	compiled: CompiledProc - the code built by vm_jit once the proc got hot, None until then
+	#	exception_table: list<(uint,uint,uint,String)> - the (start, end, handler, error_type) try regions, see find_handler
+	__slots__ = ('params_count', 'locals_count', 'consts', 'opcodes', 'code', 'verified', 'compiled', 'exception_table')
+	block_type = 4
+	def __init__(self, params_count, locals_count, consts, opcodes, exception_table=None):
 		self.params_count = params_count
 		self.locals_count = locals_count
 		self.consts = consts
-		self.opcodes = opcodes
\ No newline at end of file
+		self.opcodes = opcodes
+		if exception_table is None:
+			exception_table = []
+		self.exception_table = exception_table
+		self.code = None
+		self.verified = False
+		self.compiled = None
+	
+	def get_code(self):
+		# Returns the decoded opcodes, decoding them once per Proc
+		if self.code is None:
+			self.code = vm_opcode.decode_opcodes(self.opcodes)
+		return self.code
+	
+	def find_handler(self, inst_ptr, error_type):
+		# Returns the handler of the first try region covering the instruction at inst_ptr that catches error_type,
+		# None if there is none. A region covers the instructions from start up to end, and catches every
+		# error_type if its error_type is None. Inner regions must come before the regions around them. A region
+		# whose handler is inside it catches nothing, as its handler's errors would run it again (vm_verify rejects it).
+		for start, end, handler, region_error_type in self.exception_table:
+			if start <= inst_ptr < end and (region_error_type is None or region_error_type == error_type) and not (start <= handler < end):
+				return handler
+		return None
+	
+	def __getstate__(self):
+		# The decoded code holds handler closures, which cannot be pickled
+		return (self.params_count, self.locals_count, self.consts, self.opcodes, self.exception_table)
+	
+	def __setstate__(self, state):
+		self.params_count, self.locals_count, self.consts, self.opcodes, self.exception_table = state
+		self.code = None
+		self.verified = False
+		self.compiled = None
+	
+	def invalidate_code(self):
+		# Must be called after opcodes is modified so the next frame decodes it again
+		self.code = None
+		self.verified = False
+		self.compiled = None
@@ -4,39 +4,297 @@
 import vm_values
 import vm_trace
 import vm_thread
+import vm_frame
 import vm_exception
 import vm_pool
+import vm_async
+import collections
+import heapq
+import time
+
+DEFAULT_QUANTUM = 1000	# instructions a thread runs before the next thread gets a turn
+
+class Quotas(object):
+	# The limits of a Domain, each None for no limit. Exceeding one raises vm_exception.QuotaExceeded.
+	# The instruction limits are checked between quanta, the thread's quantum being shortened to end at them;
+	# compiled code may run to its next loop header past them. The eval stack depth is checked between quanta
+	# and at calls, so it may be passed by up to a quantum's pushes. The others are checked when they grow.
+	# Fields:
+	#	thread_instructions: uint - the most instructions each thread may run, the thread halts past it
+	#	domain_instructions: uint - the most instructions the domain may run, the run stops past it
+	#	pool_blocks: uint - the most blocks the pool may hold
+	#	pool_bytes: uint - the most bytes the pool's blocks may hold, see vm_pool.block_bytes
+	#	frame_depth: uint - the most frames each thread may have
+	#	stack_depth: uint - the most values a frame's eval stack may hold
+	def __init__(self, thread_instructions=None, domain_instructions=None, pool_blocks=None, pool_bytes=None, frame_depth=None, stack_depth=None):
+		self.thread_instructions = thread_instructions
+		self.domain_instructions = domain_instructions
+		self.pool_blocks = pool_blocks
+		self.pool_bytes = pool_bytes
+		self.frame_depth = frame_depth
+		self.stack_depth = stack_depth
+	
+	def checked_between_quanta(self):
+		return self.thread_instructions is not None or self.domain_instructions is not None or self.stack_depth is not None
 
 class Domain(object):
 	# A Domain object
 	# Fields:
 	#	threads: list<Thread> - the threads running in this domain
+	#	run_queue: deque<Thread> - the THREAD_RUNNING threads, in the order they get their next quantum
+	#	sleepers: heap<(float,int,Thread)> - (wake_time, sequence, thread) of the paused threads
+	#	quantum: int - the number of instructions a thread runs before it is preempted
+	#	cycle_count: int - the number of instructions run by this domain
+	#	error: VMException - the last error that halted a thread during the last run (see Thread.fail), or that stopped the run, None if there was none
 	#	pool: list<Blocks> - the block pool for this domain
 	#	modules: list<Module> - the modules loaded into this domain
-	#	tokens_map:dict<TokenValue,TypeRefValue> - the token to type map
-	def __init__(self, token_types):
-		# token_types:dict<TokenValue,TypeBlock>
+	#	tokens:dict<TokenValue,TokenValue> - the interned instance of each token
+	#	tokens_map:dict<TokenValue,TypeRefValue> - the token to type map, keyed by interned tokens
+	#	trace_level:int - the vm_trace.TRACE_* level of this domain
+	#	trace_sink:Sink - where trace output is written (see vm_trace)
+	#	observers:list<Observer> - objects whose observe_instruction(frame, inst_ptr, opcode, operand) is called before each instruction
+	#	profiler:Profiler - the vm_profile.Profiler timing each instruction, None if not profiling
+	#	compiler:Compiler - the vm_jit.Compiler compiling hot procs, None if every proc is interpreted
+	#	wake_event:Event - set when a thread is put back on the run queue while run_async waits, None if it is not waiting
+	#	quotas:Quotas - the limits of this domain
+	#	image:Image - the vm_image.Image whose modules and types this domain shares, None if it has none
+	def __init__(self, token_types, trace_level=vm_trace.TRACE_OFF, trace_sink=None, quantum=DEFAULT_QUANTUM, gc_threshold=None, quotas=None, image=None):
+		# token_types:dict<TokenValue,TypeBlock> - types added to those of the image
+		self.trace_level = trace_level
+		if trace_sink is None:
+			trace_sink = vm_trace.TerminalSink()
+		self.trace_sink = trace_sink
+		self.observers = []
+		self.profiler = None
+		self.compiler = None
+		self.wake_event = None
 		self.threads = []
-		self.pool = vm_pool.Pool()
-		self.module = []
-		self.tokens_map = {}
+		self.run_queue = collections.deque()
+		self.sleepers = []
+		self.sleepers_count = 0
+		self.quantum = quantum
+		self.cycle_count = 0
+		self.error = None
+		if gc_threshold is None:
+			gc_threshold = vm_pool.DEFAULT_GC_THRESHOLD
+		self.image = image
+		if image is None:
+			self.pool = vm_pool.Pool(gc_threshold)
+			self.modules = []
+			self.tokens = {}
+			self.tokens_map = {}
+		else:
+			# The image's tables are used until this domain adds to them, see own_tables
+			self.pool = vm_pool.Pool(gc_threshold, image.pool)
+			self.modules = image.modules
+			self.tokens = image.tokens
+			self.tokens_map = image.tokens_map
+		self.add_types(token_types)
+		if quotas is None:
+			quotas = Quotas()
+		self.set_quotas(quotas)
+	
+	def set_quotas(self, quotas):
+		# Limits the domain from now on, what it has used so far counting against quotas
+		self.quotas = quotas
+		self.pool.set_quotas(quotas.pool_blocks, quotas.pool_bytes)
+	
+	def own_tables(self):
+		# Copies the image's token tables and module list before this domain first adds to them
+		image = self.image
+		if image is not None and self.tokens_map is image.tokens_map:
+			self.modules = list(image.modules)
+			self.tokens = dict(image.tokens)
+			self.tokens_map = dict(image.tokens_map)
+	
+	def add_types(self, token_types):
+		# token_types:dict<TokenValue,TypeBlock>
+		if token_types:
+			self.own_tables()
 		for token_value,type_block in token_types.items():
 			type_ref_value = self.pool.add_block(type_block)
-			self.tokens_map[token_value.__repr__()] = type_ref_value
+			self.tokens_map[self.intern_token(token_value)] = type_ref_value
+	
+	def load_module(self, module):
+		# Adds the module's types to this domain, its procs can then be run with spawn_thread
+		self.own_tables()
+		self.add_types(module.token_types())
+		self.modules.append(module)
+	
+	def intern_token(self, token_value):
+		# Returns this domain's instance of token_value, so equal tokens can be compared by identity
+		token = self.tokens.get(token_value)
+		if token is None:
+			self.own_tables()
+			token = self.tokens.setdefault(token_value, token_value)
+		return token
+	
+	def spawn_thread(self, proc, params=None):
+		# Spawns a new thread in the domain running proc with the list of params
+		thread = vm_thread.Thread(self, proc, len(self.threads), params)
+		self.threads.append(thread)
+		self.run_queue.append(thread)
+		return thread
+	
+	def schedule_thread(self, thread):
+		# Puts a woken thread on the run queue, waking run_async if it is waiting for one
+		self.run_queue.append(thread)
+		if self.wake_event is not None:
+			self.wake_event.set()
+	
+	def schedule_wake(self, thread, wake_time):
+		# Wakes thread at wake_time unless it has been woken (or paused again) by then
+		self.sleepers_count += 1
+		heapq.heappush(self.sleepers, (wake_time, self.sleepers_count, thread))
+	
+	def wake_sleepers(self, now):
+		sleepers = self.sleepers
+		while sleepers and sleepers[0][0] <= now:
+			wake_time, sequence, thread = heapq.heappop(sleepers)
+			if thread.wake_time == wake_time:
+				thread.wake()
 	
-	def spawn_thread(self, proc):
-		# Spawns a new thread in the domain running proc
-		self.threads.append(vm_thread.Thread(self, proc))
+	def gc_roots(self):
+		# Returns the values the collector starts from: every frame's eval stack, locals and params, and the types
+		roots = list(self.tokens_map.values())
+		for thread in self.threads:
+			for frame in thread.frame_stack:
+				roots.extend(frame.eval_stack)
+				roots.extend(frame.locals)
+				roots.extend(frame.params)
+		return roots
+	
+	def collect_garbage(self):
+		# Collects the pool. Blocks only referenced from host code are freed too.
+		freed = self.pool.collect(self.gc_roots())
+		if self.trace_level >= vm_trace.TRACE_INFO:
+			self.trace_sink.write_info("Domain", "Collected Pool (freed = {0}, stats = {1})".format(freed, self.pool.gc_stats()))
+		return freed
+	
+	def attach_observer(self, observer):
+		self.observers.append(observer)
+	
+	def detach_observer(self, observer):
+		self.observers.remove(observer)
+	
+	def attach_profiler(self, profiler):
+		# Profiles the following quanta with profiler, which is also attached as an observer
+		if self.profiler is not None:
+			self.detach_profiler()
+		profiler.domain = self
+		self.profiler = profiler
+		self.attach_observer(profiler)
+	
+	def detach_profiler(self):
+		# Stops profiling, returning the profiler so its results can be read
+		profiler = self.profiler
+		if profiler is not None:
+			self.detach_observer(profiler)
+			self.profiler = None
+		return profiler
+	
+	def attach_compiler(self, compiler):
+		# Compiles procs once they get hot while the domain is neither tracing, observing nor profiling
+		self.compiler = compiler
+	
+	def detach_compiler(self):
+		# Interprets every proc again, returning the compiler. Compiled code stays with its procs for the next attach.
+		compiler = self.compiler
+		self.compiler = None
+		return compiler
+	
+	def trace_info(self, trace_class, trace_message):
+		if self.trace_level >= vm_trace.TRACE_INFO:
+			self.trace_sink.write_info(trace_class, trace_message)
+	
+	def frame_step(self):
+		# Returns the Frame.step method matching the domain's tracing and observers
+		if self.trace_level >= vm_trace.TRACE_INSTRUCTION:
+			return vm_frame.Frame.step_traced
+		elif self.profiler is not None:
+			return vm_frame.Frame.step_profiled
+		elif self.observers:
+			return vm_frame.Frame.step_observed
+		else:
+			return vm_frame.Frame.step
+	
+	def run_thread(self, thread, quantum):
+		# Runs up to quantum instructions of thread, with the step matching the domain's tracing and observers
+		quotas = self.quotas
+		if quotas.thread_instructions is not None:
+			quantum = min(quantum, quotas.thread_instructions - thread.cycle_count)
+		if quotas.domain_instructions is not None:
+			quantum = min(quantum, quotas.domain_instructions - self.cycle_count)
+		frame_step = self.frame_step()
+		if self.compiler is not None and frame_step == vm_frame.Frame.step:
+			executed = thread.run_quantum_tiered(quantum, self.compiler)
+		else:
+			executed = thread.run_quantum(quantum, frame_step)
+		if thread.state == vm_thread.THREAD_YIELDED:
+			thread.state = vm_thread.THREAD_RUNNING
+		if self.pool.over_quota:
+			self.check_pool_quotas(thread)
+		if quotas.checked_between_quanta():
+			self.check_quotas(thread)
+		return executed
+	
+	def check_pool_quotas(self, thread):
+		# Collects a pool that went past a quota during thread's quantum, which ended there (see Frame.add_block),
+		# failing thread if the blocks still alive are past it
+		self.collect_garbage()
+		try:
+			self.pool.check_over_quota()
+		except vm_exception.QuotaExceeded as e:
+			thread.fail(e)
+	
+	def check_quotas(self, thread):
+		# Checks the quotas counted between quanta once thread's quantum has run, if thread could run on.
+		# thread is queued again before DomainInstructions ends the run, so a later run resumes it.
+		quotas = self.quotas
+		if thread.state != vm_thread.THREAD_RUNNING:
+			return
+		if quotas.domain_instructions is not None and self.cycle_count >= quotas.domain_instructions:
+			self.run_queue.append(thread)
+			raise vm_exception.QuotaExceeded("DomainInstructions", self.cycle_count, "Domain")
+		if quotas.thread_instructions is not None and thread.cycle_count >= quotas.thread_instructions:
+			thread.fail(vm_exception.QuotaExceeded("ThreadInstructions", thread.cycle_count, "Thread"))
+		elif quotas.stack_depth is not None and len(thread.frame_stack[-1].eval_stack) > quotas.stack_depth:
+			thread.fail(vm_exception.QuotaExceeded("StackDepth", len(thread.frame_stack[-1].eval_stack), "Thread"))
 	
 	def run(self):
-		# Only supports single-threading at this time
-		vm_trace.print_info("Domain", "Running Domain...")
+		# Runs the threads round robin, a quantum at a time, until every thread has halted or is
+		# waiting to be woken by the host. Paused threads are slept on rather than polled. An error
+		# no frame handles halts its thread, the other threads keep running.
+		self.trace_info("Domain", "Running Domain...")
+		run_queue = self.run_queue
+		pool = self.pool
+		self.error = None
 		try:
-			while self.threads[0].is_running:
-				self.threads[0].step()
+			while True:
+				if self.sleepers:
+					self.wake_sleepers(time.time())
+				if not run_queue:
+					if not self.sleepers:
+						break
+					time.sleep(max(0.0, self.sleepers[0][0] - time.time()))
+					continue
+				if pool.collect_pending:
+					self.collect_garbage()
+				thread = run_queue.popleft()
+				self.run_thread(thread, self.quantum)
+				if thread.state == vm_thread.THREAD_RUNNING:
+					run_queue.append(thread)
 		except vm_exception.VMException as e:
 			#Handle VM Exception
-			vm_trace.print_error(e.error_class, e.error_type, e.error_subtype, e.error_info)
+			self.error = e
+			self.trace_sink.write_error(e.error_class, e.error_type, e.error_subtype, e.error_info)
 		finally:
-			vm_trace.print_info("Domain", "Finished Running Domain...")
-			
\ No newline at end of file
+			self.trace_info("Domain", "Finished Running Domain...")
+	
+	def run_async(self, yield_instructions=None, loop=None):
+		# Returns a coroutine running the threads like run, for a trollius (asyncio) event loop. It yields to the
+		# loop after yield_instructions instructions (the quantum by default) and waits on the loop while no
+		# thread can run, so many domains can share one loop. It finishes once every thread has halted.
+		if yield_instructions is None:
+			yield_instructions = self.quantum
+		return vm_async.run_domain(self, yield_instructions, loop)
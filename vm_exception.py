@@ -6,4 +6,9 @@ class VMException(Exception):
 		self.error_type = error_type
 		self.error_subtype = error_subtype
 		self.error_info = error_info
-		self.error_class = error_class
\ No newline at end of file
+		self.error_class = error_class
+
+class QuotaExceeded(VMException):
+	# Raised when a domain runs past one of its vm_domain.Quotas. Try regions never catch it.
+	def __init__(self, error_subtype, error_info, error_class):
+		VMException.__init__(self, "QuotaExceededError", error_subtype, error_info, error_class)
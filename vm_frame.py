@@ -1,6 +1,8 @@
 # vm_frame.py - Virtual Machine Frame Type Definitions
 # (c) 2013, Bryan Stockus. All Rights Reserved.
 
+import itertools
+
 import vm_values
 import vm_trace	
 import vm_blocks
@@ -13,24 +15,52 @@ class Frame(object):
 	# Fields:
 	#	thread: Thread - the Thread this frame is running on
 	#	frame_proc: Proc - the Proc object this frame is running
-	#	params: list<values> - the params passed to this frame
+	#	params: list<values> - the list holding the params passed to this frame, the caller's eval_stack for a called proc
+	#	params_base: int - the index of the first param in params
 	#	locals: list<values> - the locals used by this frame
-	#	inst_ptr: int - the current instruction pointer
+	#	code: list<tuple> - the decoded instruction stream of frame_proc
+	#	inst_ptr: int - the instruction pointer of the next instruction
 	#	eval_stack: list<values> - the evaluation stack
-	def __init__(self, thread, frame_proc, params):
+	__slots__ = ('thread', 'frame_proc', 'code', 'params', 'params_base', 'locals', 'inst_ptr', 'cycle_count', 'eval_stack')
+	def __init__(self, thread, frame_proc, params, params_base=0):
 		self.thread = thread
 		self.frame_proc = frame_proc
+		self.code = frame_proc.get_code()
 		self.params = params
-		self.locals = [vm_values.NullValue()] * frame_proc.locals_count
-		self.inst_ptr = -1
+		self.params_base = params_base
+		self.locals = [vm_values.Null] * frame_proc.locals_count
+		self.inst_ptr = 0
 		self.cycle_count = 0
 		self.eval_stack = []
 	
+	def reset(self, frame_proc, params, params_base):
+		# Readies a released frame to run frame_proc, reusing its lists
+		self.frame_proc = frame_proc
+		self.code = frame_proc.get_code()
+		self.params = params
+		self.params_base = params_base
+		self.locals.extend(itertools.repeat(vm_values.Null, frame_proc.locals_count))
+		self.inst_ptr = 0
+		self.cycle_count = 0
+	
+	def release(self):
+		# Drops the values held by a frame that has returned, so a free frame keeps no blocks alive
+		self.params = None
+		del self.locals[:]
+		del self.eval_stack[:]
+	
+	def replace_proc(self, frame_proc, params_count):
+		# Runs frame_proc in this frame in place of the current proc, its params being the top
+		# params_count values of the eval stack (see TAILCALL)
+		eval_stack = self.eval_stack
+		self.params[self.params_base:] = eval_stack[len(eval_stack) - params_count:]
+		del eval_stack[:]
+		del self.locals[:]
+		self.reset(frame_proc, self.params, self.params_base)
+	
 	def pop_eval_stack_value(self):
 		if len(self.eval_stack) <= 0:
 			raise vm_exception.VMException("InvalidOperationError","EvalStackIsEmpty", "", "Frame")
-			self.thread.halt()
-			return
 		else:
 			return self.eval_stack.pop()
 	
@@ -40,50 +70,95 @@ class Frame(object):
 	def get_const(self, index):
 		if index >= len(self.frame_proc.consts):
 			raise vm_exception.VMException("InvalidOperationError","ConstIndexOutOfBounds", index, "Frame")
-			self.thread.halt()
-			return
 		else:
 			return self.frame_proc.consts[index]
 	
 	def get_param(self, index):
-		if index >= len(self.params):
+		if index >= len(self.params) - self.params_base:
 			raise vm_exception.VMException("InvalidOperationError","ParamIndexOutOfBounds", index, "Frame")
-			self.thread.halt()
-			return
 		else:
-			return self.params[index]
+			return self.params[self.params_base + index]
 	
 	def get_local(self, index):
 		if index >= len(self.locals):
 			raise vm_exception.VMException("InvalidOperationError","LocalIndexOutOfBounds", index, "Frame")
-			self.thread.halt()
-			return
 		else:
 			return self.locals[index]
 	
 	def set_local(self, index, value):
 		if index >= len(self.locals):
 			raise vm_exception.VMException("InvalidOperationError","LocalIndexOutOfBounds", index, "Frame")
-			self.thread.halt()
 		else:
 			self.locals[index] = value
 	
-	def get_opcode(self):
-		self.inst_ptr += 1
-		if self.inst_ptr >= len(self.frame_proc.opcodes):
-			raise vm_exception.VMException("InvalidOperationError","InstructionPointerOutOfBounds", self.inst_ptr, "Frame")
-			self.thread.halt()
-			return
-		return self.frame_proc.opcodes[self.inst_ptr]
+	def branch(self, target):
+		# Continues at the instruction at target, the step loop catches targets inside or just past the opcodes
+		if target >= len(self.code):
+			raise vm_exception.VMException("InvalidOperationError","InstructionPointerOutOfBounds", target, "Frame")
+		self.inst_ptr = target
 	
 	def get_pool(self):
 		return self.thread.domain.pool
 	
+	def add_block(self, block):
+		# Adds block to the domain's pool, ending the thread's quantum if that takes the pool past a quota
+		pool = self.thread.domain.pool
+		ref_value = pool.add_block(block)
+		if pool.over_quota:
+			self.thread.end_quantum()
+		return ref_value
+	
 	def get_tokens_map(self):
 		return self.thread.domain.tokens_map
 	
 	def step(self):
-		opcode = self.get_opcode()
+		handler, opcode, operand, next_ptr = self.code[self.inst_ptr]
+		self.inst_ptr = next_ptr
 		self.cycle_count += 1
-		vm_opcode.run_opcode(self, opcode)
-
+		handler(self, opcode, operand)
+	
+	def opcode_operand(self, inst_ptr, next_ptr):
+		# Returns the operand as written in opcodes, the decoded entry may hold a specialized one
+		return vm_opcode.instruction_operand(self.frame_proc.opcodes, inst_ptr, next_ptr)
+	
+	def step_observed(self):
+		# step, showing the instruction to the domain's observers before it runs
+		inst_ptr = self.inst_ptr
+		handler, opcode, operand, next_ptr = self.code[inst_ptr]
+		for observer in self.thread.domain.observers:
+			observer.observe_instruction(self, inst_ptr, opcode, self.opcode_operand(inst_ptr, next_ptr))
+		self.inst_ptr = next_ptr
+		self.cycle_count += 1
+		handler(self, opcode, operand)
+	
+	def step_profiled(self):
+		# step_observed, also timing the handler for the domain's profiler
+		inst_ptr = self.inst_ptr
+		handler, opcode, operand, next_ptr = self.code[inst_ptr]
+		domain = self.thread.domain
+		for observer in domain.observers:
+			observer.observe_instruction(self, inst_ptr, opcode, self.opcode_operand(inst_ptr, next_ptr))
+		self.inst_ptr = next_ptr
+		self.cycle_count += 1
+		profiler = domain.profiler
+		start = profiler.timer()
+		try:
+			handler(self, opcode, operand)
+		finally:
+			profiler.add_time(opcode, profiler.timer() - start)
+	
+	def step_traced(self):
+		# step_observed, also writing the instruction to the domain's trace sink
+		inst_ptr = self.inst_ptr
+		handler, opcode, operand, next_ptr = self.code[inst_ptr]
+		for observer in self.thread.domain.observers:
+			observer.observe_instruction(self, inst_ptr, opcode, self.opcode_operand(inst_ptr, next_ptr))
+		self.inst_ptr = next_ptr
+		self.cycle_count += 1
+		old_eval_stack = list(self.eval_stack)
+		handler(self, opcode, operand)
+		opspec = vm_opcode.Opcodes[opcode]
+		operand = self.opcode_operand(inst_ptr, next_ptr)
+		if operand is None:
+			operand = ""
+		self.thread.domain.trace_sink.write_frame_trace(inst_ptr, opspec[2], operand, old_eval_stack, self.eval_stack, self.locals, opspec[3], opspec[4], self.cycle_count)
@@ -0,0 +1,30 @@
+# vm_image.py - Virtual Machine Shared Image
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import vm_pool
+
+class Image(object):
+	# Modules and types loaded once and shared read-only by many Domains, see Domain(image=...).
+	# A domain's pool then holds only its own allocations, and its token tables and module list are the
+	# image's until the domain adds types or modules of its own. Nothing in an image may be modified once
+	# a domain uses it.
+	# Fields:
+	#	modules: list<Module> - the image's modules
+	#	pool: Pool - holds the image's Type blocks, never collected
+	#	tokens: dict<TokenValue,TokenValue> - the interned tokens, see Domain.intern_token
+	#	tokens_map: dict<TokenValue,RefValue> - the Type of each token, as Domain.tokens_map
+	def __init__(self, modules, token_types=None):
+		# token_types:dict<TokenValue,TypeBlock> - types not part of any module
+		self.modules = list(modules)
+		self.pool = vm_pool.Pool()
+		self.tokens = {}
+		self.tokens_map = {}
+		for module in self.modules:
+			self.add_types(module.token_types())
+		if token_types is not None:
+			self.add_types(token_types)
+	
+	def add_types(self, token_types):
+		for token_value,type_block in token_types.items():
+			type_ref_value = self.pool.add_block(type_block)
+			self.tokens_map[self.tokens.setdefault(token_value, token_value)] = type_ref_value
@@ -0,0 +1,301 @@
+# vm_jit.py - Virtual Machine Tiered Compiler
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Procs start out interpreted. Once a proc has been called, or has branched backwards, threshold times
+# it is translated into a Python function that keeps the eval stack and locals in Python variables.
+# Only the instructions vm_verify proves are translated; the function returns to the interpreter
+# at every other instruction, and at an instruction whose operation raises, so errors are raised
+# by the interpreter exactly as if the proc had never been compiled.
+
+import vm_opcode
+import vm_verify
+import vm_exception
+
+DEFAULT_THRESHOLD = 1000	# calls plus back-edges of a proc before it is compiled
+
+# Format: { opcode:int : expression:String } ({0} is the value on top of the stack, {1} the value below it)
+# The operations inlined by the compiler, none of which can raise on the values the verifier proves.
+# Other operations are called, and return to the interpreter if they raise.
+Expressions = {
+	30 : "int({0} + {1})",		# IADD
+	31 : "int({0} - {1})",		# ISUB
+	32 : "int({0} * {1})",		# IMUL
+	34 : "int({0} * -1)",		# INEG
+	35 : "int({0} + 1)",		# IING
+	36 : "int({0} - 1)",		# IDEC
+	44 : "bool({0} == {1})",	# ICMP_EQ
+	45 : "bool({0} != {1})",	# ICMP_NE
+	46 : "bool({0} < {1})",		# ICMP_LT
+	47 : "bool({0} <= {1})",	# ICMP_LE
+	48 : "bool({0} > {1})",		# ICMP_GT
+	49 : "bool({0} >= {1})",	# ICMP_GE
+	83 : "bool({0})",			# I2B
+	84 : "int({0})",			# B2I
+	85 : "ord({0})",			# C2I
+	100 : "float({0} + {1})",	# FADD
+	101 : "float({0} - {1})",	# FSUB
+	102 : "float({0} * {1})",	# FMUL
+	104 : "float(-{0})",		# FNEG
+	105 : "bool({0} == {1})",	# FCMP_EQ
+	106 : "bool({0} != {1})",	# FCMP_NE
+	107 : "bool({0} < {1})",	# FCMP_LT
+	108 : "bool({0} <= {1})",	# FCMP_LE
+	109 : "bool({0} > {1})",	# FCMP_GT
+	110 : "bool({0} >= {1})",	# FCMP_GE
+	120 : "bool({0} == {1})",	# CCMP_EQ
+	121 : "bool({0} != {1})",	# CCMP_NE
+	122 : "bool({0} < {1})",	# CCMP_LT
+	123 : "bool({0} <= {1})",	# CCMP_LE
+	124 : "bool({0} > {1})",	# CCMP_GT
+	125 : "bool({0} >= {1})",	# CCMP_GE
+	202 : "{0} == {1}",			# IBR_EQ
+	203 : "{0} != {1}",			# IBR_NE
+	204 : "{0} < {1}",			# IBR_LT
+	205 : "{0} <= {1}",			# IBR_LE
+	206 : "{0} > {1}",			# IBR_GT
+	207 : "{0} >= {1}"			# IBR_GE
+}
+
+# Opcodes translated when the verifier proves them, besides the def_op_unary/def_op_binary families
+TranslatedOpcodes = set([1, 2, 13, 14, 15, 20, 21, 22, 23, 201])
+
+class CompiledProc(object):
+	# The compiled code of a Proc, kept in Proc.compiled
+	# Fields:
+	#	function: func(frame, budget) -> int - runs frame from one of the entries until it reaches an instruction
+	#		that was not compiled, or has run at least budget instructions at a loop header. Returns the number run.
+	#	entries: dict<int,int> - the eval stack depth at each instruction pointer function can start at
+	#	source: String - the Python source of function
+	__slots__ = ('function', 'entries', 'source')
+	def __init__(self, function, entries, source):
+		self.function = function
+		self.entries = entries
+		self.source = source
+
+# The compiled code of a proc that cannot be compiled, so it stays interpreted
+NotCompiled = CompiledProc(None, {}, None)
+
+def literal(value):
+	# Returns the source of an IntValue or BoolValue, None for other values
+	if value.__class__ in (int, long, bool):
+		return repr(value)
+	return None
+
+class Translator(object):
+	# Translates a verified Proc into the source of a Python function
+	# Fields:
+	#	proc: Proc - the proc being translated
+	#	states: dict<int,(letters,letters)> - the vm_verify.analyze_proc states of proc
+	#	code: list<tuple> - the checked decoded opcodes of proc
+	#	translated: set<int> - the instruction pointers of the instructions being translated
+	#	leaders: list<int> - the instruction pointers starting a block, in order
+	#	loop_headers: set<int> - the leaders branched to from later instructions, where the budget is checked
+	#	names: dict<String,values> - the globals of the function
+	#	lines: list<String> - the source being written
+	def __init__(self, proc, states):
+		self.proc = proc
+		self.states = states
+		self.code = vm_opcode.decode_opcodes(proc.opcodes)
+		self.translated = set([inst_ptr for inst_ptr in states if self.can_translate(inst_ptr)])
+		self.loop_headers = set()
+		leaders = set([0] + [handler for start, end, handler, error_type in proc.exception_table])
+		for inst_ptr in states:
+			handler, opcode, operand, next_ptr = self.code[inst_ptr]
+			if opcode in vm_opcode.BranchOpcodes:
+				leaders.add(operand)
+				leaders.add(next_ptr)
+				if operand <= inst_ptr:
+					self.loop_headers.add(operand)
+			if inst_ptr not in self.translated:
+				leaders.add(inst_ptr)
+				leaders.add(next_ptr)
+		self.leaders = sorted([inst_ptr for inst_ptr in leaders if inst_ptr in states])
+		self.names = {}
+		self.lines = []
+	
+	def can_translate(self, inst_ptr):
+		stack, locals = self.states[inst_ptr]
+		entry = self.code[inst_ptr]
+		handler, opcode = entry[0], entry[1]
+		if opcode == 0:
+			return True
+		if hasattr(handler, 'operation') and not hasattr(handler, 'in_types'):
+			# def_op_nulary
+			return True
+		if opcode not in TranslatedOpcodes and not hasattr(handler, 'make_unchecked'):
+			return False
+		return vm_verify.unchecked_entry(self.proc, entry, stack, locals) is not entry
+	
+	def depth(self, inst_ptr):
+		return len(self.states[inst_ptr][0])
+	
+	def bind(self, value):
+		# Returns the source of value, adding it to the globals unless it is a literal
+		source = literal(value)
+		if source is None:
+			source = "k{0}".format(len(self.names))
+			self.names[source] = value
+		return source
+	
+	def write(self, indent, line):
+		self.lines.append("\t" * indent + line)
+	
+	def stack_names(self, depth):
+		return ", ".join(["s{0}".format(index) for index in range(depth)]) + ","
+	
+	def write_exit(self, indent, inst_ptr, executed):
+		# Returns to the interpreter at inst_ptr, having run executed instructions
+		depth = self.depth(inst_ptr)
+		if depth == 1:
+			self.write(indent, "eval_stack.append(s0)")
+		elif depth > 1:
+			self.write(indent, "eval_stack.extend(({0}))".format(self.stack_names(depth)))
+		if self.proc.locals_count:
+			self.write(indent, "locals[:] = ({0})".format(", ".join(["l{0}".format(index) for index in range(self.proc.locals_count)]) + ","))
+		self.write(indent, "frame.inst_ptr = {0}".format(inst_ptr))
+		self.write(indent, "frame.cycle_count += {0}".format(executed))
+		self.write(indent, "return {0}".format(executed))
+	
+	def write_jump(self, indent, target, count):
+		# Continues at the block starting at target, count instructions after the start of the current block
+		executed = "n + {0}".format(count)
+		if target in self.translated:
+			self.write(indent, "n = {0}".format(executed))
+			self.write(indent, "pc = {0}".format(target))
+			self.write(indent, "continue")
+		else:
+			self.write_exit(indent, target, executed)
+	
+	def write_operation(self, indent, inst_ptr, count, opcode, target, inputs):
+		# Writes target = the operation of opcode applied to the input names, top of the stack first
+		if opcode in Expressions:
+			self.write(indent, "{0} = {1}".format(target, Expressions[opcode].format(*inputs)))
+		else:
+			self.write(indent, "try:")
+			self.write(indent + 1, "{0} = {1}({2})".format(target, self.bind(vm_opcode.Opcodes[opcode][1].operation), ", ".join(inputs)))
+			self.write(indent, "except Exception:")
+			self.write_exit(indent + 1, inst_ptr, "n + {0}".format(count - 1))
+	
+	def write_block(self, leader):
+		indent = 3
+		if leader in self.loop_headers:
+			self.write(indent, "if n >= budget:")
+			self.write_exit(indent + 1, leader, "n")
+		inst_ptr = leader
+		count = 0
+		while True:
+			handler, opcode, operand, next_ptr = self.code[inst_ptr]
+			depth = self.depth(inst_ptr)
+			top = "s{0}".format(depth - 1)
+			below = "s{0}".format(depth - 2)
+			count += 1
+			if opcode == 2:
+				self.write(indent, "s{0} = {1}".format(depth, top))
+			elif opcode == 20:
+				self.write(indent, "s{0} = {1}".format(depth, self.bind(self.proc.consts[operand])))
+			elif opcode == 21:
+				self.write(indent, "s{0} = p{1}".format(depth, operand))
+			elif opcode == 22:
+				self.write(indent, "s{0} = l{1}".format(depth, operand))
+			elif opcode == 23:
+				self.write(indent, "l{0} = {1}".format(operand, top))
+			elif opcode == 201:
+				self.write(indent, "s{0} = int(l{1} + l{2})".format(depth, operand[1], operand[0]))
+			elif opcode == 13:
+				self.write_jump(indent, operand, count)
+				return
+			elif opcode in (14, 15):
+				if opcode == 14:
+					self.write(indent, "if {0}:".format(top))
+				else:
+					self.write(indent, "if not {0}:".format(top))
+				self.write_jump(indent + 1, operand, count)
+				self.write_jump(indent, next_ptr, count)
+				return
+			elif opcode in vm_opcode.BranchOpcodes:
+				self.write_operation(indent, inst_ptr, count, opcode, "taken", [top, below])
+				self.write(indent, "if taken:")
+				self.write_jump(indent + 1, operand, count)
+				self.write_jump(indent, next_ptr, count)
+				return
+			elif getattr(handler, 'make_unchecked', None) is vm_opcode.def_op_unary_unchecked:
+				self.write_operation(indent, inst_ptr, count, opcode, top, [top])
+			elif getattr(handler, 'make_unchecked', None) is vm_opcode.def_op_binary_unchecked:
+				self.write_operation(indent, inst_ptr, count, opcode, below, [top, below])
+			elif hasattr(handler, 'operation'):
+				# def_op_nulary
+				self.write(indent, "s{0} = {1}".format(depth, self.bind(handler.operation())))
+			# NOP and POP only move the depth
+			if next_ptr in self.leaders:
+				self.write_jump(indent, next_ptr, count)
+				return
+			inst_ptr = next_ptr
+	
+	def translate(self):
+		# Returns the source of the function, and its entries
+		entries = dict([(leader, self.depth(leader)) for leader in self.leaders if leader in self.translated])
+		params = set([self.code[inst_ptr][2] for inst_ptr in self.translated if self.code[inst_ptr][1] == 21])
+		self.write(0, "def compiled(frame, budget):")
+		self.write(1, "eval_stack = frame.eval_stack")
+		if self.proc.locals_count:
+			self.write(1, "locals = frame.locals")
+			self.write(1, "{0} = locals".format(", ".join(["l{0}".format(index) for index in range(self.proc.locals_count)]) + ","))
+		if params:
+			self.write(1, "params = frame.params")
+			for index in sorted(params):
+				self.write(1, "p{0} = params[frame.params_base + {0}]".format(index))
+		self.write(1, "pc = frame.inst_ptr")
+		loaded = [(leader, depth) for leader, depth in sorted(entries.items()) if depth]
+		for index, (leader, depth) in enumerate(loaded):
+			self.write(1, "{0} pc == {1}:".format("if" if index == 0 else "elif", leader))
+			self.write(2, "{0} = eval_stack".format(self.stack_names(depth)))
+		if loaded:
+			self.write(1, "del eval_stack[:]")
+		self.write(1, "n = 0")
+		self.write(1, "while True:")
+		for index, leader in enumerate(sorted(entries)):
+			self.write(2, "{0} pc == {1}:".format("if" if index == 0 else "elif", leader))
+			self.write_block(leader)
+		self.write(2, "raise AssertionError(pc)")
+		return ("\n".join(self.lines) + "\n", entries)
+
+def compile_proc(proc):
+	# Returns the CompiledProc of proc, NotCompiled if proc does not verify or has nothing worth compiling
+	try:
+		states = vm_verify.analyze_proc(proc)
+	except vm_exception.VMException:
+		return NotCompiled
+	translator = Translator(proc, states)
+	if not translator.translated:
+		return NotCompiled
+	source, entries = translator.translate()
+	names = translator.names
+	exec compile(source, "<vm_jit proc>", "exec") in names
+	return CompiledProc(names['compiled'], entries, source)
+
+class Compiler(object):
+	# Compiles the procs a Domain runs once they get hot, attached with Domain.attach_compiler. While attached
+	# the domain runs threads with Thread.run_quantum_tiered, unless it is tracing, observing or profiling.
+	# Fields:
+	#	threshold: int - the calls plus back-edges a proc runs interpreted before it is compiled
+	#	counts: dict<Proc,int> - the calls plus back-edges counted for each proc not yet compiled
+	#	compiled_procs: int - the number of procs compiled
+	#	failed_procs: int - the number of hot procs that could not be compiled, and stay interpreted
+	def __init__(self, threshold=DEFAULT_THRESHOLD):
+		self.threshold = threshold
+		self.counts = {}
+		self.compiled_procs = 0
+		self.failed_procs = 0
+	
+	def count(self, proc):
+		# Counts a call or back-edge of proc, compiling it once it reaches threshold
+		count = self.counts.get(proc, 0) + 1
+		if count < self.threshold:
+			self.counts[proc] = count
+			return
+		self.counts.pop(proc, None)
+		proc.compiled = compile_proc(proc)
+		if proc.compiled is NotCompiled:
+			self.failed_procs += 1
+		else:
+			self.compiled_procs += 1
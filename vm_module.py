@@ -0,0 +1,335 @@
+# vm_module.py - Virtual Machine Module Files
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import sys
+import mmap
+import array
+import struct
+
+import vm_values
+import vm_blocks
+import vm_exception
+
+# File Format (little endian):
+#	header: Magic:4s, Version:uint32, consts_count:uint32, types_count:uint32, procs_count:uint32,
+#		consts_offset:uint32, types_offset:uint32, procs_offset:uint32, then module_id:string
+#	const table: consts_count of (kind:uint8, value) - see Const Kinds
+#	type table: types_count of (type_id:string, instc_fields_count:uint32, class_fields_count:uint32)
+#	proc table: procs_count of (params_count, locals_count, consts_count, consts_offset, opcodes_count, opcodes_offset,
+#		handlers_count, handlers_offset) uint32s, where consts_offset points at consts_count uint32 indices into the
+#		const table, opcodes_offset points at opcodes_count packed uint32 opcodes and handlers_offset points at
+#		handlers_count of (start:uint32, end:uint32, handler:uint32, error_type:string), an empty error_type catching every error
+#	string: length:uint32, utf-8 bytes
+# Version 1 files have no handlers in their proc table entries.
+Magic = "VMMD"
+Version = 2
+HeaderFormat = "<4sIIIIIII"
+# Format: { version:int : proc table entry format }
+ProcEntryFormats = { 1 : "<IIIIII", 2 : "<IIIIIIII" }
+ProcEntryFormat = ProcEntryFormats[Version]
+HandlerEntryFormat = "<III"
+WordTypecode = "I"
+ReadTypecode = "i"		# reads words as ints rather than longs, so words must be below 2**31
+
+# Const Kinds
+CONST_NULL = 0
+CONST_INT = 1
+CONST_FLOAT = 2
+CONST_BOOL = 3
+CONST_TOKEN = 4
+CONST_PROC = 5		# value is the index of the proc in its module
+CONST_CHAR = 6		# value is the code point
+
+# The range of the ints a CONST_INT can hold, as a signed 64 bit int
+CONST_INT_MIN = -2 ** 63
+CONST_INT_MAX = 2 ** 63 - 1
+
+def const_kind(value):
+	if vm_values.isNullValue(value):
+		return CONST_NULL
+	elif vm_values.isBoolValue(value):
+		return CONST_BOOL
+	elif vm_values.isIntValue(value):
+		if not CONST_INT_MIN <= value <= CONST_INT_MAX:
+			raise vm_exception.VMException("InvalidOperationError", "UnsupportedConstKind", value, "Module")
+		return CONST_INT
+	elif vm_values.isFloatValue(value):
+		return CONST_FLOAT
+	elif vm_values.isCharValue(value):
+		return CONST_CHAR
+	elif vm_values.isTokenValue(value):
+		return CONST_TOKEN
+	elif isinstance(value, vm_blocks.Proc):
+		return CONST_PROC
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "UnsupportedConstKind", value, "Module")
+
+def pack_string(text):
+	if isinstance(text, unicode):
+		text = text.encode("utf-8")
+	return struct.pack("<I", len(text)) + text
+
+def pack_const(value, proc_indices):
+	# proc_indices:dict<Proc,int> - the index of each proc of the module being written
+	kind = const_kind(value)
+	output = struct.pack("<B", kind)
+	if kind == CONST_BOOL:
+		output += struct.pack("<B", int(value))
+	elif kind == CONST_INT:
+		output += struct.pack("<q", value)
+	elif kind == CONST_FLOAT:
+		output += struct.pack("<d", value)
+	elif kind == CONST_CHAR:
+		output += struct.pack("<I", ord(value))
+	elif kind == CONST_TOKEN:
+		output += pack_string(value.module_id) + pack_string(value.type_id)
+	elif kind == CONST_PROC:
+		if value not in proc_indices:
+			raise vm_exception.VMException("InvalidOperationError", "ProcNotInModule", value, "Module")
+		output += struct.pack("<I", proc_indices[value])
+	return output
+
+def pack_words(words):
+	for word in words:
+		if word < 0 or word >= 0x80000000:
+			raise vm_exception.VMException("InvalidOperationError", "WordOutOfRange", word, "Module")
+	packed = array.array(WordTypecode, words)
+	if sys.byteorder != "little":
+		packed.byteswap()
+	return packed.tostring()
+
+def pack_handlers(exception_table):
+	return "".join([struct.pack(HandlerEntryFormat, start, end, handler) + pack_string(error_type or "") for start, end, handler, error_type in exception_table])
+
+def write_module(file_path, module):
+	# Writes a Module (types with type_ids, and procs) to a module file, sharing equal consts between procs
+	consts = []
+	const_indices = {}
+	proc_const_indices = []
+	proc_indices = dict((proc, index) for index, proc in enumerate(module.procs))
+	for proc in module.procs:
+		indices = []
+		for value in proc.consts:
+			key = (const_kind(value), value)
+			if key not in const_indices:
+				const_indices[key] = len(consts)
+				consts.append(value)
+			indices.append(const_indices[key])
+		proc_const_indices.append(indices)
+	module_id = pack_string(module.module_id)
+	const_table = "".join([pack_const(value, proc_indices) for value in consts])
+	type_table = "".join([pack_string(type_block.type_id) + struct.pack("<II", type_block.instc_fields_count, type_block.class_fields_count) for type_block in module.types])
+	consts_offset = struct.calcsize(HeaderFormat) + len(module_id)
+	types_offset = consts_offset + len(const_table)
+	procs_offset = types_offset + len(type_table)
+	# The proc table is fixed width, so the sections it points at follow it
+	data_offset = procs_offset + struct.calcsize(ProcEntryFormat) * len(module.procs)
+	proc_table = []
+	proc_data = []
+	for proc, indices in zip(module.procs, proc_const_indices):
+		packed_consts = pack_words(indices)
+		packed_opcodes = pack_words(proc.opcodes)
+		packed_handlers = pack_handlers(proc.exception_table)
+		handlers_offset = data_offset + len(packed_consts) + len(packed_opcodes)
+		proc_table.append(struct.pack(ProcEntryFormat, proc.params_count, proc.locals_count, len(indices), data_offset, len(proc.opcodes), data_offset + len(packed_consts), len(proc.exception_table), handlers_offset))
+		proc_data.append(packed_consts + packed_opcodes + packed_handlers)
+		data_offset = handlers_offset + len(packed_handlers)
+	f = open(file_path, "wb")
+	try:
+		f.write(struct.pack(HeaderFormat, Magic, Version, len(consts), len(module.types), len(module.procs), consts_offset, types_offset, procs_offset))
+		f.write(module_id)
+		f.write(const_table)
+		f.write(type_table)
+		f.write("".join(proc_table))
+		f.write("".join(proc_data))
+	finally:
+		f.close()
+
+class ProcIndex(object):
+	# A CONST_PROC const read before the module's procs exist
+	__slots__ = ('proc_index',)
+	def __init__(self, proc_index):
+		self.proc_index = proc_index
+
+class ModuleFile(object):
+	# A memory mapped module file
+	# Fields:
+	#	file_path:String - the path of the file
+	#	data:mmap - the mapped file contents
+	#	consts:list<Value> - the module's const table
+	def __init__(self, file_path):
+		self.file_path = file_path
+		f = open(file_path, "rb")
+		try:
+			self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()
+		self.consts = []
+	
+	def invalid(self):
+		return vm_exception.VMException("LoadError", "InvalidModuleFile", self.file_path, "Module")
+	
+	def read_struct(self, format, offset):
+		try:
+			return struct.unpack_from(format, self.data, offset)
+		except struct.error:
+			raise self.invalid()
+	
+	def read_string(self, offset):
+		# Returns (string, offset after the string)
+		length, = self.read_struct("<I", offset)
+		offset += 4
+		if offset + length > len(self.data):
+			raise self.invalid()
+		return (self.data[offset:offset + length], offset + length)
+	
+	def read_words(self, offset, count):
+		if offset + 4 * count > len(self.data):
+			raise self.invalid()
+		words = array.array(ReadTypecode)
+		words.fromstring(self.data[offset:offset + 4 * count])
+		if sys.byteorder != "little":
+			words.byteswap()
+		return words
+	
+	def read_const(self, offset):
+		# Returns (value, offset after the value)
+		kind, = self.read_struct("<B", offset)
+		offset += 1
+		if kind == CONST_NULL:
+			return (vm_values.Null, offset)
+		elif kind == CONST_BOOL:
+			value, = self.read_struct("<B", offset)
+			return (bool(value), offset + 1)
+		elif kind == CONST_INT:
+			value, = self.read_struct("<q", offset)
+			return (int(value), offset + 8)
+		elif kind == CONST_FLOAT:
+			value, = self.read_struct("<d", offset)
+			return (value, offset + 8)
+		elif kind == CONST_CHAR:
+			value, = self.read_struct("<I", offset)
+			if value > sys.maxunicode:
+				raise self.invalid()
+			return (vm_values.CharValue(unichr(value)), offset + 4)
+		elif kind == CONST_TOKEN:
+			module_id, offset = self.read_string(offset)
+			type_id, offset = self.read_string(offset)
+			return (vm_values.TokenValue(module_id, type_id), offset)
+		elif kind == CONST_PROC:
+			# resolved to the proc by load once the procs exist
+			proc_index, = self.read_struct("<I", offset)
+			return (ProcIndex(proc_index), offset + 4)
+		else:
+			raise self.invalid()
+	
+	def read_handlers(self, offset, count):
+		# Returns the exception table of a proc
+		exception_table = []
+		for index in range(count):
+			start, end, handler = self.read_struct(HandlerEntryFormat, offset)
+			error_type, offset = self.read_string(offset + struct.calcsize(HandlerEntryFormat))
+			exception_table.append((start, end, handler, error_type or None))
+		return exception_table
+	
+	def load(self):
+		# Builds the Module. Types and consts are read now, each proc's consts and opcodes on first use.
+		magic, version, consts_count, types_count, procs_count, consts_offset, types_offset, procs_offset = self.read_struct(HeaderFormat, 0)
+		if magic != Magic or version not in ProcEntryFormats:
+			raise self.invalid()
+		module_id, offset = self.read_string(struct.calcsize(HeaderFormat))
+		offset = consts_offset
+		for index in range(consts_count):
+			value, offset = self.read_const(offset)
+			self.consts.append(value)
+		types = []
+		offset = types_offset
+		for index in range(types_count):
+			type_id, offset = self.read_string(offset)
+			instc_fields_count, class_fields_count = self.read_struct("<II", offset)
+			offset += 8
+			types.append(vm_blocks.Type(instc_fields_count, class_fields_count, type_id))
+		procs = []
+		entry_format = ProcEntryFormats[version]
+		entry_size = struct.calcsize(entry_format)
+		for index in range(procs_count):
+			entry = self.read_struct(entry_format, procs_offset + index * entry_size)
+			if version == 1:
+				entry += (0, 0)
+			procs.append(MappedProc(self, *entry))
+		for index, value in enumerate(self.consts):
+			if isinstance(value, ProcIndex):
+				if value.proc_index >= len(procs):
+					raise self.invalid()
+				self.consts[index] = procs[value.proc_index]
+		return vm_blocks.Module(module_id, types, procs)
+	
+	def close(self):
+		self.data.close()
+
+class MappedProc(vm_blocks.Proc):
+	# A Proc whose consts and opcodes stay in its ModuleFile until first used
+	# Fields:
+	#	module_file:ModuleFile - the file holding the proc
+	#	consts_range:(uint,uint) - (count, offset) of the const indices in the file
+	#	opcodes_range:(uint,uint) - (count, offset) of the opcodes in the file
+	#	handlers_range:(uint,uint) - (count, offset) of the exception table in the file
+	__slots__ = ('module_file', 'consts_range', 'opcodes_range', 'handlers_range', 'loaded_consts', 'loaded_opcodes', 'loaded_handlers')
+	def __init__(self, module_file, params_count, locals_count, consts_count, consts_offset, opcodes_count, opcodes_offset, handlers_count, handlers_offset):
+		self.module_file = module_file
+		self.params_count = params_count
+		self.locals_count = locals_count
+		self.consts_range = (consts_count, consts_offset)
+		self.opcodes_range = (opcodes_count, opcodes_offset)
+		self.handlers_range = (handlers_count, handlers_offset)
+		self.loaded_consts = None
+		self.loaded_opcodes = None
+		self.loaded_handlers = None
+		self.code = None
+		self.verified = False
+		self.compiled = None
+	
+	def get_consts(self):
+		if self.loaded_consts is None:
+			module_consts = self.module_file.consts
+			indices = self.module_file.read_words(self.consts_range[1], self.consts_range[0])
+			try:
+				self.loaded_consts = [module_consts[index] for index in indices]
+			except IndexError:
+				raise self.module_file.invalid()
+		return self.loaded_consts
+	
+	def set_consts(self, consts):
+		self.loaded_consts = consts
+	
+	def get_opcodes(self):
+		if self.loaded_opcodes is None:
+			self.loaded_opcodes = self.module_file.read_words(self.opcodes_range[1], self.opcodes_range[0])
+		return self.loaded_opcodes
+	
+	def set_opcodes(self, opcodes):
+		self.loaded_opcodes = opcodes
+	
+	def get_exception_table(self):
+		if self.loaded_handlers is None:
+			self.loaded_handlers = self.module_file.read_handlers(self.handlers_range[1], self.handlers_range[0])
+		return self.loaded_handlers
+	
+	def set_exception_table(self, exception_table):
+		self.loaded_handlers = exception_table
+	
+	consts = property(get_consts, set_consts)
+	opcodes = property(get_opcodes, set_opcodes)
+	exception_table = property(get_exception_table, set_exception_table)
+	
+	def is_loaded(self):
+		return self.loaded_opcodes is not None
+	
+	def __reduce__(self):
+		# pickles as a plain Proc, the module file is not sent along. The fields are pickled as state
+		# so consts may refer back to the proc (a recursive CALL)
+		return (vm_blocks.Proc, (0, 0, None, None), (self.params_count, self.locals_count, self.consts, list(self.opcodes), self.exception_table))
+
+def load_module(file_path):
+	# Maps a module file and returns its Module
+	return ModuleFile(file_path).load()
@@ -8,48 +8,143 @@ import vm_values
 import vm_blocks
 
 def def_op_nulary(operation):
-	def op_nulary(frame, opcode):
+	def op_nulary(frame, opcode, operand):
 		results = operation()
 		frame.push_eval_stack_value(results)
+	op_nulary.operation = operation
 	return op_nulary
 
+def operation_error(opcode, error):
+	# Returns the VMException of a host error raised by an operation
+	if isinstance(error, ZeroDivisionError):
+		return vm_exception.VMException("InvalidOperationError", "DivideByZero", opcode, "Frame")
+	return vm_exception.VMException("InvalidOperationError", "IntValueOutOfRange", opcode, "Frame")
+
 def def_op_unary(inType, operation):
-	# inType 'v' = Value, 'i' = IntValue, 'f' = FloatValue
-	def op_unary(frame, opcode):
+	# inType 'v' = Value, 'i' = IntValue, 'f' = FloatValue, 'b' = BoolValue, 'c' = CharValue
+	check = vm_values.ValueTypeChecks[inType]
+	def op_unary(frame, opcode, operand):
 		value = frame.pop_eval_stack_value()
-		if vm_values.checkTypeOfValue(inType, value):
-			results = operation(value)
+		if check(value):
+			try:
+				results = operation(value)
+			except (ArithmeticError, ValueError) as e:
+				raise operation_error(opcode, e)
 			frame.push_eval_stack_value(results)
 		else:
 			raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
-			frame.thread.halt()
+	op_unary.operation = operation
+	op_unary.make_unchecked = def_op_unary_unchecked
+	op_unary.in_types = (inType,)
 	return op_unary
 
 def def_op_binary(inType_a, inType_b, operation):
-	def op_binary(frame, opcode):
+	check_a = vm_values.ValueTypeChecks[inType_a]
+	check_b = vm_values.ValueTypeChecks[inType_b]
+	def op_binary(frame, opcode, operand):
 		value_a = frame.pop_eval_stack_value()
 		value_b = frame.pop_eval_stack_value()
-		if vm_values.checkTypeOfValue(inType_a, value_a) and vm_values.checkTypeOfValue(inType_b, value_b):
-			results = operation(value_a, value_b)
+		if check_a(value_a) and check_b(value_b):
+			try:
+				results = operation(value_a, value_b)
+			except (ArithmeticError, ValueError) as e:
+				raise operation_error(opcode, e)
 			frame.push_eval_stack_value(results)
 		else:
 			raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
-			frame.thread.halt()
+	op_binary.operation = operation
+	op_binary.make_unchecked = def_op_binary_unchecked
+	op_binary.in_types = (inType_a, inType_b)
 	return op_binary
 
-def op_NI(frame, opcode):
+# Unchecked Handlers
+# Only used at instruction sites where vm_verify has proven the operand index, stack depth and value types
+
+def def_op_unary_unchecked(operation):
+	def op_unary_unchecked(frame, opcode, operand):
+		eval_stack = frame.eval_stack
+		try:
+			eval_stack[-1] = operation(eval_stack[-1])
+		except (ArithmeticError, ValueError) as e:
+			raise operation_error(opcode, e)
+	return op_unary_unchecked
+
+def def_op_binary_unchecked(operation):
+	def op_binary_unchecked(frame, opcode, operand):
+		eval_stack = frame.eval_stack
+		value_a = eval_stack.pop()
+		try:
+			eval_stack[-1] = operation(value_a, eval_stack[-1])
+		except (ArithmeticError, ValueError) as e:
+			raise operation_error(opcode, e)
+	return op_binary_unchecked
+
+def def_op_branch_binary_unchecked(operation):
+	def op_branch_binary_unchecked(frame, opcode, operand):
+		eval_stack = frame.eval_stack
+		value_a = eval_stack.pop()
+		if operation(value_a, eval_stack.pop()):
+			frame.inst_ptr = operand
+	return op_branch_binary_unchecked
+
+def op_LD_VALUE_UNCHECKED(frame, opcode, operand):
+	# LD_CONST with the constant itself as operand
+	frame.eval_stack.append(operand)
+
+def op_LD_PARAM_UNCHECKED(frame, opcode, operand):
+	frame.eval_stack.append(frame.params[frame.params_base + operand])
+
+def op_LD_LOCAL_UNCHECKED(frame, opcode, operand):
+	frame.eval_stack.append(frame.locals[operand])
+
+def op_ST_LOCAL_UNCHECKED(frame, opcode, operand):
+	frame.locals[operand] = frame.eval_stack.pop()
+
+def op_POP_UNCHECKED(frame, opcode, operand):
+	# operand is at least 1
+	del frame.eval_stack[-operand:]
+
+def op_DUP_UNCHECKED(frame, opcode, operand):
+	eval_stack = frame.eval_stack
+	eval_stack.append(eval_stack[-1])
+
+def op_BR_UNCHECKED(frame, opcode, operand):
+	frame.inst_ptr = operand
+
+def op_BR_TRUE_UNCHECKED(frame, opcode, operand):
+	if frame.eval_stack.pop():
+		frame.inst_ptr = operand
+
+def op_BR_FALSE_UNCHECKED(frame, opcode, operand):
+	if not frame.eval_stack.pop():
+		frame.inst_ptr = operand
+
+def op_LD_LOCAL_LD_LOCAL_IADD_UNCHECKED(frame, opcode, operand):
+	locals = frame.locals
+	frame.eval_stack.append(int(locals[operand[1]] + locals[operand[0]]))
+
+def op_NI(frame, opcode, operand):
 	raise vm_exception.VMException("InvalidOperationError", "OpcodeNotImplemented", opcode, "Frame")
-	frame.thread.halt()
 
 def op_NIO(frame, opcode, operand):
-	op_NI(frame, opcode)
+	op_NI(frame, opcode, operand)
 
-def op_NOP(frame, opcode):
+def op_NOP(frame, opcode, operand):
 	0 + 0
 
-def op_HALT(frame, opcode):
+def op_HALT(frame, opcode, operand):
 	frame.thread.halt()
 
+def op_WAIT(frame, opcode, operand):
+	frame.thread.wait()
+
+def op_PAUSE(frame, opcode, operand):
+	duration = frame.pop_eval_stack_value()
+	if vm_values.isFloatValue(duration) or vm_values.isIntValue(duration):
+		frame.thread.pause(duration)
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
 def op_LD_CONST(frame, opcode, operand):
 	value = frame.get_const(operand)
 	frame.push_eval_stack_value(value)
@@ -70,25 +165,43 @@ def op_POP(frame, opcode, operand):
 	for x in range(0, operand):
 		frame.pop_eval_stack_value()
 
-def op_DUP(frame, opcode):
+def op_DUP(frame, opcode, operand):
 	value = frame.pop_eval_stack_value()
 	frame.push_eval_stack_value(value)
 	frame.push_eval_stack_value(value)
 
-def op_LD_TYPE(frame, opcode):
+def op_LD_TYPE(frame, opcode, operand):
 	token_val = frame.pop_eval_stack_value()
 	if vm_values.isTokenValue(token_val):
-		type_val = frame.get_tokens_map()[token_val.__repr__()]
-		frame.push_eval_stack_value(type_val)
+		type_val = frame.get_tokens_map().get(token_val)
+		if type_val is not None:
+			frame.push_eval_stack_value(type_val)
+		else:
+			raise vm_exception.VMException("InvalidOperationError", "UnknownTypeToken", token_val, "Frame")
 	else:
 		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
 
-def op_NEWOBJ(frame, opcode):
+def op_LD_TYPE_CACHED(frame, opcode, operand):
+	# LD_TYPE with an inline cache, operand is the site's [token, tokens_map, type_ref] cache.
+	# Sites fed by LD_CONST see the same token object every time, so the cache hits on identity.
+	eval_stack = frame.eval_stack
+	if eval_stack:
+		token_val = eval_stack[-1]
+		tokens_map = frame.thread.domain.tokens_map
+		if (token_val is operand[0]) and (tokens_map is operand[1]):
+			eval_stack[-1] = operand[2]
+			return
+	op_LD_TYPE(frame, opcode, None)
+	operand[0] = token_val
+	operand[1] = tokens_map
+	operand[2] = eval_stack[-1]
+
+def op_NEWOBJ(frame, opcode, operand):
 	type_ref_value = frame.pop_eval_stack_value()
 	if vm_values.isRefValue(type_ref_value):
 		type_block = type_ref_value.block()
 		if isinstance(type_block, vm_blocks.Type):
-			obj_ref_value = frame.get_pool().add_block(vm_blocks.Obj(type_block.instc_fields_count))
+			obj_ref_value = frame.add_block(vm_blocks.Obj(type_block.instc_fields_count))
 			frame.push_eval_stack_value(obj_ref_value)
 		else:
 			raise vm_exception.VMException("InvalidOperationError", "InvalidBlockKind", opcode, "Frame")
@@ -98,6 +211,9 @@ def op_NEWOBJ(frame, opcode):
 def op_ST_FIELD(frame, opcode, operand):
 	value = frame.pop_eval_stack_value()
 	obj_ref_value = frame.pop_eval_stack_value()
+	store_field(opcode, obj_ref_value, operand, value)
+
+def store_field(opcode, obj_ref_value, operand, value):
 	if vm_values.isRefValue(obj_ref_value):
 		obj_block = obj_ref_value.block()
 		if isinstance(obj_block, vm_blocks.Obj):
@@ -110,10 +226,394 @@ def op_ST_FIELD(frame, opcode, operand):
 	else:
 		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
 
-# Format: { opcode:int : (needs_operand:bool, function:func(frame, opcode [,operand]), name:int, eval_stack_show:bool, locals_show:bool, [ extended_info:dict], globals_show:bool))}
+# Quickened Handlers
+# Generic sites decode to an adaptive handler that watches the values reaching the site. Once QUICKEN_HITS
+# executions in a row could have run a specialized handler, the site's entry in the decoded code is rewritten
+# to it. A specialized handler guards what it assumes and runs the generic handler when the guard fails;
+# after QUICKEN_MISSES failures the site goes back to its adaptive handler.
+QUICKEN_HITS = 16
+QUICKEN_MISSES = 16
+
+# Format: { in_type:String : class } - the exact class a specialized handler expects for each in_type
+QuickClasses = { 'i' : int, 'f' : float, 'b' : bool, 'c' : vm_values.CharValue }
+
+class QuickSite(object):
+	# The operand of a quickening instruction site
+	# Fields:
+	#	inst_ptr: int - the instruction pointer of the site
+	#	next_ptr: int - the instruction pointer of the next instruction
+	#	operand: the operand of the generic handler
+	#	adaptive: func(frame, opcode, operand) - the adaptive handler of the site
+	#	count: int - the hits in a row while adaptive, the misses while specialized
+	#	shape: int - the instc_fields count of the objects a specialized ST_FIELD stores to
+	__slots__ = ('inst_ptr', 'next_ptr', 'operand', 'adaptive', 'count', 'shape')
+	def __init__(self, inst_ptr, next_ptr, operand, adaptive):
+		self.inst_ptr = inst_ptr
+		self.next_ptr = next_ptr
+		self.operand = operand
+		self.adaptive = adaptive
+		self.count = 0
+		self.shape = None
+
+def rewrite_site(frame, opcode, site, handler):
+	site.count = 0
+	frame.code[site.inst_ptr] = (handler, opcode, site, site.next_ptr)
+
+def quick_miss(frame, opcode, site):
+	site.count += 1
+	if site.count >= QUICKEN_MISSES:
+		rewrite_site(frame, opcode, site, site.adaptive)
+
+def def_op_adaptive(generic, specialized, matches):
+	# matches:func(eval_stack, site) -> bool - True if specialized could run with the values on the stack
+	def op_adaptive(frame, opcode, site):
+		if matches(frame.eval_stack, site):
+			site.count += 1
+			if site.count >= QUICKEN_HITS:
+				rewrite_site(frame, opcode, site, specialized)
+		else:
+			site.count = 0
+		generic(frame, opcode, site.operand)
+	# The verifier and the compiler read the operation of the site's handler
+	for name in ('operation', 'make_unchecked', 'in_types'):
+		if hasattr(generic, name):
+			setattr(op_adaptive, name, getattr(generic, name))
+	return op_adaptive
+
+def def_op_unary_quick(generic, value_class):
+	operation = generic.operation
+	def op_unary_quick(frame, opcode, site):
+		eval_stack = frame.eval_stack
+		if eval_stack and eval_stack[-1].__class__ is value_class:
+			try:
+				eval_stack[-1] = operation(eval_stack[-1])
+			except (ArithmeticError, ValueError) as e:
+				raise operation_error(opcode, e)
+		else:
+			quick_miss(frame, opcode, site)
+			generic(frame, opcode, site.operand)
+	return op_unary_quick
+
+def def_op_binary_quick(generic, value_a_class, value_b_class):
+	operation = generic.operation
+	def op_binary_quick(frame, opcode, site):
+		eval_stack = frame.eval_stack
+		if len(eval_stack) > 1 and eval_stack[-1].__class__ is value_a_class and eval_stack[-2].__class__ is value_b_class:
+			value_a = eval_stack.pop()
+			try:
+				eval_stack[-1] = operation(value_a, eval_stack[-1])
+			except (ArithmeticError, ValueError) as e:
+				raise operation_error(opcode, e)
+		else:
+			quick_miss(frame, opcode, site)
+			generic(frame, opcode, site.operand)
+	return op_binary_quick
+
+def classes_match(classes):
+	# Returns matches for def_op_adaptive, True if the top values are exactly of classes, top of the stack first
+	def matches(eval_stack, site):
+		if len(eval_stack) < len(classes):
+			return False
+		for depth, value_class in enumerate(classes):
+			if eval_stack[-1 - depth].__class__ is not value_class:
+				return False
+		return True
+	return matches
+
+def op_ST_FIELD_QUICK(frame, opcode, site):
+	# ST_FIELD storing to objects with site.shape instance fields
+	eval_stack = frame.eval_stack
+	if len(eval_stack) > 1:
+		obj_ref_value = eval_stack[-2]
+		if obj_ref_value.__class__ is vm_values.RefValue:
+			obj_block = obj_ref_value.target
+			if obj_block.__class__ is vm_blocks.Obj and len(obj_block.instc_fields) == site.shape:
+				obj_block.instc_fields[site.operand] = eval_stack.pop()
+				eval_stack.pop()
+				return
+	quick_miss(frame, opcode, site)
+	op_ST_FIELD(frame, opcode, site.operand)
+
+def st_field_matches(eval_stack, site):
+	# matches of ST_FIELD, a new shape starts the hits again
+	if len(eval_stack) < 2:
+		return False
+	obj_ref_value = eval_stack[-2]
+	if obj_ref_value.__class__ is not vm_values.RefValue or obj_ref_value.target.__class__ is not vm_blocks.Obj:
+		return False
+	shape = len(obj_ref_value.target.instc_fields)
+	if site.operand >= shape:
+		return False
+	if shape != site.shape:
+		site.shape = shape
+		return False
+	return True
+
+def def_quick_decoder(generic, specialized, matches):
+	# Returns the SiteDecoders entry of a quickening opcode
+	adaptive = def_op_adaptive(generic, specialized, matches)
+	return lambda opcode, operand, inst_ptr, next_ptr : (adaptive, QuickSite(inst_ptr, next_ptr, operand, adaptive))
+
+def array_block(opcode, array_ref_value):
+	# Returns the Array block of array_ref_value, raising if it does not refer to one
+	if vm_values.isRefValue(array_ref_value):
+		block = array_ref_value.block()
+		if isinstance(block, vm_blocks.Array):
+			return block
+		else:
+			raise vm_exception.VMException("InvalidOperationError", "InvalidBlockKind", opcode, "Frame")
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
+def check_item_range(opcode, array_block, index, count):
+	# Checks that the count items from index are inside array_block
+	if not (vm_values.isIntValue(index) and vm_values.isIntValue(count)):
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+	if index < 0 or count < 0 or index + count > len(array_block.items):
+		raise vm_exception.VMException("InvalidOperationError", "ItemIndexIsOutOfBounds", opcode, "Frame")
+
+def elementwise_operation(opcode):
+	# Returns (operation, result kind) of an int def_op_binary opcode, or None for any other opcode
+	if opcode not in Opcodes:
+		return None
+	opspec = Opcodes[opcode]
+	if getattr(opspec[1], 'make_unchecked', None) is not def_op_binary_unchecked or opspec[1].in_types != ('i', 'i'):
+		return None
+	if opspec[5]['sa'][0][0] == 'B':
+		return (opspec[1].operation, vm_blocks.ARRAY_BOOL)
+	return (opspec[1].operation, vm_blocks.ARRAY_INT)
+
+def op_NEWARRAY(frame, opcode, operand):
+	# operand is the vm_blocks.ARRAY_* kind of the elements
+	count = frame.pop_eval_stack_value()
+	if operand not in vm_blocks.ArrayKinds:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidArrayKind", opcode, "Frame")
+	elif not vm_values.isIntValue(count):
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+	elif count < 0:
+		raise vm_exception.VMException("InvalidOperationError", "ArrayCountIsNegative", opcode, "Frame")
+	frame.get_pool().check_items(count)
+	frame.push_eval_stack_value(frame.add_block(vm_blocks.Array(operand, count)))
+
+def op_LD_ITEM(frame, opcode, operand):
+	index = frame.pop_eval_stack_value()
+	block = array_block(opcode, frame.pop_eval_stack_value())
+	check_item_range(opcode, block, index, 1)
+	frame.push_eval_stack_value(block.get_item(index))
+
+def op_ST_ITEM(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	index = frame.pop_eval_stack_value()
+	block = array_block(opcode, frame.pop_eval_stack_value())
+	check_item_range(opcode, block, index, 1)
+	if not block.accepts(value):
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeForArray", opcode, "Frame")
+	try:
+		block.items[index] = value
+	except OverflowError:
+		# An int too large for the packed storage of an int array
+		raise vm_exception.VMException("InvalidOperationError", "IntValueOutOfRange", opcode, "Frame")
+
+def op_LD_COUNT(frame, opcode, operand):
+	block = array_block(opcode, frame.pop_eval_stack_value())
+	frame.push_eval_stack_value(len(block.items))
+
+# Bulk Array Handlers
+# Each works on a whole range of items in one dispatch, using the packed storage where there is one
+
+def op_AFILL(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	block = array_block(opcode, frame.pop_eval_stack_value())
+	if not block.accepts(value):
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeForArray", opcode, "Frame")
+	try:
+		block.fill(value)
+	except OverflowError:
+		raise vm_exception.VMException("InvalidOperationError", "IntValueOutOfRange", opcode, "Frame")
+
+def op_ACOPY(frame, opcode, operand):
+	count = frame.pop_eval_stack_value()
+	dest_index = frame.pop_eval_stack_value()
+	dest_block = array_block(opcode, frame.pop_eval_stack_value())
+	src_index = frame.pop_eval_stack_value()
+	src_block = array_block(opcode, frame.pop_eval_stack_value())
+	if src_block.kind != dest_block.kind:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidArrayKind", opcode, "Frame")
+	check_item_range(opcode, src_block, src_index, count)
+	check_item_range(opcode, dest_block, dest_index, count)
+	dest_block.items[dest_index:dest_index + count] = src_block.items[src_index:src_index + count]
+
+def def_op_array_reduce(operation):
+	# Reduces the items of an int or float array to one value, operation is given the packed items
+	def op_array_reduce(frame, opcode, operand):
+		block = array_block(opcode, frame.pop_eval_stack_value())
+		if block.kind not in (vm_blocks.ARRAY_INT, vm_blocks.ARRAY_FLOAT):
+			raise vm_exception.VMException("InvalidOperationError", "InvalidArrayKind", opcode, "Frame")
+		elif len(block.items) == 0:
+			raise vm_exception.VMException("InvalidOperationError", "ArrayIsEmpty", opcode, "Frame")
+		frame.push_eval_stack_value(operation(block.items))
+	return op_array_reduce
+
+def op_AOP(frame, opcode, operand):
+	# operand is an int binary opcode, applied to the items of the two arrays as it would be
+	# to a[i] then b[i] on the stack, giving a new int or bool array
+	block_b = array_block(opcode, frame.pop_eval_stack_value())
+	block_a = array_block(opcode, frame.pop_eval_stack_value())
+	elementwise = elementwise_operation(operand)
+	if elementwise is None:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidOperandOpcode", opcode, "Frame")
+	elif block_a.kind != vm_blocks.ARRAY_INT or block_b.kind != vm_blocks.ARRAY_INT:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidArrayKind", opcode, "Frame")
+	elif len(block_a.items) != len(block_b.items):
+		raise vm_exception.VMException("InvalidOperationError", "ArrayCountsDiffer", opcode, "Frame")
+	operation, kind = elementwise
+	result_block = vm_blocks.Array(kind, 0)
+	try:
+		result_block.set_items(map(operation, block_b.items, block_a.items))
+	except ZeroDivisionError:
+		raise vm_exception.VMException("InvalidOperationError", "DivideByZero", opcode, "Frame")
+	except OverflowError:
+		raise vm_exception.VMException("InvalidOperationError", "IntValueOutOfRange", opcode, "Frame")
+	frame.push_eval_stack_value(frame.add_block(result_block))
+
+def channel_block(opcode, frame, channel_ref_value):
+	# Returns the Channel block of channel_ref_value, raising if it does not refer to one the frame's domain may use
+	if vm_values.isRefValue(channel_ref_value):
+		block = channel_ref_value.block()
+		if not isinstance(block, vm_blocks.Channel):
+			raise vm_exception.VMException("InvalidOperationError", "InvalidBlockKind", opcode, "Frame")
+		elif block.domain is not None and block.domain is not frame.thread.domain:
+			raise vm_exception.VMException("InvalidOperationError", "ChannelOfOtherDomain", opcode, "Frame")
+		return block
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
+def channel_receive(frame, channel):
+	# Channel.receive, the objects of a value from a shared channel being adopted by the frame's pool
+	received, value = channel.receive()
+	if received and channel.domain is None:
+		pool = frame.get_pool()
+		value = pool.adopt(value)
+		if pool.over_quota:
+			frame.thread.end_quantum()
+	return (received, value)
+
+def op_NEWCHAN(frame, opcode, operand):
+	capacity = frame.pop_eval_stack_value()
+	if not vm_values.isIntValue(capacity):
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+	elif capacity < 0:
+		raise vm_exception.VMException("InvalidOperationError", "ChannelCapacityIsNegative", opcode, "Frame")
+	frame.push_eval_stack_value(frame.add_block(vm_blocks.Channel(capacity, frame.thread.domain)))
+
+def op_SEND(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	channel = channel_block(opcode, frame, frame.pop_eval_stack_value())
+	if channel.domain is None:
+		# The objects sent leave this domain, they are copied if it can still reach them
+		domain = frame.thread.domain
+		value = domain.pool.detach(value, domain.gc_roots())
+	channel.send(frame.thread, value)
+
+def op_RECV(frame, opcode, operand):
+	channel_ref_value = frame.pop_eval_stack_value()
+	channel = channel_block(opcode, frame, channel_ref_value)
+	received, value = channel_receive(frame, channel)
+	if received:
+		frame.push_eval_stack_value(value)
+	else:
+		# Blocks until a value is sent, then runs again
+		frame.push_eval_stack_value(channel_ref_value)
+		frame.inst_ptr -= 1
+		channel.park_receiver(frame.thread)
+
+def op_TRY_RECV(frame, opcode, operand):
+	channel = channel_block(opcode, frame, frame.pop_eval_stack_value())
+	received, value = channel_receive(frame, channel)
+	frame.push_eval_stack_value(value)
+	frame.push_eval_stack_value(received)
+
+def const_proc(frame, opcode, operand):
+	# Returns the Proc in consts(operand), raising if the const is not a Proc
+	proc = frame.get_const(operand)
+	if not isinstance(proc, vm_blocks.Proc):
+		raise vm_exception.VMException("InvalidOperationError", "ConstIsNotProc", opcode, "Frame")
+	return proc
+
+def op_CALL(frame, opcode, operand):
+	proc = const_proc(frame, opcode, operand)
+	eval_stack = frame.eval_stack
+	if len(eval_stack) < proc.params_count:
+		raise vm_exception.VMException("InvalidOperationError", "TooFewParams", len(eval_stack), "Frame")
+	# The params stay on this frame's eval stack, the callee reads them from there
+	frame.thread.call_proc(proc, eval_stack, len(eval_stack) - proc.params_count)
+
+def op_TAILCALL(frame, opcode, operand):
+	frame.thread.tail_call_proc(const_proc(frame, opcode, operand))
+
+def op_RET(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	frame.thread.ret_proc(value)
+
+def op_BR(frame, opcode, operand):
+	frame.branch(operand)
+
+def op_BR_TRUE(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	if vm_values.isBoolValue(value):
+		if value:
+			frame.branch(operand)
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
+def op_BR_FALSE(frame, opcode, operand):
+	value = frame.pop_eval_stack_value()
+	if vm_values.isBoolValue(value):
+		if not value:
+			frame.branch(operand)
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
+# Superinstruction Handlers
+# Built by vm_optimize from sequences of the opcodes named after them
+
+def def_op_branch_binary(inType_a, inType_b, operation):
+	# A def_op_binary compare followed by BR_TRUE, operand is the branch target
+	check_a = vm_values.ValueTypeChecks[inType_a]
+	check_b = vm_values.ValueTypeChecks[inType_b]
+	def op_branch_binary(frame, opcode, operand):
+		value_a = frame.pop_eval_stack_value()
+		value_b = frame.pop_eval_stack_value()
+		if check_a(value_a) and check_b(value_b):
+			if operation(value_a, value_b):
+				frame.branch(operand)
+		else:
+			raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+	op_branch_binary.operation = operation
+	op_branch_binary.make_unchecked = def_op_branch_binary_unchecked
+	op_branch_binary.in_types = (inType_a, inType_b)
+	return op_branch_binary
+
+def op_LD_CONST_ST_FIELD(frame, opcode, operand):
+	# operand is (const index, field index)
+	value = frame.get_const(operand[0])
+	obj_ref_value = frame.pop_eval_stack_value()
+	store_field(opcode, obj_ref_value, operand[1], value)
+
+def op_LD_LOCAL_LD_LOCAL_IADD(frame, opcode, operand):
+	# operand is (local index, local index)
+	value_b = frame.get_local(operand[0])
+	value_a = frame.get_local(operand[1])
+	if vm_values.isIntValue(value_a) and vm_values.isIntValue(value_b):
+		frame.push_eval_stack_value(int(value_a + value_b))
+	else:
+		raise vm_exception.VMException("InvalidOperationError", "InvalidValueTypeOnEvalStack", opcode, "Frame")
+
+# Format: { opcode:int : (needs_operand:bool/int, function:func(frame, opcode [,operand]), name:int, eval_stack_show:bool, locals_show:bool, [ extended_info:dict], globals_show:bool))}
 # Format: extended_info = {d = description:string, o = opcode:string, sb = stack_before:list, sa = stack_after:list, m = method:string} 
+# needs_operand is True for one operand word, or the number of operand words; instructions with several get them as a tuple
 Opcodes = {
-	99 : (False, op_NI, 'RET', False, False, { 'd':"Returns from the current procedure.", 'sb':['Va'], 'sa':[] })
+	99 : (False, op_RET, 'RET', False, False, { 'd':"Returns from the current procedure.", 'sb':['Va'], 'sa':[] })
 }
 
 # General Purpose Opcodes (Base = 0)
@@ -127,8 +627,13 @@ Opcodes.update({
 # Machine Control Opcodes (Base = 10)
 Opcodes.update({
 	10 : (False, op_HALT, 'HALT', False, False, {'d':"Halts the thread.", 'o':"", 'sb':[], 'sa':[], 'm':"thread.halt()"}),
-	11 : (False, op_NI, 'WAIT', False, False, {'d':"Causes thread to wait for event.", 'o':"", 'sb':[], 'sa':[], 'm':"thread.wait()"}),
-	12 : (False, op_NI, 'PAUSE', True, False, {'d':"Causes thread to pause for given duration.", 'o':"", 'sb':['Fa'], 'sa':[], 'm':"thread.pause(a)"})
+	11 : (False, op_WAIT, 'WAIT', False, False, {'d':"Causes thread to wait until it is woken.", 'o':"", 'sb':[], 'sa':[], 'm':"thread.wait()"}),
+	12 : (False, op_PAUSE, 'PAUSE', True, False, {'d':"Causes thread to pause for the given duration in seconds.", 'o':"", 'sb':['Fa'], 'sa':[], 'm':"thread.pause(a)"}),
+	13 : (True, op_BR, 'BR', False, False, {'d':"Branches to the instruction at target.", 'o':"target", 'sb':[], 'sa':[], 'm':"goto target"}),
+	14 : (True, op_BR_TRUE, 'BR_TRUE', True, False, {'d':"Branches to the instruction at target if the BoolValue is true.", 'o':"target", 'sb':['Ba'], 'sa':[], 'm':"if a: goto target"}),
+	15 : (True, op_BR_FALSE, 'BR_FALSE', True, False, {'d':"Branches to the instruction at target if the BoolValue is false.", 'o':"target", 'sb':['Ba'], 'sa':[], 'm':"if not a: goto target"}),
+	16 : (True, op_CALL, 'CALL', True, False, {'d':"Calls the Proc in a constant, passing it the top params_count values of the stack.", 'o':"index", 'sb':['Va'], 'sa':['Vb'], 'm':"consts(index)(a...) -> b"}),
+	17 : (True, op_TAILCALL, 'TAILCALL', True, False, {'d':"Runs the Proc in a constant in place of the current one, passing it the top params_count values of the stack.", 'o':"index", 'sb':['Va'], 'sa':[], 'm':"return consts(index)(a...)"})
 })
 
 # Load/Store Opcodes (Base = 20, 50)
@@ -140,17 +645,17 @@ Opcodes.update({
 	24 : (False, def_op_nulary(lambda : int(0)), 'LD_0', True, False, {'d':"Loads an IntValue of 0 on the stack.", 'o':"", 'sb':[], 'sa':['Ia'], 'm':"int(0) -> a"}),
 	25 : (False, def_op_nulary(lambda : int(1)), 'LD_1', True, False, {'d':"Loads an IntValue of 1 on the stack.", 'o':"", 'sb':[], 'sa':['Ia'], 'm':"int(1) -> a"}),
 	26 : (False, def_op_nulary(lambda : int(-1)), 'LD_M1', True, False, {'d':"Loads an IntValue of -1 on the stack.", 'o':"", 'sb':[], 'sa':['Ia'], 'm':"int(-1) -> a"}),
-	27 : (False, def_op_nulary(lambda : vm_values.NullValue()), 'LD_NULL', True, False, {'d':"Loads a NullValue on the stack.", 'o':"", 'sb':[], 'sa':['Na'], 'm':"null() -> a"}),
+	27 : (False, def_op_nulary(lambda : vm_values.Null), 'LD_NULL', True, False, {'d':"Loads a NullValue on the stack.", 'o':"", 'sb':[], 'sa':['Na'], 'm':"null() -> a"}),
 	28 : (False, def_op_nulary(lambda : True), 'LD_TRUE', True, False, {'d':"Loads a BoolValue of True on the stack.", 'o':"", 'sb':[], 'sa':['Ba'], 'm':"bool(true) -> a"}),
 	29 : (False, def_op_nulary(lambda : False), 'LD_FALSE', True, False, {'d':"Loads a BoolValue of False on the stack.", 'o':"", 'sb':[], 'sa':['Ba'], 'm':"bool(false) -> a"}),
 	50 : (False, op_NI, 'LD_CLASS', True, False, {'d':"Loads class for a given object.", 'o':"", 'sb':['Oa'], 'sa':['Yb'], 'm':"a.class -> b"}),
 	51 : (False, op_NI, 'LD_SUPER', True, False, {'d':"Loads super for a given type.", 'o':"", 'sb':['Ya'], 'sa':['Yb'], 'm':"a.super -> b"}),
 	52 : (False, op_NI, 'LD_TYPE', True, False, {'d':"Loads type for a given token.", 'o':"", 'sb':['Ta'], 'sa':['Yb'], 'm':"type(a) -> b"}),
-	53 : (False, op_NI, 'LD_ITEM', True, False, {'d':"Loads item from an array onto the stack.", 'o':"", 'sb':['Aa','Ub'], 'sa':['Vc'], 'm':"a[b] -> c"}),
-	54 : (False, op_NI, 'ST_ITEM', True, False, {'d':"Stores value from stack into item in array.", 'o':"", 'sb':['Aa','Ub','Vc'], 'sa':[], 'm':"c -> a[b]"}),
+	53 : (False, op_LD_ITEM, 'LD_ITEM', True, False, {'d':"Loads item from an array onto the stack.", 'o':"", 'sb':['Aa','Ub'], 'sa':['Vc'], 'm':"a[b] -> c"}),
+	54 : (False, op_ST_ITEM, 'ST_ITEM', True, False, {'d':"Stores value from stack into item in array.", 'o':"", 'sb':['Aa','Ub','Vc'], 'sa':[], 'm':"c -> a[b]"}),
 	55 : (True, op_NIO, 'LD_FIELD', True, False, {'d':"Loads value from field in object or type.", 'o':"index", 'sb':['Za'], 'sa':['Vb'], 'm':"a.field(index) -> b"}),
 	56 : (True, op_ST_FIELD, 'ST_FIELD', True, False, {'d':"Stores value from stack into field in object or type.", 'o':"index", 'sb':['Za','Vb'], 'sa':[], 'm':"b -> a.field(index)"}),
-	57 : (False, op_NI, 'LD_COUNT', True, False, {'d':"Loads count for array onto stack.", 'o':"", 'sb':['Aa'], 'sa':['Ub'], 'm':"a.count -> b"}),
+	57 : (False, op_LD_COUNT, 'LD_COUNT', True, False, {'d':"Loads count for array onto stack.", 'o':"", 'sb':['Aa'], 'sa':['Ub'], 'm':"a.count -> b"}),
 	58 : (False, op_LD_TYPE, 'LD_TYPE', True, False, {'d':"Loads a TypeRefValue given a TokenRefValue", 'o':"", 'sb':['Ta'], 'sa':['Yb'], 'm':"types[a] -> b"})
 })
 
@@ -180,16 +685,34 @@ Opcodes.update({
 
 # Object/Array Opcodes (Base = 60)
 Opcodes.update({
-	60 : (False, op_NI, 'NEWARRAY', True, False, {'d':"Creates a new array with the given dimensions.", 'o':"", 'sb':['Ua'], 'sa':['Ab'], 'm':"new[a] -> b"}),
-	61 : (False, op_NEWOBJ, 'NEWOBJ', True, False, {'d':"Creates a new object with the given type.", 'o':"", 'sb':['Ta'], 'sa':['Ob'], 'm':"new a() -> b"})
+	60 : (True, op_NEWARRAY, 'NEWARRAY', True, False, {'d':"Creates a new array of a items of the given kind (0=Value, 1=Int, 2=Float, 3=Bool).", 'o':"kind", 'sb':['Ua'], 'sa':['Ab'], 'm':"new[a] -> b"}),
+	61 : (False, op_NEWOBJ, 'NEWOBJ', True, False, {'d':"Creates a new object with the given type.", 'o':"", 'sb':['Ta'], 'sa':['Ob'], 'm':"new a() -> b"}),
+	62 : (False, op_AFILL, 'AFILL', True, False, {'d':"Stores value into every item of an array.", 'o':"", 'sb':['Aa','Vb'], 'sa':[], 'm':"b -> a[*]"}),
+	63 : (False, op_ACOPY, 'ACOPY', True, False, {'d':"Copies a range of items between arrays of the same kind.", 'o':"", 'sb':['Aa','Ub','Ac','Ud','Ue'], 'sa':[], 'm':"a[b:b+e] -> c[d:d+e]"}),
+	64 : (False, def_op_array_reduce(sum), 'ASUM', True, False, {'d':"Sums the items of an int or float array.", 'o':"", 'sb':['Aa'], 'sa':['Vb'], 'm':"sum(a) -> b"}),
+	65 : (False, def_op_array_reduce(min), 'AMIN', True, False, {'d':"Finds the smallest item of an int or float array.", 'o':"", 'sb':['Aa'], 'sa':['Vb'], 'm':"min(a) -> b"}),
+	66 : (False, def_op_array_reduce(max), 'AMAX', True, False, {'d':"Finds the largest item of an int or float array.", 'o':"", 'sb':['Aa'], 'sa':['Vb'], 'm':"max(a) -> b"}),
+	67 : (True, op_AOP, 'AOP', True, False, {'d':"Applies an int binary opcode to the items of two int arrays of the same count.", 'o':"opcode", 'sb':['Aa','Ab'], 'sa':['Ac'], 'm':"opcode(b[i], a[i]) -> c[i]"})
+})
+
+# Superinstruction Opcodes (Base = 200)
+Opcodes.update({
+	200 : (2, op_LD_CONST_ST_FIELD, 'LDC_STF', True, False, {'d':"LD_CONST index then ST_FIELD field.", 'o':"index field", 'sb':['Za'], 'sa':[], 'm':"consts(index) -> a.field(field)"}),
+	201 : (2, op_LD_LOCAL_LD_LOCAL_IADD, 'LDL2_IADD', True, False, {'d':"LD_LOCAL x, LD_LOCAL y then IADD.", 'o':"x y", 'sb':[], 'sa':['Ia'], 'm':"locals(y) + locals(x) -> a"}),
+	202 : (True, def_op_branch_binary('i', 'i', lambda x, y : x == y), 'IBR_EQ', True, False, {'d':"ICMP_EQ then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a == b: goto target"}),
+	203 : (True, def_op_branch_binary('i', 'i', lambda x, y : x != y), 'IBR_NE', True, False, {'d':"ICMP_NE then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a != b: goto target"}),
+	204 : (True, def_op_branch_binary('i', 'i', lambda x, y : x < y), 'IBR_LT', True, False, {'d':"ICMP_LT then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a < b: goto target"}),
+	205 : (True, def_op_branch_binary('i', 'i', lambda x, y : x <= y), 'IBR_LE', True, False, {'d':"ICMP_LE then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a <= b: goto target"}),
+	206 : (True, def_op_branch_binary('i', 'i', lambda x, y : x > y), 'IBR_GT', True, False, {'d':"ICMP_GT then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a > b: goto target"}),
+	207 : (True, def_op_branch_binary('i', 'i', lambda x, y : x >= y), 'IBR_GE', True, False, {'d':"ICMP_GE then BR_TRUE target.", 'o':"target", 'sb':['Ia','Ib'], 'sa':[], 'm':"if a >= b: goto target"})
 })
 
 # Testing Opcodes (Base = 70)
 Opcodes.update({
-	70 : (False, op_NI, 'ISINT', True, False, {'d':"Determines of the top Value is an IntValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isint(a) -> b"}),
-	71 : (False, op_NI, 'ISFLOAT', True, False, {'d':"Determines of the top Value is an FloatValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isfloat(a) -> b"}),
-	72 : (False, op_NI, 'ISBOOL', True, False, {'d':"Determines of the top Value is an BoolValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isbool(a) -> b"}),
-	73 : (False, op_NI, 'ISCHAR', True, False, {'d':"Determines of the top Value is an CharValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"ischar(a) -> b"}),
+	70 : (False, def_op_unary('v', vm_values.isIntValue), 'ISINT', True, False, {'d':"Determines of the top Value is an IntValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isint(a) -> b"}),
+	71 : (False, def_op_unary('v', vm_values.isFloatValue), 'ISFLOAT', True, False, {'d':"Determines of the top Value is an FloatValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isfloat(a) -> b"}),
+	72 : (False, def_op_unary('v', vm_values.isBoolValue), 'ISBOOL', True, False, {'d':"Determines of the top Value is an BoolValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isbool(a) -> b"}),
+	73 : (False, def_op_unary('v', vm_values.isCharValue), 'ISCHAR', True, False, {'d':"Determines of the top Value is an CharValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"ischar(a) -> b"}),
 	74 : (False, op_NI, 'ISNULL', True, False, {'d':"Determines of the top Value is an NullValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isnull(a) -> b"}),
 	75 : (False, op_NI, 'ISTOKEN', True, False, {'d':"Determines of the top Value is an TokenValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"istoken(a) -> b"}),
 	76 : (False, op_NI, 'ISREF', True, False, {'d':"Determines of the top Value is an RefValue.", 'o':"", 'sb':['Va'], 'sa':['Bb'], 'm':"isref(a) -> b"}),
@@ -200,27 +723,125 @@ Opcodes.update({
 
 # Conversion Opcodes (Base = 80)
 Opcodes.update({
-	81 : (False, op_NI, 'I2F', True, False, {'d':"Converts IntValue to FloatValue.", 'o':"", 'sb':['Ia'], 'sa':['Fb'], 'm':"float(a) -> b"}),
-	82 : (False, op_NI, 'I2C', True, False, {'d':"Converts IntValue to CharValue.", 'o':"", 'sb':['Ia'], 'sa':['Cb'], 'm':"char(a) -> b"}),
+	81 : (False, def_op_unary('i', lambda x : float(x)), 'I2F', True, False, {'d':"Converts IntValue to FloatValue.", 'o':"", 'sb':['Ia'], 'sa':['Fb'], 'm':"float(a) -> b"}),
+	82 : (False, def_op_unary('i', lambda x : vm_values.CharValue(unichr(x))), 'I2C', True, False, {'d':"Converts IntValue to CharValue.", 'o':"", 'sb':['Ia'], 'sa':['Cb'], 'm':"char(a) -> b"}),
 	83 : (False, def_op_unary('i', lambda x : bool(x)), 'I2B', True, False, {'d':"Converts IntValue to BoolValue.", 'o':"", 'sb':['Ia'], 'sa':['Bb'], 'm':"bool(a) -> b"}),
 	84 : (False, def_op_unary('b', lambda x : int(x)), 'B2I', True, False, {'d':"Converts BoolValue to IntValue.", 'o':"", 'sb':['Ba'], 'sa':['Ib'], 'm':"int(a) -> b"}),
-	85 : (False, op_NI, 'C2I', True, False, {'d':"Converts CharValue to IntValue.", 'o':"", 'sb':['Ca'], 'sa':['Ib'], 'm':"int(a) -> b"}),
-	86 : (False, op_NI, 'F2I', True, False, {'d':"Converts FloatValue to IntValue.", 'o':"", 'sb':['Fa'], 'sa':['Ib'], 'm':"int(a) -> b"})
+	85 : (False, def_op_unary('c', lambda x : ord(x)), 'C2I', True, False, {'d':"Converts CharValue to IntValue.", 'o':"", 'sb':['Ca'], 'sa':['Ib'], 'm':"int(a) -> b"}),
+	86 : (False, def_op_unary('f', lambda x : int(x)), 'F2I', True, False, {'d':"Converts FloatValue to IntValue.", 'o':"", 'sb':['Fa'], 'sa':['Ib'], 'm':"int(a) -> b"})
+})
+
+# Float Opcodes (Base = 100)
+Opcodes.update({
+	100 : (False, def_op_binary('f', 'f', lambda x, y : float(x + y)), 'FADD', True, False, {'d':"Adds the top two FloatValues and puts the results on the stack.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Fc'], 'm':"a + b -> c"}),
+	101 : (False, def_op_binary('f', 'f', lambda x, y : float(x - y)), 'FSUB', True, False, {'d':"Subtracts the top two FloatValues and puts the results on the stack.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Fc'], 'm':"a - b -> c"}),
+	102 : (False, def_op_binary('f', 'f', lambda x, y : float(x * y)), 'FMUL', True, False, {'d':"Multiplies the top two FloatValues and puts the results on the stack.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Fc'], 'm':"a * b -> c"}),
+	103 : (False, def_op_binary('f', 'f', lambda x, y : float(x / y)), 'FDIV', True, False, {'d':"Divides the top two FloatValues and puts the results on the stack.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Fc'], 'm':"a / b -> c"}),
+	104 : (False, def_op_unary('f', lambda x : float(-x)), 'FNEG', True, False, {'d':"Negates the FloatValue on top of the stack.", 'o':"", 'sb':['Fa'], 'sa':['Fb'], 'm':"-a -> b"}),
+	105 : (False, def_op_binary('f', 'f', lambda x, y : bool(x == y)), 'FCMP_EQ', True, False, {'d':"Compares two FloatValues on top of the stack for equality.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a == b -> c"}),
+	106 : (False, def_op_binary('f', 'f', lambda x, y : bool(x != y)), 'FCMP_NE', True, False, {'d':"Compares two FloatValues on top of the stack for non-equality.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a != b -> c"}),
+	107 : (False, def_op_binary('f', 'f', lambda x, y : bool(x < y)), 'FCMP_LT', True, False, {'d':"Compares if the two FloatValues on top of the stack are less than.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a < b -> c"}),
+	108 : (False, def_op_binary('f', 'f', lambda x, y : bool(x <= y)), 'FCMP_LE', True, False, {'d':"Compares if the two FloatValues on top of the stack are less than or equal.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a <= b -> c"}),
+	109 : (False, def_op_binary('f', 'f', lambda x, y : bool(x > y)), 'FCMP_GT', True, False, {'d':"Compares if the two FloatValues on top of the stack are greater than.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a > b -> c"}),
+	110 : (False, def_op_binary('f', 'f', lambda x, y : bool(x >= y)), 'FCMP_GE', True, False, {'d':"Compares if the two FloatValues on top of the stack are greater than or equal.", 'o':"", 'sb':['Fa','Fb'], 'sa':['Bc'], 'm':"a >= b -> c"})
+})
+
+# Char Opcodes (Base = 120)
+Opcodes.update({
+	120 : (False, def_op_binary('c', 'c', lambda x, y : bool(x == y)), 'CCMP_EQ', True, False, {'d':"Compares two CharValues on top of the stack for equality.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a == b -> c"}),
+	121 : (False, def_op_binary('c', 'c', lambda x, y : bool(x != y)), 'CCMP_NE', True, False, {'d':"Compares two CharValues on top of the stack for non-equality.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a != b -> c"}),
+	122 : (False, def_op_binary('c', 'c', lambda x, y : bool(x < y)), 'CCMP_LT', True, False, {'d':"Compares if the two CharValues on top of the stack are less than.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a < b -> c"}),
+	123 : (False, def_op_binary('c', 'c', lambda x, y : bool(x <= y)), 'CCMP_LE', True, False, {'d':"Compares if the two CharValues on top of the stack are less than or equal.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a <= b -> c"}),
+	124 : (False, def_op_binary('c', 'c', lambda x, y : bool(x > y)), 'CCMP_GT', True, False, {'d':"Compares if the two CharValues on top of the stack are greater than.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a > b -> c"}),
+	125 : (False, def_op_binary('c', 'c', lambda x, y : bool(x >= y)), 'CCMP_GE', True, False, {'d':"Compares if the two CharValues on top of the stack are greater than or equal.", 'o':"", 'sb':['Ca','Cb'], 'sa':['Bc'], 'm':"a >= b -> c"})
 })
 
-def run_opcode(frame, opcode):
-	if opcode in Opcodes:
-		opspec = Opcodes[opcode]
-		inst_ptr = frame.inst_ptr
-		old_eval_stack = list(frame.eval_stack)
-		if opspec[0]:
+# Channel Opcodes (Base = 130)
+Opcodes.update({
+	130 : (False, op_NEWCHAN, 'NEWCHAN', True, False, {'d':"Creates a new channel holding up to a values.", 'o':"", 'sb':['Ia'], 'sa':['Rb'], 'm':"channel(a) -> b"}),
+	131 : (False, op_SEND, 'SEND', True, False, {'d':"Sends a value to a channel, blocking while the channel is full.", 'o':"", 'sb':['Va','Rb'], 'sa':[], 'm':"a -> b.send"}),
+	132 : (False, op_RECV, 'RECV', True, False, {'d':"Receives a value from a channel, blocking while the channel is empty.", 'o':"", 'sb':['Ra'], 'sa':['Vb'], 'm':"a.receive -> b"}),
+	133 : (False, op_TRY_RECV, 'TRY_RECV', True, False, {'d':"Receives a value from a channel if there is one, c is False and b is Null if there is none.", 'o':"", 'sb':['Ra'], 'sa':['Vb','Bc'], 'm':"a.try_receive -> b, c"})
+})
+
+def op_UNKNOWN(frame, opcode, operand):
+	raise vm_exception.VMException("InvalidOperationError","UnknownOpcode", opcode, "Frame")
+
+def op_IP_OUT_OF_BOUNDS(frame, opcode, operand):
+	# operand is the instruction pointer that fell outside of the opcodes
+	raise vm_exception.VMException("InvalidOperationError","InstructionPointerOutOfBounds", operand, "Frame")
+
+def op_IP_MISALIGNED(frame, opcode, operand):
+	# operand is the instruction pointer that landed on another opcode's operand
+	raise vm_exception.VMException("InvalidOperationError","InstructionPointerMisaligned", operand, "Frame")
+
+# Format: { opcode:int : falls_through:bool }
+# Opcodes whose operand is a branch target, and whether they may also continue with the next instruction
+BranchOpcodes = {
+	13 : False,		# BR
+	14 : True,		# BR_TRUE
+	15 : True		# BR_FALSE
+}
+BranchOpcodes.update([(opcode, True) for opcode in range(202, 208)])	# IBR_*
+
+# Format: { opcode:int : func(opcode, operand, inst_ptr, next_ptr) -> (handler, operand) }
+# Opcodes whose instruction sites get their own handler or operand when decoded
+SiteDecoders = {
+	58 : lambda opcode, operand, inst_ptr, next_ptr : (op_LD_TYPE_CACHED, [None, None, None]),
+	56 : def_quick_decoder(op_ST_FIELD, op_ST_FIELD_QUICK, st_field_matches)
+}
+# The int and bool def_op_unary and def_op_binary opcodes quicken to handlers for exactly those classes
+for opcode, opspec in Opcodes.items():
+	make_unchecked = getattr(opspec[1], 'make_unchecked', None)
+	if make_unchecked not in (def_op_unary_unchecked, def_op_binary_unchecked) or not set(opspec[1].in_types).issubset(QuickClasses):
+		continue
+	classes = [QuickClasses[in_type] for in_type in opspec[1].in_types]
+	if make_unchecked is def_op_unary_unchecked:
+		specialized = def_op_unary_quick(opspec[1], *classes)
+	else:
+		specialized = def_op_binary_quick(opspec[1], *classes)
+	SiteDecoders[opcode] = def_quick_decoder(opspec[1], specialized, classes_match(classes))
+
+def instruction_operand(opcodes, inst_ptr, next_ptr):
+	# Returns the operand words of the instruction at inst_ptr: None, the word, or a tuple of the words
+	if next_ptr == inst_ptr + 2:
+		return opcodes[inst_ptr + 1]
+	elif next_ptr > inst_ptr + 2:
+		return tuple(opcodes[inst_ptr + 1:next_ptr])
+	return None
+
+def decode_instruction(opcode, operand, inst_ptr, next_ptr):
+	handler = Opcodes[opcode][1]
+	if opcode in SiteDecoders:
+		handler, operand = SiteDecoders[opcode](opcode, operand, inst_ptr, next_ptr)
+	return (handler, opcode, operand, next_ptr)
+
+def decode_opcodes(opcodes):
+	# Decodes opcodes into a list of (handler:func(frame, opcode, operand), opcode:int, operand, next_ptr:int)
+	# entries indexed by instruction pointer. The operand words of an entry are opcodes[inst_ptr + 1:next_ptr],
+	# the operand passed to its handler may be specialized from them (see SiteDecoders). Operand slots decode to misaligned entries, and one extra
+	# entry past the end catches execution running off the end, so the step loop needs no bounds checks.
+	code = []
+	opcodes_count = len(opcodes)
+	inst_ptr = 0
+	while inst_ptr < opcodes_count:
+		opcode = opcodes[inst_ptr]
+		if opcode not in Opcodes:
+			code.append((op_UNKNOWN, opcode, None, inst_ptr + 1))
+			inst_ptr += 1
+		elif Opcodes[opcode][0]:
 			#This operation needs an operand
-			operand = frame.get_opcode()
-			opspec[1](frame, opcode, operand)
-			vm_trace.print_frame_trace(inst_ptr, opspec[2], operand, old_eval_stack, frame.eval_stack, frame.locals, opspec[3], opspec[4], frame.cycle_count)
+			next_ptr = inst_ptr + 1 + int(Opcodes[opcode][0])
+			if next_ptr > opcodes_count:
+				code.append((op_IP_OUT_OF_BOUNDS, opcode, inst_ptr + 1, opcodes_count))
+				inst_ptr += 1
+			else:
+				code.append(decode_instruction(opcode, instruction_operand(opcodes, inst_ptr, next_ptr), inst_ptr, next_ptr))
+				for operand_ptr in range(inst_ptr + 1, next_ptr):
+					code.append((op_IP_MISALIGNED, None, operand_ptr, operand_ptr + 1))
+				inst_ptr = next_ptr
 		else:
-			opspec[1](frame, opcode)
-			vm_trace.print_frame_trace(inst_ptr, opspec[2], "", old_eval_stack, frame.eval_stack, frame.locals, opspec[3], opspec[4], frame.cycle_count)
-	else:
-		raise vm_exception.VMException("InvalidOperationError","UnknownOpcode", opcode, "Frame")
-		frame.thread.halt()
\ No newline at end of file
+			code.append(decode_instruction(opcode, None, inst_ptr, inst_ptr + 1))
+			inst_ptr += 1
+	code.append((op_IP_OUT_OF_BOUNDS, None, opcodes_count, opcodes_count))
+	return code
@@ -0,0 +1,254 @@
+# vm_optimize.py - Virtual Machine Peephole Optimizer
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import vm_values
+import vm_opcode
+
+# Format: { compare_opcode:int : (branch_if_true_opcode:int, branch_if_false_opcode:int) }
+# The IBR_* superinstruction replacing a compare followed by BR_TRUE or BR_FALSE
+CompareBranches = {
+	44 : (202, 203),	# ICMP_EQ
+	45 : (203, 202),	# ICMP_NE
+	46 : (204, 207),	# ICMP_LT
+	47 : (205, 206),	# ICMP_LE
+	48 : (206, 205),	# ICMP_GT
+	49 : (207, 204)		# ICMP_GE
+}
+
+class Instruction(object):
+	# An instruction being rewritten
+	# Fields:
+	#	opcode: int - the opcode
+	#	operands: list<int> - the operand words
+	#	labels: list<int> - the instruction pointers in the original opcodes that now start at this instruction
+	__slots__ = ('opcode', 'operands', 'labels')
+	def __init__(self, opcode, operands, labels):
+		self.opcode = opcode
+		self.operands = operands
+		self.labels = labels
+
+def operands_count(opcode):
+	if opcode in vm_opcode.Opcodes:
+		return int(vm_opcode.Opcodes[opcode][0])
+	return 0
+
+def read_instructions(opcodes):
+	# Returns the list of Instructions in opcodes, or None if an operand runs past the end
+	instructions = []
+	inst_ptr = 0
+	while inst_ptr < len(opcodes):
+		next_ptr = inst_ptr + 1 + operands_count(opcodes[inst_ptr])
+		if next_ptr > len(opcodes):
+			return None
+		instructions.append(Instruction(opcodes[inst_ptr], list(opcodes[inst_ptr + 1:next_ptr]), [inst_ptr]))
+		inst_ptr = next_ptr
+	return instructions
+
+def new_pointers(instructions, end_labels):
+	# Returns dict<int,int> of where each instruction pointer in the original opcodes now starts
+	new_ptrs = {}
+	inst_ptr = 0
+	for instruction in instructions:
+		for label in instruction.labels:
+			new_ptrs[label] = inst_ptr
+		inst_ptr += 1 + len(instruction.operands)
+	for label in end_labels:
+		new_ptrs[label] = inst_ptr
+	return new_ptrs
+
+def write_instructions(instructions, end_labels):
+	# Returns the opcodes of instructions, with branch targets moved to where their labels now start
+	new_ptrs = new_pointers(instructions, end_labels)
+	opcodes = []
+	for instruction in instructions:
+		opcodes.append(instruction.opcode)
+		if instruction.opcode in vm_opcode.BranchOpcodes:
+			opcodes.append(new_ptrs[instruction.operands[0]])
+		else:
+			opcodes.extend(instruction.operands)
+	return opcodes
+
+class Optimizer(object):
+	# Rewrites the opcodes of a Proc, keeping the behavior of every instruction sequence it replaces
+	# Fields:
+	#	proc: Proc - the Proc being optimized
+	#	consts: list<values> - the consts of proc, with the results of folding added
+	#	instructions: list<Instruction> - the instructions being rewritten
+	#	end_labels: list<int> - the instruction pointers that now point just past the last instruction
+	#	targets: set<int> - the instruction pointers in the original opcodes that are branch targets, or the
+	#		start, end or handler of a try region
+	def __init__(self, proc, instructions):
+		self.proc = proc
+		self.consts = list(proc.consts)
+		self.instructions = instructions
+		self.end_labels = [len(proc.opcodes)]
+		self.targets = set([instruction.operands[0] for instruction in instructions if instruction.opcode in vm_opcode.BranchOpcodes])
+		for start, end, handler, error_type in proc.exception_table:
+			self.targets.update((start, end, handler))
+		self.nops_removed = 0
+		self.folded = 0
+		self.fused = 0
+	
+	def is_join(self, instruction):
+		# True if a branch may arrive at instruction, so it cannot be the inside of a replaced sequence
+		for label in instruction.labels:
+			if label in self.targets:
+				return True
+		return False
+	
+	def can_replace(self, index, count):
+		# True if the count instructions from index exist and only the first may be branched to
+		if index + count > len(self.instructions):
+			return False
+		for instruction in self.instructions[index + 1:index + count]:
+			if self.is_join(instruction):
+				return False
+		return True
+	
+	def replace(self, index, count, opcode, operands):
+		self.instructions[index:index + count] = [Instruction(opcode, operands, self.instructions[index].labels)]
+	
+	def remove_nops(self):
+		instructions = []
+		labels = []
+		for instruction in self.instructions:
+			if instruction.opcode == 0:
+				labels.extend(instruction.labels)
+				self.nops_removed += 1
+			else:
+				instruction.labels = labels + instruction.labels
+				labels = []
+				instructions.append(instruction)
+		self.end_labels = labels + self.end_labels
+		self.instructions = instructions
+	
+	def constant_value(self, instruction):
+		# Returns (True, value) if instruction only loads a constant value, else (False, None)
+		opcode = instruction.opcode
+		if opcode == 20:
+			if instruction.operands[0] < len(self.consts):
+				return (True, self.consts[instruction.operands[0]])
+		elif opcode in vm_opcode.Opcodes:
+			handler = vm_opcode.Opcodes[opcode][1]
+			if hasattr(handler, 'operation') and not hasattr(handler, 'in_types'):
+				return (True, handler.operation())
+		return (False, None)
+	
+	def load_constant(self, value):
+		# Returns (opcode, operands) of an instruction loading value, reusing LD_0 and the like or an existing const
+		for opcode, opspec in vm_opcode.Opcodes.items():
+			handler = opspec[1]
+			if hasattr(handler, 'operation') and not hasattr(handler, 'in_types'):
+				loaded = handler.operation()
+				if loaded.__class__ is value.__class__ and loaded == value:
+					return (opcode, [])
+		for index, const in enumerate(self.consts):
+			if const.__class__ is value.__class__ and const == value:
+				return (20, [index])
+		self.consts.append(value)
+		return (20, [len(self.consts) - 1])
+	
+	def fold_at(self, index):
+		# Folds a def_op_unary or def_op_binary opcode applied to constant loads starting at index
+		for count in (2, 3):
+			if not self.can_replace(index, count):
+				continue
+			operation_handler = vm_opcode.Opcodes.get(self.instructions[index + count - 1].opcode, (None, None))[1]
+			in_types = getattr(operation_handler, 'in_types', None)
+			if getattr(operation_handler, 'make_unchecked', None) not in (vm_opcode.def_op_unary_unchecked, vm_opcode.def_op_binary_unchecked):
+				continue
+			if in_types is None or len(in_types) != count - 1:
+				continue
+			values = []
+			for instruction in self.instructions[index:index + count - 1]:
+				is_constant, value = self.constant_value(instruction)
+				if not is_constant:
+					break
+				values.append(value)
+			if len(values) != count - 1:
+				continue
+			# The last load is the top of the stack, which is checked against in_types[0]
+			values.reverse()
+			for in_type, value in zip(in_types, values):
+				if not vm_values.checkTypeOfValue(in_type, value):
+					return False
+			try:
+				result = operation_handler.operation(*values)
+			except ArithmeticError:
+				return False
+			if result.__class__ not in (int, bool):
+				return False
+			opcode, operands = self.load_constant(result)
+			self.replace(index, count, opcode, operands)
+			self.folded += 1
+			return True
+		return False
+	
+	def fold_constants(self):
+		changed = True
+		while changed:
+			changed = False
+			for index in range(len(self.instructions)):
+				if index < len(self.instructions) and self.fold_at(index):
+					changed = True
+	
+	def fuse_at(self, index):
+		# Replaces the sequence starting at index with a superinstruction
+		instructions = self.instructions
+		first = instructions[index]
+		if first.opcode == 20 and self.can_replace(index, 2) and instructions[index + 1].opcode == 56:
+			if first.operands[0] < len(self.consts):
+				self.replace(index, 2, 200, [first.operands[0], instructions[index + 1].operands[0]])
+				return True
+		elif first.opcode == 22 and self.can_replace(index, 3) and instructions[index + 1].opcode == 22 and instructions[index + 2].opcode == 30:
+			if max(first.operands[0], instructions[index + 1].operands[0]) < self.proc.locals_count:
+				self.replace(index, 3, 201, [first.operands[0], instructions[index + 1].operands[0]])
+				return True
+		elif first.opcode in CompareBranches and self.can_replace(index, 2) and instructions[index + 1].opcode in (14, 15):
+			if instructions[index + 1].opcode == 14:
+				opcode = CompareBranches[first.opcode][0]
+			else:
+				opcode = CompareBranches[first.opcode][1]
+			self.replace(index, 2, opcode, instructions[index + 1].operands)
+			return True
+		return False
+	
+	def fuse_superinstructions(self):
+		index = 0
+		while index < len(self.instructions):
+			if self.fuse_at(index):
+				self.fused += 1
+			index += 1
+
+def optimize_proc(proc):
+	# Removes NOPs, folds constant int arithmetic and fuses superinstructions in proc.opcodes.
+	# Returns a report of the instructions removed. Procs with an operand, branch target or try region
+	# boundary outside their opcodes are left as they are. The try regions are moved with their instructions.
+	instructions = read_instructions(proc.opcodes)
+	report = { 'instructions_before':0, 'instructions_after':0, 'removed':0, 'nops_removed':0, 'folded':0, 'fused':0 }
+	if instructions is None:
+		return report
+	report['instructions_before'] = report['instructions_after'] = len(instructions)
+	starts = set([label for instruction in instructions for label in instruction.labels] + [len(proc.opcodes)])
+	optimizer = Optimizer(proc, instructions)
+	if not optimizer.targets.issubset(starts):
+		return report
+	optimizer.remove_nops()
+	optimizer.fold_constants()
+	optimizer.fuse_superinstructions()
+	proc.opcodes = write_instructions(optimizer.instructions, optimizer.end_labels)
+	new_ptrs = new_pointers(optimizer.instructions, optimizer.end_labels)
+	proc.exception_table = [(new_ptrs[start], new_ptrs[end], new_ptrs[handler], error_type) for start, end, handler, error_type in proc.exception_table]
+	if len(optimizer.consts) != len(proc.consts):
+		proc.consts = optimizer.consts
+	proc.invalidate_code()
+	report['instructions_after'] = len(optimizer.instructions)
+	report['removed'] = report['instructions_before'] - report['instructions_after']
+	report['nops_removed'] = optimizer.nops_removed
+	report['folded'] = optimizer.folded
+	report['fused'] = optimizer.fused
+	return report
+
+def optimize_module(module):
+	# Optimizes every proc of a Module, returning the list of optimize_proc reports
+	return [optimize_proc(proc) for proc in module.procs]
@@ -1,23 +1,260 @@
 # vm_pool.py - Virtual Machine Pool Implementation
 # (c) 2013, Bryan Stockus. All Rights Reserved.
 
+import sys
+import time
+
 import vm_values
 import vm_blocks
+import vm_exception
+
+DEFAULT_GC_THRESHOLD = 10000	# allocations between collections while the pool is small
+ITEM_BYTES = 8					# the bytes counted for each item of an array not created yet, see check_items
+HARD_QUOTA_FACTOR = 2			# how far past its quotas a pool may go before it is collected, see check_quota
+DETACH_COPY_ITEMS = 256			# graphs of at most this many fields and items in all are copied by detach without walking the pool
+
+def block_bytes(block):
+	# Returns the bytes counted against a pool's max_bytes for block, its values being counted as pointers
+	if block.block_type == vm_blocks.Obj.block_type:
+		return sys.getsizeof(block) + sys.getsizeof(block.instc_fields)
+	elif block.block_type == vm_blocks.Array.block_type:
+		return sys.getsizeof(block) + sys.getsizeof(block.items)
+	return sys.getsizeof(block)
+
+def block_items(block):
+	# Returns the number of fields or items of a movable block, what copy_block copies
+	if block.block_type == vm_blocks.Obj.block_type:
+		return len(block.instc_fields)
+	return len(block.items)
+
+def movable(block):
+	# Objs and Arrays are moved between pools by Pool.detach and Pool.adopt, the other blocks are never
+	# written by an opcode so are shared by the pools instead
+	return block.block_type == vm_blocks.Obj.block_type or block.block_type == vm_blocks.Array.block_type
+
+def graph_refs(value):
+	# Returns dict<id(Block),RefValue> of the blocks value refers to, and of those the movable ones refer to
+	refs = {}
+	pending = [value]
+	while pending:
+		value = pending.pop()
+		if vm_values.isRefValue(value) and id(value.target) not in refs:
+			refs[id(value.target)] = value
+			if movable(value.target):
+				pending.extend(value.target.child_values())
+	return refs
+
+def reaches(roots, refs):
+	# True if a block of refs can be reached from the values in roots
+	seen = set()
+	pending = list(roots)
+	while pending:
+		value = pending.pop()
+		if vm_values.isRefValue(value) and id(value.target) not in seen:
+			if id(value.target) in refs:
+				return True
+			seen.add(id(value.target))
+			pending.extend(value.target.child_values())
+	return False
+
+def copy_block(block):
+	if block.block_type == vm_blocks.Obj.block_type:
+		copy = vm_blocks.Obj(0)
+		copy.instc_fields = list(block.instc_fields)
+	else:
+		copy = vm_blocks.Array(block.kind, 0)
+		copy.items = block.items[:]
+	return copy
+
+def relink(block, refs):
+	# Replaces the refs held by a movable block with the refs of the same blocks in refs
+	if block.block_type == vm_blocks.Obj.block_type:
+		values = block.instc_fields
+	elif block.kind == vm_blocks.ARRAY_VALUE:
+		values = block.items
+	else:
+		return
+	for index, value in enumerate(values):
+		if vm_values.isRefValue(value):
+			values[index] = refs[id(value.target)]
 
 class Pool(object):
 	# Fields:
 	#	blocks:dict<uint,Block> - the blocks in this pool
 	#	current_index:uint - the current index value
-	def __init__(self):
+	#	free_indices:list<uint> - indices freed by the collector, reused before current_index grows
+	#	gc_threshold:uint - the minimum number of allocations between collections
+	#	next_collection:uint - the number of allocations that triggers the next collection
+	#	allocations:uint - the number of allocations since the last collection
+	#	collect_pending:bool - set once allocations reaches the threshold, cleared by collect
+	#	collections:uint - the number of collections run
+	#	freed_blocks:uint - the number of blocks freed by all collections
+	#	last_pause:float - the seconds taken by the last collection
+	#	total_pause:float - the seconds taken by all collections
+	#	max_blocks:uint - the most blocks the pool may hold, None for no limit
+	#	max_bytes:uint - the most block_bytes the pool may hold, None for no limit
+	#	live_bytes:uint - the block_bytes of the blocks in this pool, only counted while max_bytes is set
+	#	limited:bool - True if either max_blocks or max_bytes is set
+	#	over_quota:bool - set once an allocation takes the pool past a quota, cleared by check_over_quota
+	#	shared:Pool - the pool of the vm_image.Image whose blocks this pool's values may also refer to, None if there is none
+	def __init__(self, gc_threshold=DEFAULT_GC_THRESHOLD, shared=None):
 		self.blocks = {}
+		self.shared = shared
+		# Indices start past the shared pool's, which an image never adds to once it is shared
 		self.current_index = 0
+		if shared is not None:
+			self.current_index = shared.current_index
+		self.free_indices = []
+		self.gc_threshold = gc_threshold
+		self.next_collection = gc_threshold
+		self.allocations = 0
+		self.collect_pending = False
+		self.collections = 0
+		self.freed_blocks = 0
+		self.last_pause = 0.0
+		self.total_pause = 0.0
+		self.max_blocks = None
+		self.max_bytes = None
+		self.live_bytes = 0
+		self.limited = False
+		self.over_quota = False
+	
+	def set_quotas(self, max_blocks, max_bytes):
+		self.max_blocks = max_blocks
+		self.max_bytes = max_bytes
+		self.limited = max_blocks is not None or max_bytes is not None
+		self.over_quota = False
+		self.live_bytes = 0
+		if max_bytes is not None:
+			self.live_bytes = sum([block_bytes(block) for block in self.blocks.itervalues()])
+	
+	def check_quota(self, new_bytes):
+		# Checks one more block of new_bytes against the quotas. Blocks only held by garbage count until the next
+		# collection, which is asked for once the pool is 3/4 full. Past a quota the block is still added and
+		# over_quota is set, the allocating thread's quantum then ends and the domain collects before calling
+		# check_over_quota (see Frame.add_block). Raises QuotaExceeded only past HARD_QUOTA_FACTOR times a quota.
+		if self.max_blocks is not None:
+			if len(self.blocks) >= self.max_blocks * HARD_QUOTA_FACTOR:
+				raise vm_exception.QuotaExceeded("PoolBlocks", len(self.blocks), "Pool")
+			if len(self.blocks) >= self.max_blocks:
+				self.over_quota = True
+			if len(self.blocks) * 4 >= self.max_blocks * 3:
+				self.collect_pending = True
+		if self.max_bytes is not None:
+			if self.live_bytes + new_bytes > self.max_bytes * HARD_QUOTA_FACTOR:
+				raise vm_exception.QuotaExceeded("PoolBytes", self.live_bytes, "Pool")
+			if self.live_bytes + new_bytes > self.max_bytes:
+				self.over_quota = True
+			if (self.live_bytes + new_bytes) * 4 >= self.max_bytes * 3:
+				self.collect_pending = True
+	
+	def check_over_quota(self):
+		# Raises QuotaExceeded if the pool is still past a quota, call once it has been collected
+		self.over_quota = False
+		if self.max_blocks is not None and len(self.blocks) > self.max_blocks:
+			raise vm_exception.QuotaExceeded("PoolBlocks", len(self.blocks), "Pool")
+		if self.max_bytes is not None and self.live_bytes > self.max_bytes:
+			raise vm_exception.QuotaExceeded("PoolBytes", self.live_bytes, "Pool")
+	
+	def check_items(self, count):
+		# check_quota for an array of count items, before the host memory for it is taken
+		if self.max_bytes is not None:
+			self.check_quota(count * ITEM_BYTES)
 	
 	def add_block(self, block):
 		# Adds the block to this pool, and returns a RefValue
-		self.blocks[self.current_index] = block
-		ref_value = vm_values.RefValue(self.current_index, self)
-		self.current_index += 1
-		return ref_value
+		if self.limited:
+			new_bytes = 0
+			if self.max_bytes is not None:
+				new_bytes = block_bytes(block)
+			self.check_quota(new_bytes)
+			self.live_bytes += new_bytes
+		if self.free_indices:
+			index = self.free_indices.pop()
+		else:
+			index = self.current_index
+			self.current_index += 1
+		self.blocks[index] = block
+		self.allocations += 1
+		if self.allocations >= self.next_collection:
+			self.collect_pending = True
+		return vm_values.RefValue(index, block)
+	
+	def detach(self, value, roots):
+		# Takes the Objs and Arrays value refers to out of this pool, so they can be given to another pool with adopt.
+		# Graphs of up to DETACH_COPY_ITEMS fields and items are copied, costing no more than the walk over the
+		# graph itself. Larger graphs are moved when none of their blocks can be reached from the values in roots,
+		# which takes a walk over the pool like a collection, and copied when one can. Returns the value to adopt.
+		refs = graph_refs(value)
+		moved = [ref for ref in refs.itervalues() if movable(ref.target)]
+		if not moved:
+			return value
+		if sum([block_items(ref.target) for ref in moved]) <= DETACH_COPY_ITEMS or reaches(roots, refs):
+			copies = dict(refs)
+			for ref in moved:
+				copies[id(ref.target)] = vm_values.RefValue(None, copy_block(ref.target))
+			for ref in moved:
+				relink(copies[id(ref.target)].target, copies)
+			return copies[id(value.target)]
+		blocks = self.blocks
+		for ref in moved:
+			if blocks.get(ref.ref_index) is ref.target:
+				if self.max_bytes is not None:
+					self.live_bytes -= block_bytes(ref.target)
+				del blocks[ref.ref_index]
+				self.free_indices.append(ref.ref_index)
+		return value
+	
+	def adopt(self, value):
+		# Adds the Objs and Arrays of a value returned by detach to this pool, and returns the value referring to
+		# them here. Only the refs they hold are rewritten. The other blocks it refers to are added as they are.
+		refs = graph_refs(value)
+		if not refs:
+			return value
+		adopted = {}
+		for block_id, ref in refs.iteritems():
+			shared = self.shared
+			if not movable(ref.target) and shared is not None and shared.blocks.get(ref.ref_index) is ref.target:
+				adopted[block_id] = ref
+			else:
+				adopted[block_id] = self.add_block(ref.target)
+		for ref in refs.itervalues():
+			if movable(ref.target):
+				relink(ref.target, adopted)
+		return adopted[id(value.target)]
 	
 	def get_block(self, ref_index):
-		return self.blocks[ref_index]
\ No newline at end of file
+		if self.shared is not None and ref_index not in self.blocks:
+			return self.shared.get_block(ref_index)
+		return self.blocks[ref_index]
+	
+	def collect(self, roots):
+		# Frees every block that cannot be reached from the values in roots.
+		# Only call this between instructions (see Domain.collect_garbage), never from inside an opcode.
+		# Blocks of the shared pool are never freed, and as they only refer to each other are not traced.
+		start = time.time()
+		blocks = self.blocks
+		marked = set()
+		pending = list(roots)
+		while pending:
+			value = pending.pop()
+			if vm_values.isRefValue(value) and (value.ref_index not in marked) and (value.ref_index in blocks):
+				marked.add(value.ref_index)
+				pending.extend(blocks[value.ref_index].child_values())
+		freed = [index for index in blocks if index not in marked]
+		if self.max_bytes is not None:
+			self.live_bytes -= sum([block_bytes(blocks[index]) for index in freed])
+		for index in freed:
+			del blocks[index]
+		self.free_indices.extend(freed)
+		self.allocations = 0
+		self.next_collection = max(self.gc_threshold, len(blocks))
+		self.collect_pending = False
+		self.collections += 1
+		self.freed_blocks += len(freed)
+		self.last_pause = time.time() - start
+		self.total_pause += self.last_pause
+		return len(freed)
+	
+	def gc_stats(self):
+		return { 'collections':self.collections, 'live_blocks':len(self.blocks), 'freed_blocks':self.freed_blocks, 'last_pause':self.last_pause, 'total_pause':self.total_pause }
@@ -99,8 +99,9 @@ def generate_file_output(infos):
 	output += "</table></body></html>"
 	return output
 
-ol = parse_opcodes()
-fo = generate_file_output(ol)
-f = open("index.html","w")
-f.write(fo)
-f.close()
\ No newline at end of file
+if __name__ == "__main__":
+	ol = parse_opcodes()
+	fo = generate_file_output(ol)
+	f = open("index.html","w")
+	f.write(fo)
+	f.close()
\ No newline at end of file
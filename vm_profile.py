@@ -0,0 +1,118 @@
+# vm_profile.py - Virtual Machine Profiler
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import json
+import timeit
+
+import vm_values
+import vm_opcode
+
+class Profiler(object):
+	# Counts what a Domain executes, attached with Domain.attach_profiler. While attached the domain
+	# steps with Frame.step_profiled, which times each handler; once detached the domain is back on Frame.step.
+	# Fields:
+	#	domain: Domain - the domain being profiled, None if detached
+	#	opcode_counts: dict<int,int> - executions per opcode
+	#	opcode_seconds: dict<int,float> - cumulative handler wall time per opcode
+	#	site_hits: dict<(Proc,int),int> - executions per (proc, inst_ptr)
+	#	procs: dict<Proc,int> - the order in which procs were first executed
+	#	allocations: dict<int,int> - NEWOBJ executions per ref_index of the type being created
+	#	timer: func() -> float - the clock handlers are timed with
+	def __init__(self):
+		self.domain = None
+		self.opcode_counts = {}
+		self.opcode_seconds = {}
+		self.site_hits = {}
+		self.procs = {}
+		self.allocations = {}
+		self.timer = timeit.default_timer
+	
+	def observe_instruction(self, frame, inst_ptr, opcode, operand):
+		self.opcode_counts[opcode] = self.opcode_counts.get(opcode, 0) + 1
+		site = (frame.frame_proc, inst_ptr)
+		hits = self.site_hits.get(site)
+		if hits is None:
+			hits = 0
+			self.procs.setdefault(frame.frame_proc, len(self.procs))
+		self.site_hits[site] = hits + 1
+		if opcode == 61 and frame.eval_stack:
+			# NEWOBJ, the type is on top of the stack
+			type_ref_value = frame.eval_stack[-1]
+			if vm_values.isRefValue(type_ref_value):
+				self.allocations[type_ref_value.ref_index] = self.allocations.get(type_ref_value.ref_index, 0) + 1
+	
+	def add_time(self, opcode, seconds):
+		self.opcode_seconds[opcode] = self.opcode_seconds.get(opcode, 0.0) + seconds
+	
+	def reset(self):
+		self.opcode_counts.clear()
+		self.opcode_seconds.clear()
+		self.site_hits.clear()
+		self.procs.clear()
+		self.allocations.clear()
+	
+	def proc_names(self):
+		# Returns dict<Proc,String>, naming procs of the domain's modules by module and index and others by first execution
+		names = {}
+		if self.domain is not None:
+			for module in self.domain.modules:
+				for index, proc in enumerate(module.procs):
+					names[proc] = "{0}.procs[{1}]".format(module.module_id, index)
+		for proc, order in self.procs.items():
+			if proc not in names:
+				names[proc] = "proc#{0}".format(order)
+		return names
+	
+	def type_names(self):
+		# Returns dict<int,String> of the token of each type ref_index
+		names = {}
+		if self.domain is not None:
+			for token_value, type_ref_value in self.domain.tokens_map.items():
+				names[type_ref_value.ref_index] = repr(token_value)
+		return names
+	
+	def stats(self):
+		# Returns the profile as a dict of lists sorted with the most expensive first, ready for json
+		proc_names = self.proc_names()
+		type_names = self.type_names()
+		total_seconds = sum(self.opcode_seconds.values())
+		opcodes = []
+		for opcode, count in self.opcode_counts.items():
+			seconds = self.opcode_seconds.get(opcode, 0.0)
+			if opcode in vm_opcode.Opcodes:
+				name = vm_opcode.Opcodes[opcode][2]
+			elif opcode is None:
+				# The sentinel entries of Frame.code, past the end of the opcodes
+				name = "?"
+			else:
+				name = "?{0:02X}".format(opcode)
+			opcodes.append({ 'opcode':opcode, 'name':name, 'count':count, 'seconds':seconds, 'fraction':seconds / total_seconds if total_seconds else 0.0 })
+		opcodes.sort(key=lambda entry : (-entry['seconds'], -entry['count']))
+		sites = [{ 'proc':proc_names[proc], 'inst_ptr':inst_ptr, 'hits':hits } for (proc, inst_ptr), hits in self.site_hits.items()]
+		sites.sort(key=lambda entry : (-entry['hits'], entry['proc'], entry['inst_ptr']))
+		allocations = [{ 'type':type_names.get(ref_index, "<{0}>".format(ref_index)), 'count':count } for ref_index, count in self.allocations.items()]
+		allocations.sort(key=lambda entry : (-entry['count'], entry['type']))
+		return { 'total_seconds':total_seconds, 'opcodes':opcodes, 'sites':sites, 'allocations':allocations }
+	
+	def report(self, limit=20):
+		# Returns the profile as text, showing at most limit sites
+		stats = self.stats()
+		output = "Opcodes (total {0:.6f}s):".format(stats['total_seconds'])
+		output += "\n{0:>12} {1:>12} {2:>12} {3:>10} {4:>7}".format("name", "count", "seconds", "usec/op", "time")
+		for entry in stats['opcodes']:
+			output += "\n{0:>12} {1:>12} {2:>12.6f} {3:>10.3f} {4:>6.1f}%".format(entry['name'], entry['count'], entry['seconds'], 1e6 * entry['seconds'] / entry['count'], 100 * entry['fraction'])
+		output += "\nHot Sites:"
+		output += "\n{0:>24} {1:>8} {2:>12}".format("proc", "inst_ptr", "hits")
+		for entry in stats['sites'][:limit]:
+			output += "\n{0:>24} {1:>8} {2:>12}".format(entry['proc'], "{0:04X}".format(entry['inst_ptr']), entry['hits'])
+		output += "\nAllocations:"
+		for entry in stats['allocations']:
+			output += "\n{0:>24} {1:>12}".format(entry['type'], entry['count'])
+		return output
+	
+	def write_json(self, file_path):
+		f = open(file_path, "w")
+		try:
+			json.dump(self.stats(), f, indent=1, sort_keys=True)
+		finally:
+			f.close()
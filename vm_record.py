@@ -0,0 +1,113 @@
+# vm_record.py - Virtual Machine Binary Trace Recorder
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import sys
+import array
+import struct
+
+import vm_opcode
+import vm_print
+
+# File Format:
+#	header: Magic:4s, Version:uint32, ByteOrder:uint32 (1=little, 2=big), RecordFields:uint32
+#	records: RecordFields uint32 words per executed instruction, in the byte order of the header
+# Record Format: (inst_ptr, opcode, operand, cycle_count, stack_depth)
+Magic = "VMTR"
+Version = 1
+HeaderFormat = "<4sIII"
+RecordFields = 5
+RecordTypecode = "I"
+NoValue = 0xFFFFFFFF	# stored for a missing opcode or operand
+
+ByteOrders = { 'little' : 1, 'big' : 2 }
+
+class TraceRecorder(object):
+	# A Domain observer that appends a fixed width record per executed instruction to a file
+	# Fields:
+	#	file: file - the file records are appended to
+	#	buffer: array<uint32> - the records not yet written to file
+	#	flush_size: int - the buffer length that causes the buffer to be written
+	def __init__(self, file_path, buffer_records=4096):
+		self.file = open(file_path, "wb")
+		self.file.write(struct.pack(HeaderFormat, Magic, Version, ByteOrders[sys.byteorder], RecordFields))
+		self.buffer = array.array(RecordTypecode)
+		self.flush_size = buffer_records * RecordFields
+
+	def observe_instruction(self, frame, inst_ptr, opcode, operand):
+		buffer = self.buffer
+		buffer.append(inst_ptr)
+		if opcode is None:
+			buffer.append(NoValue)
+		else:
+			buffer.append(opcode)
+		if operand.__class__ is int:
+			buffer.append(operand & NoValue)
+		else:
+			buffer.append(NoValue)
+		buffer.append((frame.cycle_count + 1) & NoValue)
+		buffer.append(len(frame.eval_stack))
+		if len(buffer) >= self.flush_size:
+			self.flush()
+
+	def flush(self):
+		self.buffer.tofile(self.file)
+		self.file.flush()
+		del self.buffer[:]
+
+	def close(self):
+		self.flush()
+		self.file.close()
+
+def read_trace(file_path):
+	# Returns the records of a trace file as a list of (inst_ptr, opcode, operand, cycle_count, stack_depth)
+	# where a missing opcode or operand is None
+	f = open(file_path, "rb")
+	try:
+		header = f.read(struct.calcsize(HeaderFormat))
+		magic, version, byte_order, record_fields = struct.unpack(HeaderFormat, header)
+		if magic != Magic or version != Version or record_fields != RecordFields:
+			raise ValueError("{0} is not a version {1} trace file".format(file_path, Version))
+		words = array.array(RecordTypecode)
+		words.fromstring(f.read())
+	finally:
+		f.close()
+	if byte_order != ByteOrders[sys.byteorder]:
+		words.byteswap()
+	records = []
+	for index in range(0, len(words) - RecordFields + 1, RecordFields):
+		inst_ptr, opcode, operand, cycle_count, stack_depth = words[index:index + RecordFields]
+		if opcode == NoValue:
+			opcode = None
+		if operand == NoValue:
+			operand = None
+		records.append((inst_ptr, opcode, operand, cycle_count, stack_depth))
+	return records
+
+def render_record(record):
+	# Renders a record using the names and descriptions in vm_opcode.Opcodes
+	inst_ptr, opcode, operand, cycle_count, stack_depth = record
+	output = "{0:04}: {1:04X}".format(cycle_count, inst_ptr)
+	if opcode in vm_opcode.Opcodes:
+		opspec = vm_opcode.Opcodes[opcode]
+		output += " {0:>10}".format(opspec[2])
+	elif opcode is None:
+		output += " {0:>10}".format("-")
+	else:
+		output += " {0:>10}".format("?{0:02X}".format(opcode))
+	if operand is None:
+		output += "    "
+	else:
+		output += " {0:02X} ".format(operand)
+	output += " [depth={0}]".format(stack_depth)
+	if opcode in vm_opcode.Opcodes:
+		ext_info = vm_opcode.Opcodes[opcode][5]
+		output += " : {0}".format(ext_info['d'])
+		if ('sb' in ext_info) and ('sa' in ext_info):
+			output += " (" + vm_print.parse_stack_description_list(ext_info['sb'], ext_info['sa']) + ")"
+	return output
+
+def render_trace(file_path):
+	return "\n".join([render_record(record) for record in read_trace(file_path)])
+
+if __name__ == "__main__":
+	print render_trace(sys.argv[1])
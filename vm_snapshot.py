@@ -0,0 +1,366 @@
+# vm_snapshot.py - Virtual Machine Domain Snapshots
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Saves a quiescent Domain (one that is not inside run) so it can be restored without running the
+# program that built it again. Restoring costs one pass over the blocks and frames in the snapshot.
+
+import gc
+import sys
+import array
+import struct
+import marshal
+import itertools
+
+import vm_values
+import vm_blocks
+import vm_trace
+import vm_frame
+import vm_thread
+import vm_domain
+import vm_exception
+
+# File Format:
+#	header: Magic:4s, Version:uint32, ByteOrder:uint32 (1=little, 2=big) of the packed arrays
+#	state: one marshal.dumps document, see SnapshotWriter.document
+# Lists of values are written as (plain, ref_positions, ref_indices, others): plain holds the IntValues,
+# FloatValues and BoolValues, and None everywhere else; the refs are two packed arrays of positions and
+# ref_indices; others is a list of (position, VALUE_*, index) for tokens, procs and chars. Restoring a list of
+# values then needs no work per value beyond the refs.
+Magic = "VMSN"
+Version = 3
+HeaderFormat = "<4sII"
+MarshalVersion = 3
+IndexTypecode = "i"
+
+ByteOrders = { 'little' : 1, 'big' : 2 }
+
+# Value Kinds
+VALUE_TOKEN = 1		# index is into the token table
+VALUE_PROC = 2		# index is into the proc table
+VALUE_CHAR = 3		# index is the code point
+
+class SnapshotWriter(object):
+	# Flattens a Domain into tables of marshal friendly tuples, so no block is written inside another
+	# Fields:
+	#	domain: Domain - the domain being written
+	#	tokens: list<TokenValue> - the token table
+	#	token_indices: dict<TokenValue,int> - the index of each token in tokens
+	#	procs: list<Proc> - the proc table
+	#	proc_indices: dict<Proc,int> - the index of each proc in procs
+	def __init__(self, domain):
+		self.domain = domain
+		self.tokens = []
+		self.token_indices = {}
+		self.procs = []
+		self.proc_indices = {}
+	
+	def token_index(self, token_value):
+		index = self.token_indices.get(token_value)
+		if index is None:
+			index = self.token_indices[token_value] = len(self.tokens)
+			self.tokens.append(token_value)
+		return index
+	
+	def proc_index(self, proc):
+		index = self.proc_indices.get(proc)
+		if index is None:
+			index = self.proc_indices[proc] = len(self.procs)
+			self.procs.append(proc)
+		return index
+	
+	def values(self, values):
+		# Returns the packed form of a list of values
+		plain = []
+		ref_positions = array.array(IndexTypecode)
+		ref_indices = array.array(IndexTypecode)
+		others = []
+		for position, value in enumerate(values):
+			value_class = value.__class__
+			if value_class in (int, long, float, bool):
+				plain.append(value)
+				continue
+			plain.append(None)
+			if value_class is vm_values.RefValue:
+				ref_positions.append(position)
+				ref_indices.append(value.ref_index)
+			elif value is vm_values.Null:
+				pass
+			elif vm_values.isTokenValue(value):
+				others.append((position, VALUE_TOKEN, self.token_index(value)))
+			elif isinstance(value, vm_blocks.Proc):
+				others.append((position, VALUE_PROC, self.proc_index(value)))
+			elif vm_values.isCharValue(value):
+				others.append((position, VALUE_CHAR, ord(value)))
+			else:
+				raise vm_exception.VMException("InvalidOperationError", "UnsupportedValue", value, "Snapshot")
+		return (plain, ref_positions.tostring(), ref_indices.tostring(), others)
+	
+	def blocks(self):
+		# Returns the pool's blocks as tables per block type. The fields of every Obj are written as one list of values.
+		types = []
+		objs_refs = array.array(IndexTypecode)
+		objs_counts = array.array(IndexTypecode)
+		objs_fields = []
+		arrays = []
+		procs = []
+		channels = []
+		pool = self.domain.pool
+		pool_blocks = pool.blocks.items()
+		if pool.shared is not None:
+			# The image's blocks are written as the domain's own
+			pool_blocks.extend(pool.shared.blocks.items())
+		for ref_index, block in pool_blocks:
+			block_type = block.block_type
+			if block_type == vm_blocks.Obj.block_type:
+				objs_refs.append(ref_index)
+				objs_counts.append(len(block.instc_fields))
+				objs_fields.extend(block.instc_fields)
+			elif block_type == vm_blocks.Type.block_type:
+				types.append((ref_index, block.instc_fields_count, block.class_fields_count, block.type_id))
+			elif block_type == vm_blocks.Array.block_type:
+				if block.kind == vm_blocks.ARRAY_VALUE:
+					arrays.append((ref_index, block.kind, self.values(block.items)))
+				else:
+					arrays.append((ref_index, block.kind, block.items.tostring()))
+			elif block_type == vm_blocks.Proc.block_type:
+				procs.append((ref_index, self.proc_index(block)))
+			elif block_type == vm_blocks.Channel.block_type:
+				channels.append(self.channel(ref_index, block))
+			else:
+				raise vm_exception.VMException("InvalidOperationError", "UnsupportedBlock", ref_index, "Snapshot")
+		return (types, (objs_refs.tostring(), objs_counts.tostring(), self.values(objs_fields)), arrays, procs, channels)
+	
+	def channel(self, ref_index, channel):
+		# Returns (ref_index, capacity, owned, items, senders, receivers) of a channel, senders being (thread index, value)
+		# and receivers thread indices. Only this domain's threads are written. The values of a shared channel are
+		# held in no pool (see Pool.detach), so only a shared channel holding no refs can be written.
+		domain = self.domain
+		owned = channel.domain is domain
+		if not owned and channel.domain is not None:
+			raise vm_exception.VMException("InvalidOperationError", "UnsupportedBlock", ref_index, "Snapshot")
+		sent = list(channel.items) + [value for sender, value in channel.senders]
+		if not owned and any(vm_values.isRefValue(value) for value in sent):
+			raise vm_exception.VMException("InvalidOperationError", "UnsupportedValue", ref_index, "Snapshot")
+		thread_indices = dict((thread, index) for index, thread in enumerate(domain.threads))
+		senders = [(thread_indices[sender], self.values([value])) for sender, value in channel.senders if sender in thread_indices]
+		receivers = [thread_indices[receiver] for receiver in channel.receivers if receiver in thread_indices]
+		return (ref_index, channel.capacity, owned, self.values(list(channel.items)), senders, receivers)
+	
+	def module(self, module):
+		type_refs = dict((id(type_ref_value.block()), type_ref_value) for type_ref_value in self.domain.tokens_map.values())
+		types = []
+		for type_block in module.types:
+			if id(type_block) not in type_refs:
+				raise vm_exception.VMException("InvalidOperationError", "ModuleNotLoaded", module.module_id, "Snapshot")
+			types.append(type_refs[id(type_block)].ref_index)
+		return (module.module_id, types, [self.proc_index(proc) for proc in module.procs])
+	
+	def frame(self, frame, caller):
+		# A called frame's params are the top of its caller's eval stack, which is written once
+		if caller is not None and frame.params is caller.eval_stack:
+			params = None
+		else:
+			params = self.values(frame.params)
+		return (self.proc_index(frame.frame_proc), params, frame.params_base, self.values(frame.locals), frame.inst_ptr, frame.cycle_count, self.values(frame.eval_stack))
+	
+	def thread(self, thread):
+		frames = []
+		caller = None
+		for frame in thread.frame_stack:
+			frames.append(self.frame(frame, caller))
+			caller = frame
+		return (thread.thread_id, thread.state, thread.wake_time, thread.cycle_count, self.values([thread.return_value]), frames)
+	
+	def document(self):
+		# Returns the state of the domain, as a tuple of tables
+		domain = self.domain
+		pool = domain.pool
+		blocks = self.blocks()
+		tokens_map = [(self.token_index(token_value), type_ref_value.ref_index) for token_value, type_ref_value in domain.tokens_map.items()]
+		modules = [self.module(module) for module in domain.modules]
+		threads = [self.thread(thread) for thread in domain.threads]
+		thread_indices = dict((thread, index) for index, thread in enumerate(domain.threads))
+		run_queue = [thread_indices[thread] for thread in domain.run_queue]
+		sleepers = [(wake_time, sequence, thread_indices[thread]) for wake_time, sequence, thread in domain.sleepers]
+		# Procs are written last, as the tables above and their own consts may add procs
+		procs = []
+		while len(procs) < len(self.procs):
+			proc = self.procs[len(procs)]
+			procs.append((proc.params_count, proc.locals_count, self.values(proc.consts), list(proc.opcodes), list(proc.exception_table)))
+		tokens = [(token_value.module_id, token_value.type_id) for token_value in self.tokens]
+		pool_state = (pool.current_index, pool.free_indices, pool.gc_threshold, pool.next_collection, pool.allocations, pool.collections, pool.freed_blocks)
+		domain_state = (domain.quantum, domain.cycle_count, domain.sleepers_count, run_queue, sleepers)
+		return (domain_state, pool_state, tokens, procs, blocks, tokens_map, modules, threads)
+
+def write_snapshot(file_path, domain):
+	# Writes the state of a domain that is not running to a snapshot file. Observers, the profiler, the
+	# compiler and the trace sink are not part of the snapshot.
+	# A domain sharing a vm_image.Image is restored with its own copy of the image. A channel shared between
+	# domains is restored as a shared channel knowing only this domain's threads, and cannot hold refs.
+	document = SnapshotWriter(domain).document()
+	f = open(file_path, "wb")
+	try:
+		f.write(struct.pack(HeaderFormat, Magic, Version, ByteOrders[sys.byteorder]))
+		marshal.dump(document, f, MarshalVersion)
+	finally:
+		f.close()
+
+class SnapshotReader(object):
+	# Rebuilds a Domain from a snapshot document
+	# Fields:
+	#	domain: Domain - the domain being restored
+	#	byteswap: bool - True if the packed arrays were written in the other byte order
+	#	refs: list<RefValue> - the ref of each block, by ref_index
+	#	tokens: list<TokenValue> - the token table, interned in domain
+	#	procs: list<Proc> - the proc table
+	def __init__(self, domain, byteswap):
+		self.domain = domain
+		self.byteswap = byteswap
+		self.refs = []
+		self.tokens = []
+		self.procs = []
+	
+	def unpack(self, packed, typecode):
+		items = array.array(typecode)
+		items.fromstring(packed)
+		if self.byteswap:
+			items.byteswap()
+		return items
+	
+	def values(self, packed):
+		# Returns the list of values of a packed list of values
+		plain, ref_positions, ref_indices, others = packed
+		Null = vm_values.Null
+		values = [Null if value is None else value for value in plain]
+		refs = self.refs
+		for position, ref_index in itertools.izip(self.unpack(ref_positions, IndexTypecode), self.unpack(ref_indices, IndexTypecode)):
+			values[position] = refs[ref_index]
+		for position, kind, index in others:
+			if kind == VALUE_TOKEN:
+				values[position] = self.tokens[index]
+			elif kind == VALUE_CHAR:
+				values[position] = vm_values.CharValue(unichr(index))
+			else:
+				values[position] = self.procs[index]
+		return values
+	
+	def blocks(self, entry, current_index):
+		# Returns the pool's dict of blocks. Every block is created before any values are read, as values may refer to any block.
+		types, (objs_refs, objs_counts, objs_fields), arrays, procs, channels = entry
+		refs = self.refs = [None] * current_index
+		RefValue = vm_values.RefValue
+		objs_refs = self.unpack(objs_refs, IndexTypecode)
+		objs = [vm_blocks.Obj(0) for ref_index in objs_refs]
+		blocks = dict(itertools.izip(objs_refs, objs))
+		for ref_index, instc_fields_count, class_fields_count, type_id in types:
+			blocks[ref_index] = vm_blocks.Type(instc_fields_count, class_fields_count, type_id)
+		for ref_index, kind, items in arrays:
+			block = blocks[ref_index] = vm_blocks.Array(kind, 0)
+			if kind != vm_blocks.ARRAY_VALUE:
+				block.items = self.unpack(items, block.items.typecode)
+		for ref_index, proc_index in procs:
+			blocks[ref_index] = self.procs[proc_index]
+		for ref_index, capacity, owned, items, senders, receivers in channels:
+			blocks[ref_index] = vm_blocks.Channel(capacity, self.domain if owned else None)
+		for ref_index, block in blocks.iteritems():
+			refs[ref_index] = RefValue(ref_index, block)
+		fields = self.values(objs_fields)
+		offset = 0
+		for block, count in itertools.izip(objs, self.unpack(objs_counts, IndexTypecode)):
+			block.instc_fields = fields[offset:offset + count]
+			offset += count
+		for ref_index, kind, items in arrays:
+			if kind == vm_blocks.ARRAY_VALUE:
+				blocks[ref_index].items = self.values(items)
+		for ref_index, capacity, owned, items, senders, receivers in channels:
+			blocks[ref_index].items.extend(self.values(items))
+		return blocks
+	
+	def channel_threads(self, channels, blocks):
+		# Puts the restored threads back into the senders and receivers of the channels
+		threads = self.domain.threads
+		for ref_index, capacity, owned, items, senders, receivers in channels:
+			channel = blocks[ref_index]
+			channel.senders.extend([(threads[index], self.values(value)[0]) for index, value in senders])
+			channel.receivers.extend([threads[index] for index in receivers])
+	
+	def module(self, entry):
+		module_id, types, procs = entry
+		return vm_blocks.Module(module_id, [self.refs[ref_index].block() for ref_index in types], [self.procs[index] for index in procs])
+	
+	def thread(self, entry):
+		thread_id, state, wake_time, cycle_count, return_value, frames = entry
+		frame_stack = []
+		caller = None
+		for proc_index, params, params_base, locals, inst_ptr, frame_cycle_count, eval_stack in frames:
+			if params is None:
+				params = caller.eval_stack
+			else:
+				params = self.values(params)
+			if caller is None:
+				thread = vm_thread.Thread(self.domain, self.procs[proc_index], thread_id, params)
+				frame = thread.frame_stack[0]
+				frame.params = params
+				frame.params_base = params_base
+			else:
+				frame = vm_frame.Frame(thread, self.procs[proc_index], params, params_base)
+				frame_stack.append(frame)
+			frame.locals[:] = self.values(locals)
+			frame.inst_ptr = inst_ptr
+			frame.cycle_count = frame_cycle_count
+			frame.eval_stack[:] = self.values(eval_stack)
+			caller = frame
+		thread.frame_stack.extend(frame_stack)
+		thread.state = state
+		thread.wake_time = wake_time
+		thread.cycle_count = cycle_count
+		thread.return_value = self.values(return_value)[0]
+		return thread
+	
+	def restore(self, document):
+		domain_state, pool_state, tokens, procs, blocks, tokens_map, modules, threads = document
+		domain = self.domain
+		pool = domain.pool
+		self.tokens = [domain.intern_token(vm_values.TokenValue(module_id, type_id)) for module_id, type_id in tokens]
+		self.procs = [vm_blocks.Proc(params_count, locals_count, None, opcodes, list(exception_table)) for params_count, locals_count, consts, opcodes, exception_table in procs]
+		pool.current_index, free_indices, pool.gc_threshold, pool.next_collection, pool.allocations, pool.collections, pool.freed_blocks = pool_state
+		pool.free_indices = list(free_indices)
+		pool.collect_pending = pool.allocations >= pool.next_collection
+		pool.blocks = self.blocks(blocks, pool.current_index)
+		for proc, entry in zip(self.procs, procs):
+			proc.consts = self.values(entry[2])
+		for token_index, ref_index in tokens_map:
+			domain.tokens_map[self.tokens[token_index]] = self.refs[ref_index]
+		domain.modules = [self.module(entry) for entry in modules]
+		domain.threads = [self.thread(entry) for entry in threads]
+		self.channel_threads(blocks[4], pool.blocks)
+		domain.quantum, domain.cycle_count, domain.sleepers_count, run_queue, sleepers = domain_state
+		domain.run_queue.extend([domain.threads[index] for index in run_queue])
+		domain.sleepers = [(wake_time, sequence, domain.threads[index]) for wake_time, sequence, index in sleepers]
+		return domain
+
+def load_snapshot(file_path, trace_level=vm_trace.TRACE_OFF, trace_sink=None):
+	# Returns a new Domain in the state written by write_snapshot
+	f = open(file_path, "rb")
+	try:
+		header = f.read(struct.calcsize(HeaderFormat))
+		try:
+			magic, version, byte_order = struct.unpack(HeaderFormat, header)
+			if magic != Magic or version != Version:
+				raise ValueError(magic)
+			document = marshal.load(f)
+		except (struct.error, ValueError, EOFError, TypeError):
+			raise vm_exception.VMException("LoadError", "InvalidSnapshot", file_path, "Snapshot")
+	finally:
+		f.close()
+	domain = vm_domain.Domain({}, vm_trace.TRACE_OFF, trace_sink)
+	# Every restored block is live, so Python's cyclic collector would only walk them over and over
+	collector_enabled = gc.isenabled()
+	gc.disable()
+	try:
+		SnapshotReader(domain, byte_order != ByteOrders[sys.byteorder]).restore(document)
+	finally:
+		if collector_enabled:
+			gc.enable()
+	domain.trace_level = trace_level
+	return domain
@@ -6,38 +6,209 @@ import vm_trace
 import vm_frame
 import vm_domain
 import vm_exception
+import time
+
+# Thread States
+THREAD_RUNNING = 0		# in the domain's run queue
+THREAD_BLOCKED = 1		# waiting to be woken, costs nothing until then
+THREAD_HALTED = 2		# finished
+THREAD_YIELDED = 3		# running, but its quantum was ended early, only seen until Domain.run_thread returns
 
 class Thread(object):
 	# A thread object
 	# Fields:
 	#	domain: Domain - the domain this thread run in
+	#	thread_id: int - the index of this thread in domain.threads
 	#	frame_stack: list<Frame> - the frame stack
-	#	is_running: bool - the run status of the thread
-	def __init__(self, domain, proc):
+	#	state: int - the THREAD_* state of the thread
+	#	wake_time: float - when a paused thread is woken, None if it is not paused
+	#	cycle_count: int - the number of instructions run by this thread
+	#	free_frames: list<Frame> - returned frames, reused by the next calls
+	#	return_value: Value - the value returned by the thread's first frame, Null until it returns
+	#	error: VMException - the error no frame handled, which halted the thread, None if there was none
+	def __init__(self, domain, proc, thread_id=0, params=None):
 		self.domain = domain
+		self.thread_id = thread_id
 		self.frame_stack = []
-		self.is_running = True
-		self.call_proc(proc, [])
+		self.free_frames = []
+		self.state = THREAD_RUNNING
+		self.wake_time = None
+		self.cycle_count = 0
+		self.return_value = vm_values.Null
+		self.error = None
+		if params is None:
+			params = []
+		# The first frame's params may be replaced by TAILCALL, so the host's list is not used
+		self.call_proc(proc, list(params))
+	
+	@property
+	def is_running(self):
+		return self.state == THREAD_RUNNING
+	
+	@property
+	def is_blocked(self):
+		return self.state == THREAD_BLOCKED
 	
 	def current_frame(self):
 		return self.frame_stack[len(self.frame_stack) - 1]
 	
+	def run_quantum(self, quantum, frame_step):
+		# Runs up to quantum instructions using frame_step (one of the Frame.step methods),
+		# stopping early if the thread blocks or halts. Returns the number of instructions run.
+		# The instruction raising a VMException counts as run, see raise_error.
+		frame_stack = self.frame_stack
+		executed = 0
+		try:
+			while executed < quantum and self.state == THREAD_RUNNING:
+				try:
+					while executed < quantum and self.state == THREAD_RUNNING:
+						frame_step(frame_stack[-1])
+						executed += 1
+				except vm_exception.VMException as e:
+					executed += 1
+					self.raise_error(e)
+		finally:
+			self.cycle_count += executed
+			self.domain.cycle_count += executed
+		return executed
+	
+	def run_quantum_tiered(self, quantum, compiler):
+		# run_quantum for a domain with a vm_jit.Compiler. Calls and back-edges are counted until a proc is
+		# compiled, then frames at an entry of its compiled code run it in place of Frame.step.
+		frame_stack = self.frame_stack
+		executed = 0
+		try:
+			while executed < quantum and self.state == THREAD_RUNNING:
+				try:
+					while executed < quantum and self.state == THREAD_RUNNING:
+						frame = frame_stack[-1]
+						inst_ptr = frame.inst_ptr
+						compiled = frame.frame_proc.compiled
+						if compiled is None:
+							frame.step()
+							executed += 1
+							if frame.inst_ptr <= inst_ptr or inst_ptr == 0:
+								compiler.count(frame.frame_proc)
+						elif inst_ptr in compiled.entries:
+							executed += compiled.function(frame, quantum - executed)
+						else:
+							frame.step()
+							executed += 1
+				except vm_exception.VMException as e:
+					# compiled code returns to the interpreter before an instruction that raises
+					executed += 1
+					self.raise_error(e)
+		finally:
+			self.cycle_count += executed
+			self.domain.cycle_count += executed
+		return executed
+	
 	def step(self):
-		self.current_frame().step()
+		self.frame_stack[-1].step()
+	
+	def call_proc(self, proc, params, params_base=0):
+		# Runs proc in a new frame, its params being params[params_base:], which are not copied
+		if len(params) - params_base < proc.params_count:
+			raise vm_exception.VMException("InvalidOperationError", "TooFewParams", len(params) - params_base, "Thread")
+		quotas = self.domain.quotas
+		if quotas.frame_depth is not None and len(self.frame_stack) >= quotas.frame_depth:
+			raise vm_exception.QuotaExceeded("FrameDepth", len(self.frame_stack), "Thread")
+		# A called proc's params are the caller's eval stack, checked here as the caller may have grown it since its quantum began
+		if quotas.stack_depth is not None and self.frame_stack and len(params) > quotas.stack_depth:
+			raise vm_exception.QuotaExceeded("StackDepth", len(params), "Thread")
+		if self.domain.trace_level >= vm_trace.TRACE_INFO:
+			self.domain.trace_sink.write_info("Thread", "Procedure Called (params = {0}, consts = {1})".format(params[params_base:], proc.consts))
+		if self.free_frames:
+			frame = self.free_frames.pop()
+			frame.reset(proc, params, params_base)
+		else:
+			frame = vm_frame.Frame(self, proc, params, params_base)
+		self.frame_stack.append(frame)
 	
-	def call_proc(self, proc, params):
-		vm_trace.print_info("Thread", "Procedure Called (params = {0}, consts = {1})".format(params, proc.consts))
-		self.frame_stack.append(vm_frame.Frame(self, proc, params))
+	def tail_call_proc(self, proc):
+		# Runs proc in place of the current frame's proc, taking its params from the current eval stack
+		frame = self.frame_stack[-1]
+		if len(frame.eval_stack) < proc.params_count:
+			raise vm_exception.VMException("InvalidOperationError", "TooFewParams", len(frame.eval_stack), "Thread")
+		if self.domain.trace_level >= vm_trace.TRACE_INFO:
+			self.domain.trace_sink.write_info("Thread", "Procedure Tail Called (params = {0}, consts = {1})".format(frame.eval_stack[len(frame.eval_stack) - proc.params_count:], proc.consts))
+		frame.replace_proc(proc, proc.params_count)
 	
 	def ret_proc(self, ret_value):
-		vm_trace.print_info("Thread", "Procedure Returned (return value = {0})".format(ret_value))
-		self.frame_stack.pop()
+		if self.domain.trace_level >= vm_trace.TRACE_INFO:
+			self.domain.trace_sink.write_info("Thread", "Procedure Returned (return value = {0})".format(ret_value))
+		frame = self.frame_stack.pop()
 		if len(self.frame_stack) <= 0:
+			# The first frame is kept so the thread's final eval stack can still be read
+			self.frame_stack.append(frame)
+			self.return_value = ret_value
 			self.halt()
 		else:
+			# The params of a called proc are the top of the caller's eval stack
+			del frame.params[frame.params_base:]
+			frame.release()
+			self.free_frames.append(frame)
 			self.current_frame().push_eval_stack_value(ret_value)
 	
+	def raise_error(self, error):
+		# Continues at the handler of the top frame whose proc has a try region catching error, where the
+		# error was raised or at its call. The frames above it are returned from and its eval stack is replaced
+		# by the error's TokenValue(error_type, error_subtype). Only run once an instruction has raised, an
+		# instruction's frame being left with inst_ptr past it. Halts the thread if no frame handles error.
+		frame_stack = self.frame_stack
+		if isinstance(error, vm_exception.QuotaExceeded):
+			self.fail(error)
+			return
+		for depth in range(len(frame_stack) - 1, -1, -1):
+			frame = frame_stack[depth]
+			handler = frame.frame_proc.find_handler(frame.inst_ptr - 1, error.error_type)
+			if handler is not None:
+				break
+		else:
+			self.fail(error)
+			return
+		while len(frame_stack) > depth + 1:
+			frame = frame_stack.pop()
+			frame.release()
+			self.free_frames.append(frame)
+		frame = frame_stack[-1]
+		if self.domain.trace_level >= vm_trace.TRACE_INFO:
+			self.domain.trace_sink.write_info("Thread", "Error Handled (error = {0}.{1}, handler = {2})".format(error.error_type, error.error_subtype, handler))
+		# The called frames' params were the top of this eval stack
+		del frame.eval_stack[:]
+		frame.eval_stack.append(vm_values.TokenValue(error.error_type, error.error_subtype))
+		frame.inst_ptr = handler
+	
+	def fail(self, error):
+		# Halts the thread with an error no frame handled, the frames are left as they were for the host to read
+		self.error = error
+		self.domain.error = error
+		self.domain.trace_sink.write_error(error.error_class, error.error_type, error.error_subtype, error.error_info)
+		self.halt()
+	
 	def halt(self):
-		vm_trace.print_info("Thread", "Thread Halted.")
-		self.is_running = False
-	
\ No newline at end of file
+		if self.domain.trace_level >= vm_trace.TRACE_INFO:
+			self.domain.trace_sink.write_info("Thread", "Thread Halted.")
+		self.state = THREAD_HALTED
+	
+	def end_quantum(self):
+		# Ends the running quantum once the current instruction has run, see Domain.run_thread
+		if self.state == THREAD_RUNNING:
+			self.state = THREAD_YIELDED
+	
+	def wait(self):
+		# Blocks the thread until wake is called
+		self.state = THREAD_BLOCKED
+	
+	def pause(self, duration):
+		# Blocks the thread for duration seconds
+		self.state = THREAD_BLOCKED
+		self.wake_time = time.time() + duration
+		self.domain.schedule_wake(self, self.wake_time)
+	
+	def wake(self):
+		# Puts a blocked thread back on its domain's run queue
+		if self.state == THREAD_BLOCKED:
+			self.state = THREAD_RUNNING
+			self.wake_time = None
+			self.domain.schedule_thread(self)
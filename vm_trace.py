@@ -1,6 +1,16 @@
 # vm_trace.py - Virtual Machine Trace Helpers
 # (c) 2013, Bryan Stockus. All Rights Reserved.
 
+import re
+import collections
+
+# Trace Levels (picked when a Domain is built)
+TRACE_OFF = 0			# errors only, the step loop makes no trace calls
+TRACE_INFO = 1			# domain, thread and procedure events
+TRACE_INSTRUCTION = 2	# every executed instruction
+
+TermPattern = re.compile("\007|\033\\[[0-9;]*m")
+
 def term(cmd):
 	return "\033[" + cmd + "m"
 def termn(cmds):
@@ -9,20 +19,91 @@ def termn(cmds):
 		output += "\033[" + s + "m"
 	return output
 
-def print_error(error_class, error_type, error_reason, error_description):
-	print ("\007" + termn(['91','1']) + "[ERROR:" + term('4') + "{3}" + termn(['0','91','1']) + "] {0}: {1} ({2})" + term('0')).format(error_type, error_reason, error_description, error_class)
+def strip_term(text):
+	# Removes the terminal escape codes from text
+	return TermPattern.sub("", text)
 
-def print_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
+def format_error(error_class, error_type, error_reason, error_description):
+	return ("\007" + termn(['91','1']) + "[ERROR:" + term('4') + "{3}" + termn(['0','91','1']) + "] {0}: {1} ({2})" + term('0')).format(error_type, error_reason, error_description, error_class)
+
+def format_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
 	output = ( termn(['94','1']) + "[TRACE:" + term('4') + "Frame" + termn(['0', '1', '94']) + "]" + term('0') + " " + term('94') + "{2:04}: " + termn(['0', '92']) + "{0:04X}" + term('0') + " " + term('1') + "{1:>10}").format(inst_ptr, opcode, cycle_count)
 	if operand == "":
 		output += "    " + term('0')
+	elif isinstance(operand, tuple):
+		output += (" {0} " + term('0')).format(" ".join(["{0:02X}".format(word) for word in operand]))
 	else:
 		output += (" {0:02X} " + term('0')).format(operand)
 	if evalsShow:
 		output += ("(" + term('93') + "{0} => {1}" + term('0') + ") ").format(desc, results)
 	if localsShow:
 		output += ("(" + term('95') + "{0}" + term('0') + ")").format(locals)
-	print output
+	return output
+
+def format_info(trace_class, trace_message):
+	return (termn(['37','1']) + "[INFO:" + term('4') + "{0}" + termn(['0', '37', '1']) + "]" + term('0') + " " + term('37') + "{1}" + term('0')).format(trace_class, trace_message)
+
+def print_error(error_class, error_type, error_reason, error_description):
+	print format_error(error_class, error_type, error_reason, error_description)
+
+def print_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
+	print format_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count)
 
 def print_info(trace_class, trace_message):
-	print (termn(['37','1']) + "[INFO:" + term('4') + "{0}" + termn(['0', '37', '1']) + "]" + term('0') + " " + term('37') + "{1}" + term('0')).format(trace_class, trace_message)
\ No newline at end of file
+	print format_info(trace_class, trace_message)
+
+# Trace Sinks
+# A sink receives the trace output of a Domain through write_error, write_frame_trace and write_info,
+# which take the same arguments as the print_* functions above.
+
+class TerminalSink(object):
+	# Prints colored trace output to stdout
+	def write_error(self, error_class, error_type, error_reason, error_description):
+		print_error(error_class, error_type, error_reason, error_description)
+	def write_frame_trace(self, inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
+		print_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count)
+	def write_info(self, trace_class, trace_message):
+		print_info(trace_class, trace_message)
+
+class FileSink(object):
+	# Writes plain trace output to a file
+	# Fields:
+	#	file: file - the file the trace is written to
+	def __init__(self, file_path):
+		self.file = open(file_path, "w")
+	def write_line(self, line):
+		self.file.write(strip_term(line) + "\n")
+	def write_error(self, error_class, error_type, error_reason, error_description):
+		self.write_line(format_error(error_class, error_type, error_reason, error_description))
+	def write_frame_trace(self, inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
+		self.write_line(format_frame_trace(inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count))
+	def write_info(self, trace_class, trace_message):
+		self.write_line(format_info(trace_class, trace_message))
+	def close(self):
+		self.file.close()
+
+class RingBufferSink(object):
+	# Keeps the last size trace entries in memory, formatting them only when asked for
+	# Fields:
+	#	entries: deque<tuple> - the (print function, args) of each trace entry
+	def __init__(self, size):
+		self.entries = collections.deque(maxlen=size)
+	def write_error(self, error_class, error_type, error_reason, error_description):
+		self.entries.append((format_error, (error_class, error_type, error_reason, error_description)))
+	def write_frame_trace(self, inst_ptr, opcode, operand, desc, results, locals, evalsShow, localsShow, cycle_count):
+		# results and locals are the frame's live lists, so they are copied
+		self.entries.append((format_frame_trace, (inst_ptr, opcode, operand, desc, list(results), list(locals), evalsShow, localsShow, cycle_count)))
+	def write_info(self, trace_class, trace_message):
+		self.entries.append((format_info, (trace_class, trace_message)))
+	def lines(self):
+		# Returns the buffered entries as plain text lines, oldest first
+		return [strip_term(format_entry(*args)) for format_entry, args in self.entries]
+	def replay(self, sink):
+		# Writes the buffered entries to another sink, oldest first
+		for format_entry, args in self.entries:
+			if format_entry == format_error:
+				sink.write_error(*args)
+			elif format_entry == format_frame_trace:
+				sink.write_frame_trace(*args)
+			else:
+				sink.write_info(*args)
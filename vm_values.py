@@ -1,38 +1,61 @@
 # vm_values.py - Virtual Machine Value Type Definitions
 # (c) 2013, Bryan Stockus. All Rights Reserved.
 
-import vm_pool
+import operator
 
 class NullValue(object):
-	# defines a null
+	# defines a null, use the Null singleton rather than creating new instances
+	__slots__ = ()
 	def __str__(self):
 		return "<NullValue>"
 	def __repr__(self):
 		return "Null"
-	
-class TokenValue(object):
-	# defines a type token value
-	def __init__(self, moduleId, typeId):
-		self.moduleId = moduleId
-		self.typeId = typeId
+	def __reduce__(self):
+		# unpickles as the Null singleton
+		return "Null"
+
+Null = NullValue()
+
+class TokenValue(tuple):
+	# defines a type token value, a (module_id, type_id) pair so hashing and comparing tokens
+	# runs at C speed (see Domain.intern_token)
+	# Fields:
+	#	module_id:String - the id of the module defining the type
+	#	type_id:String - the id of the type in its module
+	__slots__ = ()
+	def __new__(cls, moduleId, typeId):
+		return tuple.__new__(cls, (moduleId, typeId))
+	module_id = property(operator.itemgetter(0))
+	type_id = property(operator.itemgetter(1))
 	def moduleId(self):
-		return self.moduleId
+		return self[0]
 	def typeId(self):
-		return self.typeId
+		return self[1]
+	def __reduce__(self):
+		return (TokenValue, (self[0], self[1]))
 	def __repr__(self):
-		return "{0}.{1}".format(self.moduleId, self.typeId)
+		return "{0}.{1}".format(self[0], self[1])
+
+class CharValue(unicode):
+	# defines a char value, a single unicode code point
+	__slots__ = ()
+	def __repr__(self):
+		return repr(unicode(self))[1:]
+	def __reduce__(self):
+		return (CharValue, (unicode(self),))
 
 class RefValue(object):
 	# Fields:
-	#	ref_index:uint - the reference index to the block
-	#	pool:Pool - the pool this block is stored in
-	def __init__(self, ref_index, pool):
+	#	ref_index:uint - the reference index to the block in its pool
+	#	target:Block - the block itself, so block() needs no pool lookup
+	__slots__ = ('ref_index', 'target')
+	def __init__(self, ref_index, target):
 		self.ref_index = ref_index
-		self.pool = pool
+		self.target = target
 	def __repr__(self):
 		return "<{0}>".format(self.ref_index)
 	def block(self):
-		return self.pool.get_block(self.ref_index)
+		return self.target
 
 def isNullValue(object):
 	if isinstance(object, NullValue):
@@ -41,7 +64,8 @@ def isNullValue(object):
 		return False
 
 def isIntValue(object):
-	if isinstance(object, int):
+	# bools are ints to Python, but are not IntValues
+	if isinstance(object, (int, long)) and not isinstance(object, bool):
 		return True
 	else :
 		return False
@@ -58,6 +82,12 @@ def isBoolValue(object):
 	else :
 		return False
 
+def isCharValue(object):
+	if isinstance(object, CharValue):
+		return True
+	else :
+		return False
+
 def isTokenValue(object):
 	if isinstance(object, TokenValue):
 		return True
@@ -70,18 +100,21 @@ def isRefValue(object):
 	else:
 		return False
 
+# Format: { type:String : check:func(value) -> bool }
+# The check of each type letter, handlers look theirs up once when they are defined
+ValueTypeChecks = {
+	'v' : lambda value : True,
+	'n' : isNullValue,
+	'i' : isIntValue,
+	'f' : isFloatValue,
+	'b' : isBoolValue,
+	'c' : isCharValue,
+	't' : isTokenValue,
+	'r' : isRefValue
+}
+
 def checkTypeOfValue(type, value):
-	if type == 'v':
-		return True
-	elif (type == 'n') and isNullValue(value):
-		return True
-	elif (type == 'i') and isIntValue(value):
-		return True
-	elif (type == 'b') and isBoolValue(value):
-		return True
-	elif (type == 't') and isTokenValue(value):
-		return True
-	elif (type == 'r') and isRefValue(value):
-		return True
+	if type in ValueTypeChecks:
+		return ValueTypeChecks[type](value)
 	else:
-		return False
\ No newline at end of file
+		return False
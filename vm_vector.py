@@ -0,0 +1,238 @@
+# vm_vector.py - Virtual Machine Columnar Runner
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+#
+# Runs one Proc over many rows of params given as columns, see run_columns. Straight-line procs of the
+# integer, float, compare and conversion opcodes run elementwise over whole columns with numpy, everything
+# else runs row by row on the interpreter. numpy is optional, without it every row is interpreted.
+
+import vm_values
+import vm_opcode
+import vm_verify
+import vm_domain
+import vm_thread
+import vm_exception
+
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+INT_MIN = -2 ** 63
+INT_MAX = 2 ** 63 - 1
+
+# Column dtypes of the value letters (see vm_verify.value_letter) that can be vectorized
+ColumnTypes = { 'I':'int64', 'F':'float64', 'B':'bool' }
+
+# Format: { opcode:int : (operation:func(a[, b]) -> column, set_aside:func(a[, b], results) -> mask) }
+# a is the top of the stack, as with vm_opcode. set_aside returns the rows whose results numpy cannot give the
+# way the interpreter would, because they overflow 64 bits or raise, None if there are none.
+VectorOperations = {
+	30 : (lambda a, b : a + b, lambda a, b, r : ((a ^ r) & (b ^ r)) < 0),
+	31 : (lambda a, b : a - b, lambda a, b, r : ((a ^ b) & (a ^ r)) < 0),
+	32 : (lambda a, b : a * b, lambda a, b, r : numpy.abs(numpy.multiply(a, b, dtype='float64')) >= 2.0 ** 62),
+	33 : (lambda a, b : numpy.floor_divide(a, numpy.where(b == 0, 1, b)), lambda a, b, r : (b == 0) | ((a == INT_MIN) & (b == -1))),
+	34 : (lambda a : -a, lambda a, r : a == INT_MIN),
+	35 : (lambda a : a + 1, lambda a, r : a == INT_MAX),
+	36 : (lambda a : a - 1, lambda a, r : a == INT_MIN),
+	44 : (lambda a, b : a == b, None),
+	45 : (lambda a, b : a != b, None),
+	46 : (lambda a, b : a < b, None),
+	47 : (lambda a, b : a <= b, None),
+	48 : (lambda a, b : a > b, None),
+	49 : (lambda a, b : a >= b, None),
+	81 : (lambda a : numpy.asarray(a, 'float64'), None),
+	83 : (lambda a : a != 0, None),
+	84 : (lambda a : numpy.asarray(a, 'int64'), None),
+	86 : (lambda a : numpy.trunc(numpy.where(numpy.isfinite(a), a, 0.0)).astype('int64'), lambda a, r : ~numpy.isfinite(a) | (numpy.abs(a) >= 2.0 ** 63)),
+	100 : (lambda a, b : a + b, None),
+	101 : (lambda a, b : a - b, None),
+	102 : (lambda a, b : a * b, None),
+	103 : (lambda a, b : a / numpy.where(b == 0.0, 1.0, b), lambda a, b, r : b == 0.0),
+	104 : (lambda a : -a, None),
+	105 : (lambda a, b : a == b, None),
+	106 : (lambda a, b : a != b, None),
+	107 : (lambda a, b : a < b, None),
+	108 : (lambda a, b : a <= b, None),
+	109 : (lambda a, b : a > b, None),
+	110 : (lambda a, b : a >= b, None)
+}
+
+class Unsupported(Exception):
+	# Raised while vectorizing a proc that must be interpreted row by row
+	pass
+
+def column_array(column):
+	# Returns (letter, array) of a column of params, raising Unsupported if its values are not all of one vectorized type
+	if isinstance(column, numpy.ndarray):
+		letter = array_letter(column)
+		if letter not in ColumnTypes:
+			raise Unsupported()
+		return letter, column.astype(ColumnTypes[letter], copy=False)
+	letters = set(vm_verify.value_letter(value) for value in column)
+	if len(letters) != 1:
+		raise Unsupported()
+	letter = letters.pop()
+	if letter not in ColumnTypes:
+		raise Unsupported()
+	try:
+		return letter, numpy.array(column, ColumnTypes[letter])
+	except OverflowError:
+		raise Unsupported()
+
+def array_letter(array):
+	# Returns the value letter of a numpy array or scalar of one of the ColumnTypes
+	for letter, dtype in ColumnTypes.items():
+		if array.dtype.kind == numpy.dtype(dtype).kind:
+			return letter
+	return 'V'
+
+def constant_value(value):
+	# Returns (letter, value) of a constant, vectorized types being converted to numpy scalars
+	letter = vm_verify.value_letter(value)
+	if letter in ColumnTypes:
+		try:
+			return letter, numpy.array(value, ColumnTypes[letter])[()]
+		except OverflowError:
+			raise Unsupported()
+	return letter, value
+
+def input_letter(in_type):
+	# Returns the value letter checked by an operation's in_type, None for any Value
+	if in_type == 'v':
+		return None
+	return in_type.upper()
+
+def vectorize(proc, columns, rows):
+	# Runs proc over every row at once, returning (results, set_aside) where results is the value column
+	# returned by RET (a numpy array, or a constant of any type) and set_aside the mask of rows to interpret.
+	# Raises Unsupported if proc is not straight-line code of VectorOperations or the params do not fit.
+	if len(columns) < proc.params_count:
+		raise Unsupported()
+	params = [column_array(column) for column in columns]
+	local_values = [('N', vm_values.Null)] * proc.locals_count
+	stack = []
+	set_aside = numpy.zeros(rows, 'bool')
+	opcodes = proc.opcodes
+	inst_ptr = 0
+	while inst_ptr < len(opcodes):
+		opcode = opcodes[inst_ptr]
+		if opcode not in vm_opcode.Opcodes:
+			raise Unsupported()
+		opspec = vm_opcode.Opcodes[opcode]
+		operand = None
+		if opspec[0]:
+			if inst_ptr + 1 >= len(opcodes):
+				raise Unsupported()
+			operand = opcodes[inst_ptr + 1]
+			inst_ptr += 2
+		else:
+			inst_ptr += 1
+		if opcode == 0:
+			continue
+		elif opcode == 1:
+			if operand > len(stack):
+				raise Unsupported()
+			del stack[len(stack) - operand:]
+		elif opcode == 2:
+			if not stack:
+				raise Unsupported()
+			stack.append(stack[-1])
+		elif opcode == 20:
+			if not 0 <= operand < len(proc.consts):
+				raise Unsupported()
+			stack.append(constant_value(proc.consts[operand]))
+		elif opcode == 21:
+			if not 0 <= operand < len(params):
+				raise Unsupported()
+			stack.append(params[operand])
+		elif opcode == 22:
+			if not 0 <= operand < len(local_values):
+				raise Unsupported()
+			stack.append(local_values[operand])
+		elif opcode == 23:
+			if not 0 <= operand < len(local_values) or not stack:
+				raise Unsupported()
+			local_values[operand] = stack.pop()
+		elif 24 <= opcode <= 29:
+			stack.append(constant_value(opspec[1].operation()))
+		elif opcode == 10:
+			return vm_values.Null, set_aside
+		elif opcode == 99:
+			if not stack:
+				raise Unsupported()
+			return stack[-1][1], set_aside
+		elif opcode in VectorOperations:
+			operation, aside = VectorOperations[opcode]
+			in_types = opspec[1].in_types
+			if len(stack) < len(in_types):
+				raise Unsupported()
+			values = []
+			for in_type in in_types:
+				letter, value = stack.pop()
+				if letter != input_letter(in_type):
+					# Every row would raise InvalidValueTypeOnEvalStack
+					raise Unsupported()
+				values.append(value)
+			with numpy.errstate(all='ignore'):
+				results = operation(*values)
+				if aside is not None:
+					set_aside |= aside(*(values + [results]))
+			stack.append((array_letter(results), results))
+		else:
+			raise Unsupported()
+	raise Unsupported()
+
+def interpret_rows(proc, columns, rows, token_types, trace_sink, values, errors):
+	# Runs proc once per row in rows on the interpreter, filling in values and errors. The rows share a Domain.
+	domain = vm_domain.Domain(token_types, trace_sink=trace_sink)
+	columns = [list(column) if numpy is None or not isinstance(column, numpy.ndarray) else column.tolist() for column in columns]
+	for row in rows:
+		try:
+			thread = vm_thread.Thread(domain, proc, 0, [column[row] for column in columns])
+		except vm_exception.VMException as e:
+			errors[row] = e
+			continue
+		domain.threads = [thread]
+		while thread.state == vm_thread.THREAD_RUNNING:
+			domain.run_thread(thread, domain.quantum)
+		if thread.error is not None:
+			errors[row] = thread.error
+		elif thread.state == vm_thread.THREAD_BLOCKED:
+			errors[row] = vm_exception.VMException("InvalidOperationError", "ThreadBlocked", row, "Vector")
+		else:
+			values[row] = thread.return_value
+		domain.threads = []
+		if domain.pool.collect_pending:
+			# The values returned so far may refer to blocks of the pool, so are roots too
+			domain.pool.collect(domain.gc_roots() + values)
+
+def run_columns(proc, columns, rows=None, token_types=None, trace_sink=None):
+	# Runs proc once per row of params, columns holding one sequence (or numpy array) per param, all rows long.
+	# rows defaults to the length of the first column. Returns (values, errors), values being the list of
+	# the values each row returned with RET (Null if it halted otherwise or raised) and errors the dict<int,VMException>
+	# of the rows raising an error no frame handled, which are also written to trace_sink (see Domain).
+	# Results match running each row on its own Domain.
+	if rows is None:
+		rows = len(columns[0]) if columns else 0
+	if token_types is None:
+		token_types = {}
+	values = [vm_values.Null] * rows
+	errors = {}
+	pending = range(rows)
+	if numpy is not None and rows > 0:
+		try:
+			results, set_aside = vectorize(proc, columns, rows)
+			if isinstance(results, numpy.ndarray) and results.ndim:
+				values = results.tolist()
+			elif isinstance(results, numpy.generic):
+				values = [results.item()] * rows
+			else:
+				values = [results] * rows
+			pending = numpy.flatnonzero(set_aside).tolist()
+			for row in pending:
+				values[row] = vm_values.Null
+		except Unsupported:
+			pass
+	if pending:
+		interpret_rows(proc, columns, pending, token_types, trace_sink, values, errors)
+	return values, errors
@@ -0,0 +1,268 @@
+# vm_verify.py - Virtual Machine Bytecode Verifier
+# (c) 2013, Bryan Stockus. All Rights Reserved.
+
+import vm_values
+import vm_blocks
+import vm_opcode
+import vm_exception
+
+# Value Letters (as used by the 'sb'/'sa' stack descriptors in vm_opcode.Opcodes)
+# 'V' is a value of unknown type, 'R' a ref to an unknown kind of block
+RefLetters = set(['R', 'A', 'O', 'Y', 'Z'])
+
+# Format: { opcode:int : inputs:list<letter> } (last letter is the top of the stack)
+# Input types of opcodes not built by def_op_unary/def_op_binary, the 'sb' descriptors only give their count
+StackInputs = {
+	12 : ['V'],			# PAUSE takes an IntValue or a FloatValue
+	14 : ['B'],			# BR_TRUE
+	15 : ['B'],			# BR_FALSE
+	53 : ['A', 'I'],	# LD_ITEM
+	54 : ['A', 'I', 'V'],	# ST_ITEM
+	57 : ['A'],			# LD_COUNT
+	56 : ['Z', 'V'],	# ST_FIELD
+	58 : ['T'],			# LD_TYPE
+	60 : ['I'],			# NEWARRAY
+	61 : ['Y'],			# NEWOBJ
+	62 : ['A', 'V'],	# AFILL
+	63 : ['A', 'I', 'A', 'I', 'I'],	# ACOPY
+	64 : ['A'],			# ASUM
+	65 : ['A'],			# AMIN
+	66 : ['A'],			# AMAX
+	67 : ['A', 'A'],	# AOP
+	130 : ['I'],		# NEWCHAN
+	131 : ['R', 'V'],	# SEND
+	132 : ['R'],		# RECV
+	133 : ['R'],		# TRY_RECV
+	200 : ['Z']			# LD_CONST_ST_FIELD
+}
+
+# Format: { opcode:int : stack_after:func(operand, consts, popped:list<letter>) -> list<letter> }
+# Opcodes whose results depend on their operand or inputs rather than their 'sa' descriptor
+StackAfterOverrides = {
+	2 : lambda operand, consts, popped : [popped[0], popped[0]],		# DUP
+	20 : lambda operand, consts, popped : [value_letter(consts[operand])],	# LD_CONST
+	21 : lambda operand, consts, popped : ['V'],						# LD_PARAM
+	58 : lambda operand, consts, popped : ['Y'],						# LD_TYPE
+	61 : lambda operand, consts, popped : ['O']							# NEWOBJ
+}
+
+# Opcodes that end a path through the proc
+StopOpcodes = set([10, 17, 99])		# HALT, TAILCALL, RET
+
+# Format: { opcode:int : handler:func(frame, opcode, operand) }
+# Unchecked handlers of opcodes whose only checks are the ones the verifier proves
+UncheckedHandlers = {
+	2 : vm_opcode.op_DUP_UNCHECKED,
+	13 : vm_opcode.op_BR_UNCHECKED,
+	14 : vm_opcode.op_BR_TRUE_UNCHECKED,
+	15 : vm_opcode.op_BR_FALSE_UNCHECKED,
+	21 : vm_opcode.op_LD_PARAM_UNCHECKED,
+	22 : vm_opcode.op_LD_LOCAL_UNCHECKED,
+	23 : vm_opcode.op_ST_LOCAL_UNCHECKED
+}
+
+def value_letter(value):
+	if vm_values.isNullValue(value):
+		return 'N'
+	elif vm_values.isBoolValue(value):
+		return 'B'
+	elif vm_values.isIntValue(value):
+		return 'I'
+	elif vm_values.isFloatValue(value):
+		return 'F'
+	elif vm_values.isCharValue(value):
+		return 'C'
+	elif vm_values.isTokenValue(value):
+		return 'T'
+	elif vm_values.isRefValue(value):
+		return 'R'
+	return 'V'
+
+def stack_inputs(opcode, operand):
+	# Returns the letters of the values the opcode pops, the last letter being the top of the stack
+	if opcode == 1:
+		# POP takes its count from the operand
+		return ['V'] * operand
+	elif opcode in (16, 17):
+		# CALL and TAILCALL take their callee's params, operand being its params_count
+		return ['V'] * operand
+	elif opcode in StackInputs:
+		return StackInputs[opcode]
+	in_types = getattr(vm_opcode.Opcodes[opcode][1], 'in_types', None)
+	if in_types is not None:
+		# in_types[0] is checked against the top of the stack
+		return [in_type.upper() for in_type in reversed(in_types)]
+	return ['V'] * len(vm_opcode.Opcodes[opcode][5]['sb'])
+
+def proc_params_count(proc, inst_ptr, index):
+	# Returns the params_count of the Proc a CALL or TAILCALL takes from consts(index)
+	if index >= len(proc.consts):
+		raise verify_error("ConstIndexOutOfBounds", inst_ptr)
+	if not isinstance(proc.consts[index], vm_blocks.Proc):
+		raise verify_error("ConstIsNotProc", inst_ptr)
+	return proc.consts[index].params_count
+
+def letter_accepts(required, actual):
+	# False only if a value of type actual is certain to fail a check for type required
+	if required == 'V' or actual == 'V' or required == actual:
+		return True
+	if required in RefLetters and actual in RefLetters:
+		return True
+	if required == 'U' and actual == 'I':
+		return True
+	return False
+
+def merge_letters(letters_a, letters_b):
+	return tuple([a if a == b else 'V' for a, b in zip(letters_a, letters_b)])
+
+def verify_error(subtype, inst_ptr):
+	return vm_exception.VMException("VerificationError", subtype, inst_ptr, "Verifier")
+
+def instruction_effect(proc, inst_ptr, opcode, operand, stack, locals):
+	# Returns (stack, locals, popped) after the instruction at inst_ptr, given the letters before it
+	opspec = vm_opcode.Opcodes[opcode]
+	if opcode == 20 and operand >= len(proc.consts):
+		raise verify_error("ConstIndexOutOfBounds", inst_ptr)
+	if opcode == 21 and operand >= proc.params_count:
+		raise verify_error("ParamIndexOutOfBounds", inst_ptr)
+	if opcode in (22, 23) and operand >= proc.locals_count:
+		raise verify_error("LocalIndexOutOfBounds", inst_ptr)
+	if opcode == 60 and operand not in vm_blocks.ArrayKinds:
+		raise verify_error("InvalidArrayKind", inst_ptr)
+	if opcode == 67 and vm_opcode.elementwise_operation(operand) is None:
+		raise verify_error("InvalidOperandOpcode", inst_ptr)
+	if opcode == 200 and operand[0] >= len(proc.consts):
+		raise verify_error("ConstIndexOutOfBounds", inst_ptr)
+	if opcode == 201:
+		if max(operand) >= proc.locals_count:
+			raise verify_error("LocalIndexOutOfBounds", inst_ptr)
+		if not (letter_accepts('I', locals[operand[0]]) and letter_accepts('I', locals[operand[1]])):
+			raise verify_error("InvalidValueType", inst_ptr)
+	if opcode in (16, 17):
+		inputs = stack_inputs(opcode, proc_params_count(proc, inst_ptr, operand))
+	else:
+		inputs = stack_inputs(opcode, operand)
+	if len(inputs) > len(stack):
+		raise verify_error("EvalStackUnderflow", inst_ptr)
+	popped = list(stack[len(stack) - len(inputs):])
+	for required, actual in zip(inputs, popped):
+		if not letter_accepts(required, actual):
+			raise verify_error("InvalidValueType", inst_ptr)
+	stack = stack[:len(stack) - len(inputs)]
+	if opcode == 22:
+		pushed = [locals[operand]]
+	elif opcode == 23:
+		locals = locals[:operand] + (popped[0],) + locals[operand + 1:]
+		pushed = []
+	elif opcode in StackAfterOverrides:
+		pushed = StackAfterOverrides[opcode](operand, proc.consts, popped)
+	else:
+		pushed = [sa[0].replace('U', 'I') for sa in opspec[5]['sa']]
+	return (stack + tuple(pushed), locals, popped)
+
+def successors(proc, inst_ptr, opcode, operand, next_ptr):
+	# Returns the instruction pointers that can run after the instruction at inst_ptr
+	if opcode in StopOpcodes:
+		return []
+	elif opcode in vm_opcode.BranchOpcodes:
+		if operand > len(proc.opcodes):
+			raise verify_error("BranchTargetOutOfBounds", inst_ptr)
+		if vm_opcode.BranchOpcodes[opcode]:
+			return [next_ptr, operand]
+		return [operand]
+	return [next_ptr]
+
+def analyze_proc(proc):
+	# Walks every path through proc from its start and its handlers, returning {inst_ptr : (stack letters,
+	# locals letters)} before each reachable instruction, or raising a VerificationError
+	code = vm_opcode.decode_opcodes(proc.opcodes)
+	states = {}
+	pending = []
+	def add_state(target, stack, locals):
+		if target not in states:
+			states[target] = (stack, locals)
+			pending.append(target)
+		else:
+			old_stack, old_locals = states[target]
+			if len(old_stack) != len(stack):
+				raise verify_error("StackDepthMismatch", target)
+			merged = (merge_letters(old_stack, stack), merge_letters(old_locals, locals))
+			if merged != states[target]:
+				states[target] = merged
+				pending.append(target)
+	add_state(0, (), ('N',) * proc.locals_count)
+	for start, end, handler, error_type in proc.exception_table:
+		if not (0 <= start <= end <= len(proc.opcodes)) or not (0 <= handler < len(proc.opcodes)):
+			raise verify_error("InvalidTryRegion", handler)
+		if start <= handler < end:
+			# An error raised by the handler would run the handler again, forever
+			raise verify_error("InvalidTryRegion", handler)
+		# A handler starts with the error's token on the stack, and locals as the region left them
+		add_state(handler, ('T',), ('V',) * proc.locals_count)
+	while pending:
+		inst_ptr = pending.pop()
+		handler, opcode, operand, next_ptr = code[inst_ptr]
+		if inst_ptr >= len(proc.opcodes):
+			raise verify_error("FallsOffEnd", inst_ptr)
+		if handler in (vm_opcode.op_UNKNOWN, vm_opcode.op_IP_OUT_OF_BOUNDS, vm_opcode.op_IP_MISALIGNED):
+			raise verify_error("InvalidInstruction", inst_ptr)
+		if handler in (vm_opcode.op_NI, vm_opcode.op_NIO):
+			raise verify_error("OpcodeNotImplemented", inst_ptr)
+		# The operand as written in opcodes, decoded entries may hold a specialized one
+		operand = vm_opcode.instruction_operand(proc.opcodes, inst_ptr, next_ptr)
+		stack, locals = states[inst_ptr]
+		stack, locals, popped = instruction_effect(proc, inst_ptr, opcode, operand, stack, locals)
+		for target in successors(proc, inst_ptr, opcode, operand, next_ptr):
+			add_state(target, stack, locals)
+	return states
+
+def proven(opcode, stack):
+	# True if the stack letters prove the type checks of the handler of opcode
+	if opcode in (1, 16, 17):
+		# the inputs of POP, CALL and TAILCALL depend on their operand, and are never typed
+		return False
+	inputs = stack_inputs(opcode, None)
+	for required, actual in zip(inputs, stack[len(stack) - len(inputs):]):
+		if required != 'V' and required != actual:
+			return False
+	return True
+
+def unchecked_entry(proc, entry, stack, locals):
+	# Returns the unchecked version of a decoded entry, or the entry itself if it still needs its checks
+	handler, opcode, operand, next_ptr = entry
+	if opcode == 20:
+		return (vm_opcode.op_LD_VALUE_UNCHECKED, opcode, proc.consts[operand], next_ptr)
+	elif opcode == 1:
+		if operand > 0:
+			return (vm_opcode.op_POP_UNCHECKED, opcode, operand, next_ptr)
+	elif opcode == 201:
+		if locals[operand[0]] == 'I' and locals[operand[1]] == 'I':
+			return (vm_opcode.op_LD_LOCAL_LD_LOCAL_IADD_UNCHECKED, opcode, operand, next_ptr)
+	elif not proven(opcode, stack):
+		pass
+	elif opcode in UncheckedHandlers:
+		return (UncheckedHandlers[opcode], opcode, operand, next_ptr)
+	elif hasattr(handler, 'make_unchecked'):
+		return (handler.make_unchecked(handler.operation), opcode, operand, next_ptr)
+	return entry
+
+def verify_proc(proc):
+	# Verifies proc and switches it to unchecked handlers wherever the checks were proven.
+	# Returns {'sites', 'unchecked_sites', 'max_stack'}, or raises a VerificationError and leaves proc unchanged.
+	states = analyze_proc(proc)
+	code = vm_opcode.decode_opcodes(proc.opcodes)
+	unchecked_sites = 0
+	max_stack = 0
+	for inst_ptr, (stack, locals) in states.items():
+		max_stack = max(max_stack, len(stack))
+		entry = unchecked_entry(proc, code[inst_ptr], stack, locals)
+		if entry is not code[inst_ptr]:
+			code[inst_ptr] = entry
+			unchecked_sites += 1
+	proc.code = code
+	proc.verified = True
+	return { 'sites':len(states), 'unchecked_sites':unchecked_sites, 'max_stack':max_stack }
+
+def verify_module(module):
+	# Verifies every proc of a Module, returning the list of verify_proc results
+	return [verify_proc(proc) for proc in module.procs]